@@ -5,7 +5,6 @@ import os
 from elasticsearch import Elasticsearch
 # flask extensions
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
@@ -13,15 +12,28 @@ from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 # local modules
 from config import Config
+from app.compression import Compression
+from app.metrics import Metrics
+from app.presence import LastSeenBuffer
+from app.replicas import ReadReplicas, RoutingSQLAlchemy
+from app.search import init_backend
+from app.sqlitedb import SQLiteProfile
 
 
 # instantiate extensions without attaching to the app
-db = SQLAlchemy()
+# note: the db session routes the reads of GET requests to the read
+# replicas, if any (see app/replicas.py)
+db = RoutingSQLAlchemy()
+read_replicas = ReadReplicas()
+sqlite_profile = SQLiteProfile()
 migrate = Migrate()
 login = LoginManager()
 mail = Mail()
 bootstrap = Bootstrap()
 moment = Moment()
+last_seen_buffer = LastSeenBuffer()
+metrics = Metrics()
+compression = Compression()
 
 # configure LoginManager object which view function handles logins
 login.login_view = 'auth.login' 
@@ -31,15 +43,21 @@ login.login_message = 'Please log in to access this page.'
 def app_factory(config_class=Config):
     # create and configure app instance
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
 
     # attach extensions to app
     db.init_app(app)
+    read_replicas.init_app(app)
+    # SQLite pragmas, pooling and write queue (see app/sqlitedb.py)
+    sqlite_profile.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
+    last_seen_buffer.init_app(app)
+    # opt-in request metrics and /metrics endpoint (see app/metrics.py)
+    metrics.init_app(app)
 
     # create elasticsearch instance
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
@@ -53,6 +71,47 @@ def app_factory(config_class=Config):
     # note: if no elasticsearch URL is returned, this will signal that 
     # elasticsearch should be disabled.
 
+    # search backend: elasticsearch, or else the embedded engine
+    # (see app/search.py)
+    app.search_backend = init_backend(app)
+
+    # search outbox worker (see app/indexer.py)
+    from app.indexer import search_indexer
+    search_indexer.init_app(app)
+
+    # cache of the search results' post records (see app/records.py)
+    from app.records import post_records
+    post_records.init_app(app)
+
+    # search result cache (see app/searchcache.py)
+    from app.searchcache import search_cache
+    search_cache.init_app(app)
+
+    # rendered post fragments (see app/fragments.py)
+    from app.fragments import post_fragments
+    post_fragments.init_app(app)
+
+    # buffer of the most recent posts, for /explore (see app/explore.py)
+    from app.explore import explore_buffer
+    explore_buffer.init_app(app)
+
+    # users loaded for their session cookie (see app/usercache.py)
+    from app.usercache import user_cache
+    user_cache.init_app(app)
+
+    # password hashing pool (see app/hashing.py)
+    from app.hashing import password_hasher
+    password_hasher.init_app(app)
+
+    # background celebrity retags, in 'hybrid' TIMELINE_MODE (see
+    # app/timeline.py)
+    from app.timeline import celebrity_retagger
+    celebrity_retagger.init_app(app)
+
+    # new posts pushed to open home timelines (see app/live.py)
+    from app.live import live_hub
+    live_hub.init_app(app)
+
     # register blueprints
     from app.errors import bp as errors_bp
     from app.auth import bp as auth_bp
@@ -61,6 +120,10 @@ def app_factory(config_class=Config):
     app.register_blueprint(auth_bp, url_prefix='/auth') 
     app.register_blueprint(main_bp)
 
+    # response compression and precompressed static files (see
+    # app/compression.py); after every blueprint with a static folder
+    compression.init_app(app)
+
     # Error logging
     if not app.debug and not app.testing:
         # setup logging to email
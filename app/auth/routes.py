@@ -6,6 +6,7 @@ from flask_login import current_user, login_user, logout_user, login_required
 from app import db  
 from app.auth import bp
 from app.auth.forms import LoginForm, SignUpForm
+from app.hashing import password_hasher
 from app.models import User
 
 
@@ -19,6 +20,10 @@ def login():
         if user is None or not user.check_password(form.password.data):
             flash('Invalid username or password')
             return redirect(url_for('auth.login'))
+        if password_hasher.needs_rehash(user.password_hash):
+            # PASSWORD_HASH_METHOD changed: rehash with the new cost
+            user.set_password(form.password.data)
+            db.session.commit()
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
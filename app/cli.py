@@ -0,0 +1,168 @@
+"""
+Custom `flask` CLI commands.
+"""
+# python packages
+import click
+import time
+# local modules
+from app import db
+from app import indexer
+from app.compression import SUFFIXES, compress_static
+from app.dataio import DataError, export_data, import_data
+from app.indexer import searchable_models
+from app import timeline as timelines
+from app.models import User
+
+
+def register(app):
+    """
+    Attach the custom command groups to the app's `flask` CLI.
+    """
+    @app.cli.group()
+    def timeline():
+        """Materialized home timeline commands."""
+        pass
+
+    @timeline.command()
+    @click.option('--user-id', type=int, default=None,
+        help='Only rebuild this user\'s timeline.')
+    def rebuild(user_id):
+        """Backfill (or repair) materialized timelines."""
+        timelines.rebuild(db.session, user_id)
+        db.session.commit()
+        click.echo('Timelines rebuilt.')
+
+    @timeline.command()
+    def retag():
+        """Promote or demote the celebrities that crossed a threshold."""
+        promoted, demoted = timelines.retag(db.session)
+        db.session.commit()
+        click.echo(f'Promoted {len(promoted)} and demoted {len(demoted)} '
+            'user(s).')
+
+    @app.cli.group()
+    def counters():
+        """Denormalized counter commands."""
+        pass
+
+    @counters.command()
+    def repair():
+        """Recompute follower/following/post counters for every user."""
+        repaired = User.repair_counters()
+        db.session.commit()
+        click.echo(f'Repaired counters of {repaired} user(s).')
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    def backlog():
+        """Show the depth of the search indexing outbox."""
+        pending, failing, oldest = indexer.backlog()
+        click.echo(f'{pending} update(s) pending, {failing} failing.')
+        if oldest is not None:
+            click.echo(f'Oldest due since {oldest:%Y-%m-%d %H:%M:%S} UTC.')
+
+    @search.command()
+    def drain():
+        """Send every due update in the search outbox to the search backend."""
+        if not app.search_backend:
+            raise click.ClickException('No search backend is configured.')
+        sent = indexer.drain()
+        pending, failing, _ = indexer.backlog()
+        click.echo(f'Sent {sent} update(s); {pending} pending, '
+            f'{failing} failing.')
+
+    @search.command()
+    @click.option('--index', 'index_names', multiple=True,
+        help='Index to rebuild (default: every searchable model).')
+    @click.option('--chunk-size', type=int, default=None,
+        help='Documents per bulk request.')
+    @click.option('--workers', type=int, default=None,
+        help='Concurrent bulk requests.')
+    @click.option('--new-index', is_flag=True,
+        help='Build into a new index, then swap the alias over to it.')
+    @click.option('--restart', is_flag=True,
+        help='Start over instead of resuming an interrupted reindex.')
+    def reindex(index_names, chunk_size, workers, new_index, restart):
+        """Rebuild search indexes from the database."""
+        if not app.search_backend:
+            raise click.ClickException('No search backend is configured.')
+        models = searchable_models()
+        for index in index_names or sorted(models):
+            if index not in models:
+                raise click.BadParameter(f'no searchable model named {index!r}',
+                    param_hint='--index')
+            reported = [0.0]
+            def progress(indexed, elapsed):
+                # report every 5 seconds at most
+                if elapsed - reported[0] >= 5:
+                    reported[0] = elapsed
+                    click.echo(f'{index}: {indexed} documents, '
+                        f'{indexed / elapsed:.0f} docs/s', err=True)
+            result = models[index].reindex(chunk_size=chunk_size,
+                workers=workers, new_index=new_index, restart=restart,
+                progress=progress)
+            resumed = f' (resumed after id {result.resumed_from})' \
+                if result.resumed_from else ''
+            click.echo(f'{index}: indexed {result.indexed} documents into '
+                f'{result.target} in {result.elapsed:.1f}s '
+                f'({result.rate:.0f} docs/s){resumed}.')
+
+    @app.cli.group()
+    def data():
+        """Bulk import/export commands."""
+        pass
+
+    @data.command('export')
+    @click.argument('output', type=click.File('w'), default='-')
+    @click.option('--batch-size', type=int, default=None,
+        help='Rows fetched at a time.')
+    def export_command(output, batch_size):
+        """Write every user, follow and post as newline-delimited JSON."""
+        start = time.perf_counter()
+        counts = export_data(output, batch_size=batch_size)
+        click.echo(f'Exported {describe(counts)} in '
+            f'{time.perf_counter() - start:.1f}s.', err=True)
+
+    @data.command('import')
+    @click.argument('input', type=click.File('r'), default='-')
+    @click.option('--batch-size', type=int, default=None,
+        help='Rows per INSERT batch.')
+    @click.option('--no-reindex', is_flag=True,
+        help='Don\'t rebuild the search indexes afterwards.')
+    def import_command(input, batch_size, no_reindex):
+        """Load users, follows and posts from newline-delimited JSON."""
+        start = time.perf_counter()
+        try:
+            counts = import_data(input, batch_size=batch_size,
+                reindex=not no_reindex)
+        except DataError as e:
+            raise click.ClickException(str(e))
+        click.echo(f'Imported {describe(counts)} in '
+            f'{time.perf_counter() - start:.1f}s.')
+
+    @app.cli.group()
+    def assets():
+        """Static file commands."""
+        pass
+
+    @assets.command('compress')
+    @click.option('--force', is_flag=True,
+        help='Rewrite the compressed files that are already current.')
+    def compress_command(force):
+        """Write precompressed (.gz/.br) versions of the static files."""
+        files = compress_static(app, force=force)
+        total = sum(size for _, size, _ in files)
+        for encoding in SUFFIXES:
+            compressed = sum(sizes.get(encoding, size)
+                for _, size, sizes in files)
+            if any(encoding in sizes for _, _, sizes in files):
+                click.echo(f'{encoding}: {total} -> {compressed} bytes')
+        click.echo(f'Compressed {len(files)} static file(s).')
+
+
+def describe(counts):
+    return ', '.join(f'{count} {kind}(s)' for kind, count in counts.items())
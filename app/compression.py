@@ -0,0 +1,239 @@
+"""
+Response compression, and precompressed static files.
+
+Responses are compressed when the client accepts it (Accept-Encoding), their
+mimetype is one of COMPRESS_MIMETYPES and they're at least COMPRESS_MIN_SIZE
+bytes: with brotli if the client accepts it and the `brotli` package is
+installed (and COMPRESS_BROTLI is set), else with gzip. Streamed responses
+are compressed as they're sent, each chunk flushed through the compressor so
+that the client gets it without waiting for the next one (they have no
+Content-Length, so they're compressed whatever their size).
+
+Responses that both hold a secret (a CSRF token) and may reflect the
+request's input (query string or form data: e.g., a page of search
+results, or a form re-rendered with its errors) are never compressed: the
+compressed length of such a page leaks how much of the secret an
+attacker's input guessed (BREACH).
+
+Static files aren't compressed per request. Instead, `flask assets compress`
+(run at build time; see Dockerfile) writes a .gz (and, with brotli, a .br)
+next to each compressible file of the static folders: the app's, and
+Flask-Bootstrap's (which the pages load with BOOTSTRAP_SERVE_LOCAL set,
+instead of its CDN's). The static views send the precompressed file the
+client accepts, if it's at least as new as the original.
+
+Set COMPRESS_LEVEL to 0 to disable both.
+"""
+# python packages
+import gzip
+import mimetypes
+import os
+import zlib
+from functools import wraps
+# flask extensions
+from flask import current_app, g, request, safe_join, send_from_directory
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# suffixes of the precompressed static files, by encoding (preferred first)
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+# compressible static files whose mimetype isn't guessed from their name
+STATIC_EXTENSIONS = ('.map', '.eot', '.ttf', '.otf')
+
+
+class Compression():
+    """
+    Flask extension compressing the responses of an app.
+
+        Notes
+            Initialized after the extensions and blueprints with static folders (e.g., Flask-Bootstrap), whose static views it wraps.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        settings = app.extensions['compression'] = _Settings(app)
+        if not settings.encodings:
+            return None
+        app.after_request(compress_response)
+        for endpoint, owner in static_owners(app).items():
+            app.view_functions[endpoint] = precompressed(
+                app.view_functions[endpoint], owner)
+
+
+class _Settings():
+    def __init__(self, app):
+        self.level = app.config['COMPRESS_LEVEL']
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.mimetypes = set(app.config['COMPRESS_MIMETYPES'])
+        self.brotli_quality = app.config['COMPRESS_BROTLI_QUALITY']
+        self.encodings = []
+        if self.level > 0:
+            if brotli is not None and app.config['COMPRESS_BROTLI']:
+                self.encodings.append('br')
+            self.encodings.append('gzip')
+
+
+def static_owners(app):
+    """
+    Returns {static endpoint: the app or blueprint whose static_folder it serves}.
+    """
+    owners = {}
+    if 'static' in app.view_functions:
+        owners['static'] = app
+    for name, blueprint in app.blueprints.items():
+        if f'{name}.static' in app.view_functions:
+            owners[f'{name}.static'] = blueprint
+    return owners
+
+
+def accepted(encodings):
+    """
+    Returns the first of the encodings that the request accepts, or None.
+    """
+    for encoding in encodings:
+        if request.accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+def compressor(encoding, settings):
+    """
+    Returns a streaming compressor for the encoding: (compress(chunk), flush(), finish()) functions.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=settings.brotli_quality)
+        return compressor.process, compressor.flush, compressor.finish
+    # wbits 31: gzip container
+    compressor = zlib.compressobj(settings.level, zlib.DEFLATED, 31)
+    return compressor.compress, \
+        lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def compress_stream(chunks, encoding, settings):
+    compress, flush, finish = compressor(encoding, settings)
+    for chunk in chunks:
+        data = compress(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+
+
+def breach_exposed():
+    """
+    Returns True if the response may hold both a CSRF token (one was generated for the request's forms) and input of the request.
+    """
+    field_name = current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+    return g.get(field_name) is not None and bool(request.args or request.form)
+
+
+def compress_response(response):
+    """
+    after_request handler: compress the response if it's compressible and the client accepts it.
+    """
+    settings = current_app.extensions['compression']
+    if request.method == 'HEAD' or response.status_code < 200 or \
+            response.status_code in (204, 206, 304) or \
+            response.direct_passthrough or \
+            'Content-Encoding' in response.headers or \
+            response.mimetype not in settings.mimetypes or \
+            breach_exposed():
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted(settings.encodings)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(), encoding,
+            settings)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < settings.min_size:
+            return response
+        response.set_data(brotli.compress(data, quality=settings.brotli_quality)
+            if encoding == 'br' else gzip.compress(data, settings.level))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak: # strong ETags are per representation
+        response.set_etag(f'{etag}-{encoding}')
+    return response
+
+
+def precompressed(view, owner):
+    """
+    Wrap a static view to send the precompressed version of the file that the client accepts, if there's a current one.
+    """
+    @wraps(view)
+    def wrapper(filename):
+        settings = current_app.extensions['compression']
+        folder = owner.static_folder
+        path = safe_join(folder, filename)
+        variants = [encoding for encoding in settings.encodings
+            if path and is_current(path + SUFFIXES[encoding], path)]
+        encoding = accepted(variants)
+        if encoding is None:
+            response = view(filename)
+        else:
+            mimetype = mimetypes.guess_type(filename)[0] or \
+                'application/octet-stream'
+            response = send_from_directory(folder,
+                filename + SUFFIXES[encoding], mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+        if variants:
+            response.vary.add('Accept-Encoding')
+        return response
+    return wrapper
+
+
+def is_current(variant, original):
+    try:
+        return os.stat(variant).st_mtime >= os.stat(original).st_mtime
+    except OSError:
+        return False
+
+
+def compress_static(app, force=False):
+    """
+    Write the precompressed versions (.gz, and .br with brotli) of the compressible files of the app's static folders.
+
+        Params
+            force (bool)
+                rewrite the versions that are already current
+
+        Returns
+            files (list) -- (path, size, {encoding: compressed size}) of each compressible file
+    """
+    settings = app.extensions['compression']
+    files = []
+    folders = [owner.static_folder for owner in static_owners(app).values()
+        if owner.has_static_folder]
+    for folder in folders:
+        for root, _, names in os.walk(folder):
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                if name.endswith(tuple(SUFFIXES.values())) or not (
+                        mimetypes.guess_type(name)[0] in settings.mimetypes or
+                        name.endswith(STATIC_EXTENSIONS)):
+                    continue
+                with open(path, 'rb') as f:
+                    data = f.read()
+                sizes = {}
+                for encoding in settings.encodings:
+                    variant = path + SUFFIXES[encoding]
+                    if not force and is_current(variant, path):
+                        sizes[encoding] = os.path.getsize(variant)
+                        continue
+                    compressed = brotli.compress(data, quality=11) \
+                        if encoding == 'br' else gzip.compress(data, 9)
+                    if len(compressed) >= len(data):
+                        continue # not worth it
+                    with open(variant, 'wb') as f:
+                        f.write(compressed)
+                    sizes[encoding] = len(compressed)
+                files.append((path, len(data), sizes))
+    return files
@@ -0,0 +1,108 @@
+"""
+HTTP conditional GETs for the timeline pages: their responses carry a weak
+ETag computed from versions of what the page shows, and a request whose
+If-None-Match matches is answered with a 304 before the page's queries run
+or its template renders.
+
+An ETag combines the view's validator with the viewer's own versions: id,
+profile_version (the navbar links to their profile) and follow_version
+(bumped by follow()/unfollow(): the Follow/Unfollow links, and whose posts
+are in their home timeline). The validators:
+    main.index -- over the viewer and the accounts they follow (one aggregate query): their newest post id (new posts), their count, and the sums of posts_count (deletes) and profile_version (renames, avatar changes; only ever bumped, so its sum only grows); plus the CSRF token of the page's post form
+    main.explore -- the explore buffer's shared mark, bumped by the commits that insert or delete posts or change authors, in any process (see app/explore.py); so explore's 304s need no SQL. With the buffer disabled, explore isn't conditional.
+    main.user -- the profile's user row (profile, counters, last_seen, pending included) and their newest post id
+Pages that carry flash messages get no ETag (the messages show only once).
+Responses are `Cache-Control: private, no-cache`: caches may keep them, but
+revalidate them on every use, per viewer.
+
+Set CONDITIONAL_GET to False to disable it.
+"""
+# python packages
+import time
+from functools import wraps
+from hashlib import md5
+# flask extensions
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+# local modules
+from app import db, last_seen_buffer
+
+
+def conditional(validator):
+    """
+    Decorator for views answering GETs with 304 when the client's copy is current.
+
+        Params
+            validator (func)
+                called with the view's arguments; returns a tuple of versions of what the page shows, or None to answer normally without an ETag
+
+        Notes
+            Goes below login_required: the viewer's versions are part of the ETag.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or \
+                    not current_app.config['CONDITIONAL_GET'] or \
+                    '_flashes' in session:
+                return view(*args, **kwargs)
+            versions = validator(*args, **kwargs)
+            if versions is None:
+                return view(*args, **kwargs)
+            etag = make_etag(versions)
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or '_flashes' in session:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+def make_etag(versions):
+    viewer = (current_user.id, current_user.profile_version,
+        current_user.follow_version)
+    return md5(repr((viewer, versions)).encode('utf-8')).hexdigest()
+
+
+def feed_validator():
+    from app.models import Post, User, followers
+    followed = db.select([followers.c.followed_id]). \
+        where(followers.c.follower_id == current_user.id)
+    # note: a post deleted and another posted leave posts_count as it was,
+    # but not the newest id (an index range scan per author, on
+    # ix_post_user_id_timestamp)
+    newest = db.select([db.func.max(Post.id)]).where(db.or_(
+        Post.user_id == current_user.id, Post.user_id.in_(followed))). \
+        as_scalar()
+    versions = tuple(db.session.query(newest, db.func.count(User.id),
+        db.func.sum(User.posts_count), db.func.sum(User.profile_version)).
+        filter(db.or_(User.id == current_user.id, User.id.in_(followed))).
+        one())
+    if current_app.config.get('WTF_CSRF_ENABLED', True):
+        # the post form's token is per session, and expires: renew the page
+        # at half the token's lifetime
+        limit = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+        versions += (session.get('csrf_token'), int(time.time() // (limit / 2)))
+    return versions
+
+
+def explore_validator():
+    from app.explore import explore_buffer
+    return explore_buffer.version()
+
+
+def profile_validator(username):
+    from app.models import User, Post
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return None
+    last_seen = last_seen_buffer.get(user.id) or user.last_seen
+    return (user.id, user.profile_version, user.about_me, user.followers_count,
+        user.followed_count, user.posts_count, last_seen,
+        db.session.query(db.func.max(Post.id)).
+            filter(Post.user_id == user.id).scalar())
@@ -0,0 +1,216 @@
+"""
+Bulk import/export of users, follows and posts as newline-delimited JSON
+(`flask data export` / `flask data import`).
+
+Each line is one JSON object with a "type" ('user', 'follow' or 'post') and
+the row's columns; datetimes are ISO 8601 strings. Exports list every user,
+then every follow, then every post, so a file can be imported back in one
+pass. Ids are kept, so imports go into an empty database (or one whose ids
+don't overlap).
+
+Both directions stream in constant memory:
+    export -- each table is read through one server-side cursor (stream_results; on SQLite, the DBAPI cursor already steps through the result lazily), DATA_BATCH_SIZE rows at a time
+    import -- lines are parsed one at a time and inserted with one executemany() per DATA_BATCH_SIZE rows of a table, in a single transaction
+The import goes through Core, not the ORM, so none of the session hooks run
+per row: no search outbox rows (or sync index requests), no timeline
+pushes, no counter updates. Instead, once every row is in, the counters
+(and, in 'fanout'/'hybrid' TIMELINE_MODE, the timelines) are rebuilt in
+bulk, and the search indexes are rebuilt with one reindex per searchable
+model (see app/reindex.py).
+"""
+# python packages
+import json
+from datetime import datetime
+# flask extensions
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+# local modules
+from app import db
+from app import indexer, timeline
+from app.models import User, Post, followers
+
+
+# columns of each record type, in insert order
+COLUMNS = {
+    'user': ('id', 'username', 'email', 'password_hash', 'about_me',
+        'last_seen'),
+    'follow': ('follower_id', 'followed_id'),
+    'post': ('id', 'body', 'timestamp', 'user_id')}
+DATETIME_COLUMNS = ('last_seen', 'timestamp')
+# how SQLAlchemy stores datetimes in SQLite
+SQLITE_DATETIME = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class DataError(Exception):
+    pass
+
+
+def tables():
+    """
+    Returns the exported tables as (record type, table, columns) tuples, in import order (users first: the other tables reference them).
+
+        Notes
+            The denormalized columns (counters, celebrity tag, avatar digest, profile version) aren't exported: they're recomputed on import.
+    """
+    return [(kind, table, COLUMNS[kind]) for kind, table in (
+        ('user', User.__table__), ('follow', followers),
+        ('post', Post.__table__))]
+
+
+def insert_rows(connection, table, columns, rows):
+    """
+    INSERT the rows (tuples of `columns` values) with one executemany().
+
+        Notes
+            On SQLite, the rows go straight to the DBAPI cursor: SQLAlchemy's per-row parameter processing otherwise takes longer than the inserts themselves. Datetimes are then written in SQLAlchemy's SQLite storage format (always with microseconds, so that they compare as strings with the values SQLAlchemy binds).
+    """
+    if not rows:
+        return None
+    if connection.dialect.name != 'sqlite':
+        connection.execute(table.insert(),
+            [dict(zip(columns, row)) for row in rows])
+        return None
+    rows = [tuple(value.strftime(SQLITE_DATETIME)
+        if isinstance(value, datetime) else value for value in row)
+        for row in rows]
+    name = connection.dialect.identifier_preparer.quote(table.name)
+    connection.connection.cursor().executemany(
+        f"INSERT INTO {name} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' * len(columns))})", rows)
+
+
+def export_data(stream, batch_size=None):
+    """
+    Write every user, follow and post to the stream, one JSON object per line.
+
+        Returns
+            counts (dict) -- rows written, by record type
+    """
+    batch_size = batch_size or current_app.config['DATA_BATCH_SIZE']
+    connection = db.session.connection(). \
+        execution_options(stream_results=True)
+    counts = {}
+    for kind, table, columns in tables():
+        select = db.select([table.c[column] for column in columns])
+        if kind == 'follow':
+            select = select.order_by(*select.columns)
+        else:
+            select = select.order_by(table.c.id)
+        result = connection.execute(select)
+        count = 0
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            lines = []
+            for row in rows:
+                record = {'type': kind}
+                for column, value in zip(columns, row):
+                    record[column] = value.isoformat() \
+                        if isinstance(value, datetime) else value
+                lines.append(json.dumps(record, separators=(',', ':')))
+            stream.write('\n'.join(lines) + '\n')
+            count += len(rows)
+        result.close()
+        counts[kind] = count
+    db.session.commit()
+    return counts
+
+
+def import_data(stream, batch_size=None, reindex=True):
+    """
+    Insert the users, follows and posts of an NDJSON stream (as written by export_data()), then rebuild what's derived from them.
+
+        Params
+            stream (obj)
+                text file-like object
+            batch_size (int)
+                rows per executemany() (default: DATA_BATCH_SIZE)
+            reindex (bool)
+                rebuild the search indexes afterwards (if a search backend is configured)
+
+        Returns
+            counts (dict) -- rows inserted, by record type
+
+        Raises
+            DataError -- if a line isn't a valid record, or rows conflict with existing ones (nothing is inserted then)
+    """
+    from app.explore import explore_buffer
+    batch_size = batch_size or current_app.config['DATA_BATCH_SIZE']
+    # users also get their avatar digest (see parse_row())
+    specs = {kind: (table, columns + (('avatar_digest',)
+        if kind == 'user' else ())) for kind, table, columns in tables()}
+    order = list(specs)
+    batches = {kind: [] for kind in specs}
+    counts = {kind: 0 for kind in specs}
+    connection = db.session.connection()
+
+    def flush(kind):
+        # rows of the tables before `kind` go in first (foreign keys)
+        for earlier in order[:order.index(kind) + 1]:
+            table, columns = specs[earlier]
+            insert_rows(connection, table, columns, batches[earlier])
+            counts[earlier] += len(batches[earlier])
+            batches[earlier] = []
+
+    try:
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                batches[record['type']].append(parse_row(record))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                raise DataError(f'line {number}: invalid record ({e!r})')
+            if len(batches[record['type']]) >= batch_size:
+                flush(record['type'])
+        flush(order[-1])
+        User.repair_counters()
+        if timeline.fanout_enabled():
+            timeline.rebuild(db.session)
+        reset_sequences(connection)
+        db.session.commit()
+    except (IntegrityError, connection.dialect.dbapi.IntegrityError) as e:
+        db.session.rollback()
+        raise DataError(f'rows conflict with the data in the database (the '
+            f'ids must not be in use): {e}')
+    except Exception:
+        db.session.rollback()
+        raise
+    # the explore buffers of every process reload with the new posts
+    explore_buffer.invalidate()
+    if reindex and current_app.search_backend is not None:
+        for model in indexer.searchable_models().values():
+            model.reindex()
+    return counts
+
+
+def parse_row(record):
+    """
+    Returns the row of a record, as a tuple in its table's column order (plus, for users, the avatar digest).
+    """
+    kind = record['type']
+    columns = COLUMNS[kind]
+    row = [record.get(column) for column in columns]
+    for index, column in enumerate(columns):
+        if column in DATETIME_COLUMNS and row[index] is not None:
+            row[index] = datetime.fromisoformat(row[index])
+    if kind == 'user':
+        email = record.get('email')
+        row.append(User.make_avatar_digest(email) if email else None)
+    return tuple(row)
+
+
+def reset_sequences(connection):
+    """
+    Move the id sequences past the imported ids (PostgreSQL; elsewhere, autoincrement already follows the largest id).
+    """
+    if connection.dialect.name != 'postgresql':
+        return None
+    quote = connection.dialect.identifier_preparer.quote
+    for kind, table, columns in tables():
+        if 'id' in columns:
+            name = quote(table.name)
+            connection.execute(db.text(
+                f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), "
+                f"(SELECT coalesce(max(id), 0) + 1 FROM {name}), false)"))
@@ -1,8 +1,9 @@
 # extensions
-from flask import render_template
+from flask import make_response, render_template
 # local modules
 from app import db
 from app.errors import bp
+from app.hashing import HashingBusy
 
 @bp.app_errorhandler(404)
 def not_found_error(error):
@@ -11,4 +12,11 @@ def not_found_error(error):
 @bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback() # resets the session
-    return render_template('errors/500.html'), 500
\ No newline at end of file
+    return render_template('errors/500.html'), 500
+
+@bp.app_errorhandler(HashingBusy)
+def hashing_busy_error(error):
+    # login/signup burst: ask the client to come back (see app/hashing.py)
+    response = make_response(render_template('errors/503.html'), 503)
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
\ No newline at end of file
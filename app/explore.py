@@ -0,0 +1,327 @@
+"""
+In-memory buffer of the most recent posts, serving the first pages of
+/explore without querying the post table.
+
+Each process keeps the EXPLORE_BUFFER_SIZE newest posts (as PostRecords;
+see app/records.py), ordered by (timestamp, id). It's loaded from the db on
+first use, and kept current by the commits of this process: new posts are
+inserted, deleted posts removed, and renamed authors updated in place.
+
+The commits of other processes (e.g., other gunicorn workers) are seen
+through a shared high-water mark: a small memory-mapped file
+(EXPLORE_BUFFER_MARK_FILE) holding two counters that every process bumps
+on commit:
+    generation -- bumped when posts are inserted; a process that sees it change fetches the posts with ids above the newest id it holds
+    epoch -- bumped when posts are deleted or authors change; a process that sees it change reloads the whole buffer
+Without a mark file (or if it can't be opened, in which case a warning is
+logged), only this process's commits are seen. The buffer is
+also reloaded every EXPLORE_BUFFER_TTL seconds, which bounds staleness if
+ids aren't assigned in commit order (concurrent writers on a database with
+sequences) or a process crashed between its commit and its bump.
+"""
+# python packages
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+# flask extensions
+from flask import current_app
+# local modules
+from app import db
+from app.pagination import decode_cursor, make_page, post_key
+from app.records import AuthorRecord, PostRecord
+from app.replicas import use_primary
+
+
+MARK = struct.Struct('<QQ') # generation, epoch
+
+
+class SharedMark():
+    """
+    The (generation, epoch) counters, shared between processes through a memory-mapped file (or local to this process if path is None).
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.counters = [0, 0]
+        self.map = None
+        if path:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < MARK.size:
+                    os.ftruncate(fd, MARK.size)
+                self.map = mmap.mmap(fd, MARK.size)
+            finally:
+                os.close(fd)
+        self.lock = threading.Lock()
+
+    def read(self):
+        if self.map is None:
+            return tuple(self.counters)
+        return MARK.unpack_from(self.map)
+
+    def bump(self, generation=0, epoch=0):
+        """
+        Add to the counters; returns (old, new) values.
+        """
+        with self.lock:
+            if self.map is None:
+                old = tuple(self.counters)
+                self.counters = [old[0] + generation, old[1] + epoch]
+                return old, tuple(self.counters)
+            with open(self.path, 'rb') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    old = MARK.unpack_from(self.map)
+                    new = (old[0] + generation, old[1] + epoch)
+                    MARK.pack_into(self.map, 0, *new)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return old, new
+
+
+class ExploreBuffer():
+    """
+    Flask extension holding one buffer of recent posts per app.
+
+        Notes
+            Set EXPLORE_BUFFER_SIZE to 0 to disable the buffer (every page is queried).
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['explore_buffer'] = _Ring(app)
+
+    def _ring(self):
+        return current_app.extensions['explore_buffer']
+
+    def keyset_paginate(self, per_page, after=None, before=None):
+        """
+        Returns a KeysetPage of the buffered posts past the cursor, like KeysetQuery.keyset_paginate(), or None if the buffer doesn't hold all the posts of the page (or is disabled).
+
+            Raises
+                ValueError -- if the cursor is malformed
+        """
+        return self._ring().keyset_paginate(per_page, after, before)
+
+    def publish(self, new=(), deleted=(), authors=()):
+        """
+        Apply the changes committed by this process to the buffer, and bump the shared mark so that other processes pick them up.
+
+            Params
+                new (list) -- PostRecords of inserted posts
+                deleted (list) -- ids of deleted posts
+                authors (list) -- AuthorRecords of authors whose username or avatar changed
+        """
+        self._ring().publish(new, deleted, authors)
+
+    def invalidate(self):
+        """
+        Make every process reload its buffer, e.g. after posts were written without going through the session (bulk imports).
+        """
+        self._ring().invalidate()
+
+    def version(self):
+        """
+        Returns the shared (generation, epoch) mark, which every commit that changes the posts or their authors bumps (None if the buffer is disabled).
+        """
+        mark = self._ring().mark
+        return mark.read() if mark is not None else None
+
+
+class _Ring():
+    def __init__(self, app):
+        self.size = app.config['EXPLORE_BUFFER_SIZE']
+        self.ttl = app.config['EXPLORE_BUFFER_TTL']
+        self.mark = self.open_mark(app) if self.size > 0 else None
+        self.keys = [] # (timestamp, id), oldest first
+        self.records = [] # PostRecords, in the same order
+        self.complete = False # the buffer holds every post
+        self.max_id = 0 # newest id read from the db (not from publish())
+        self.seen = None # mark when last synced; None: not loaded
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def open_mark(app):
+        path = app.config['EXPLORE_BUFFER_MARK_FILE']
+        try:
+            return SharedMark(path)
+        except OSError as error:
+            app.logger.warning(f'explore buffer: cannot open the mark file '
+                f'({error}); only the commits of this process are seen, and '
+                f"other processes' every EXPLORE_BUFFER_TTL seconds")
+            return SharedMark()
+
+    # note: the rows are queried without holding the lock, which the
+    # requests of the process (and publish(), from after_commit) would
+    # otherwise queue behind; they're only swapped in if the buffer wasn't
+    # synced meanwhile (it's then at least as current)
+    def sync(self):
+        mark = self.mark.read() # before the query: the rows are as new
+        with self.lock:
+            seen, max_id, loaded_at = self.seen, self.max_id, self.loaded_at
+        if seen is not None and mark[1] == seen[1] and \
+                time.monotonic() - loaded_at <= self.ttl:
+            if mark[0] == seen[0]:
+                return None
+            rows = self.fetch_new(max_id)
+            if rows is not None:
+                with self.lock:
+                    if self.seen == seen:
+                        self.insert(rows)
+                        self.max_id = max([self.max_id] +
+                            [record.id for record in rows])
+                        self.seen = mark
+                return None
+        rows = self.fetch_all()
+        with self.lock:
+            if self.seen == seen:
+                self.reload(rows, mark)
+
+    def query(self):
+        from app.models import Post
+        return Post.query.records()
+
+    def fetch_all(self):
+        from app.models import Post
+        return self.query().order_by(Post.timestamp.desc(), Post.id.desc()). \
+            limit(self.size + 1).all()
+
+    def fetch_new(self, max_id):
+        """
+        Returns the posts with ids above max_id, or None if there are too many to insert (reload instead).
+        """
+        from app.models import Post
+        rows = self.query().filter(Post.id > max_id).order_by(Post.id). \
+            limit(self.size + 1).all()
+        return rows if len(rows) <= self.size else None
+
+    def reload(self, rows, mark):
+        self.complete = len(rows) <= self.size
+        records = sorted(rows[:self.size], key=post_key)
+        self.records = records
+        self.keys = [post_key(record) for record in records]
+        self.max_id = max((record.id for record in records), default=0)
+        self.seen = mark
+        self.loaded_at = time.monotonic()
+
+    def insert(self, records):
+        for record in records:
+            key = post_key(record)
+            if record.timestamp is None:
+                continue
+            if not self.complete and self.keys and key < self.keys[0]:
+                continue # older than everything buffered: not a recent post
+            position = bisect_left(self.keys, key)
+            if position < len(self.keys) and self.keys[position] == key:
+                continue
+            self.keys.insert(position, key)
+            self.records.insert(position, record)
+        if len(self.records) > self.size:
+            excess = len(self.records) - self.size
+            del self.keys[:excess]
+            del self.records[:excess]
+            self.complete = False
+
+    def publish(self, new, deleted, authors):
+        if self.mark is None:
+            return None
+        old, mark = self.mark.bump(generation=1 if new else 0,
+            epoch=1 if deleted or authors else 0)
+        with self.lock:
+            if self.seen is None:
+                return None # not loaded yet; the first read loads it all
+            self.insert(new)
+            if deleted:
+                deleted = set(deleted)
+                kept = [index for index, record in enumerate(self.records)
+                    if record.id not in deleted]
+                self.keys = [self.keys[index] for index in kept]
+                self.records = [self.records[index] for index in kept]
+            for author in authors:
+                for record in self.records:
+                    if record.author.id == author.id:
+                        record.author = author
+            # if nobody else committed since our last sync, the buffer is
+            # now current as of the new mark
+            if old == self.seen:
+                self.seen = mark
+
+    def invalidate(self):
+        if self.mark is None:
+            return None
+        self.mark.bump(epoch=1)
+
+    def keyset_paginate(self, per_page, after, before):
+        if self.mark is None:
+            return None
+        cursor = after or before
+        if cursor is not None:
+            timestamp, id = decode_cursor(cursor)
+            if not isinstance(timestamp, datetime) or not isinstance(id, int):
+                raise ValueError(f'invalid cursor: {cursor!r}')
+            key = (timestamp, id)
+        # note: the buffer is shared by every request of the process, so
+        # it's filled from the primary (see app/replicas.py)
+        with use_primary():
+            self.sync()
+        with self.lock:
+            if before is not None:
+                # the buffer always holds the newest posts, so every newer
+                # post is in it unless the cursor is older than the buffer
+                if not self.complete and (not self.keys or key < self.keys[0]):
+                    return None
+                start = bisect_right(self.keys, key)
+                rows = self.records[start:start + per_page + 1]
+            else:
+                end = bisect_left(self.keys, key) if after is not None \
+                    else len(self.keys)
+                rows = self.records[max(0, end - per_page - 1):end][::-1]
+                if len(rows) <= per_page and not self.complete:
+                    return None
+        return make_page(rows, per_page, after, before)
+
+
+def after_flush(session, flush_context):
+    """
+    Record the posts inserted/deleted and the authors renamed by a flush, for after_commit() to publish.
+    """
+    if current_app.config['EXPLORE_BUFFER_SIZE'] <= 0:
+        return None
+    from app.models import Post, User
+    changes = session.info.setdefault('explore_buffer',
+        {'new': [], 'deleted': [], 'authors': {}})
+    for obj in session.new:
+        if isinstance(obj, Post) and obj.author is not None:
+            changes['new'].append(PostRecord.from_model(obj))
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            changes['deleted'].append(obj.id)
+    for obj in session.dirty:
+        # note: what profile_version versions (it's bumped in SQL, so its
+        # new value is loaded here, on access)
+        attrs = db.inspect(obj).attrs if isinstance(obj, User) else None
+        if attrs is not None and (attrs.username.history.has_changes() or
+                attrs.avatar_digest.history.has_changes()):
+            changes['authors'][obj.id] = AuthorRecord(obj.id, obj.username,
+                obj.avatar_digest, obj.profile_version)
+
+
+def after_commit(session):
+    changes = session.info.pop('explore_buffer', None)
+    if changes and (changes['new'] or changes['deleted'] or changes['authors']):
+        explore_buffer.publish(changes['new'], changes['deleted'],
+            list(changes['authors'].values()))
+
+
+def after_rollback(session):
+    session.info.pop('explore_buffer', None)
+
+
+explore_buffer = ExploreBuffer()
@@ -0,0 +1,75 @@
+"""
+Cache of rendered post fragments (_post.html).
+
+Pages list posts with the render_posts() template global instead of
+including _post.html once per post. Each post's rendered HTML is cached by
+(post id, post timestamp, author's profile_version), so a post renders once
+per process and is then reused across pages and users. User.profile_version
+is bumped whenever the username or avatar changes, which supersedes all of
+that user's cached fragments (in every process: the version is read from
+the db with the post's author).
+
+The fragment must only depend on the post and its author: _post.html is
+rendered with the calling page's context, but the result is shared by every
+page and user that lists the post.
+"""
+# flask extensions
+from flask import current_app
+from jinja2 import Markup, contextfunction
+# local modules
+from app.searchcache import LocalBackend
+
+
+class FragmentCache():
+    """
+    Flask extension holding one LRU of rendered post fragments per app.
+
+        Notes
+            Holds up to FRAGMENT_CACHE_SIZE fragments (0 disables the cache), each for up to FRAGMENT_CACHE_TTL seconds; superseded fragments are never read again and age out of the LRU.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['post_fragments'] = LocalBackend(
+            app.config['FRAGMENT_CACHE_SIZE'])
+        app.add_template_global(render_posts)
+
+
+def fragment_key(post):
+    """
+    Returns the cache key of the post's fragment (None if it can't be cached).
+
+        Notes
+            The timestamp guards against a reused id (SQLite may reuse the id of the last post after it's deleted).
+    """
+    version = getattr(post.author, 'profile_version', None)
+    if version is None or post.timestamp is None:
+        return None
+    return f'{post.id}:{post.timestamp.isoformat()}:{version}'
+
+
+@contextfunction
+def render_posts(context, posts):
+    """
+    Returns the rendered _post.html fragments of the posts, concatenated; only cache misses are rendered.
+    """
+    cache = current_app.extensions['post_fragments']
+    ttl = current_app.config['FRAGMENT_CACHE_TTL']
+    template = None
+    fragments = []
+    for post in posts:
+        key = fragment_key(post) if cache.size > 0 else None
+        fragment = cache.get(key) if key else None
+        if fragment is None:
+            if template is None:
+                template = context.environment.get_template('_post.html')
+            fragment = template.render(dict(context.get_all(), post=post))
+            if key:
+                cache.set(key, fragment, ttl)
+        fragments.append(fragment)
+    return Markup(''.join(fragments))
+
+
+post_fragments = FragmentCache()
@@ -0,0 +1,128 @@
+"""
+Password hashing off the request threads.
+
+PBKDF2 is deliberately slow (PASSWORD_HASH_METHOD sets its cost), so a burst
+of logins/signups hashing on the web workers keeps them all busy, and every
+other request queues behind the burst. Instead, hashes are computed in a
+pool of PASSWORD_HASH_WORKERS processes, with admission control: at most
+PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE hashes are running or waiting
+at once, and past that callers get HashingBusy straight away, which the app
+answers with a 503 and a Retry-After header (see app/errors/handlers.py).
+The web workers held by logins are then bounded, and the rest keep serving.
+
+With PASSWORD_HASH_WORKERS = 0, hashes are computed in the calling thread,
+without admission control (as before).
+
+Hashes record their method (e.g. 'pbkdf2:sha256:150000'), so changing
+PASSWORD_HASH_METHOD doesn't invalidate stored passwords: they're checked
+with their own method, and rehashed with the new one on the next successful
+login (see auth.login).
+"""
+# python packages
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+# flask extensions
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingBusy(Exception):
+    """
+    Raised when the hashing pool is full. retry_after is the seconds the client should wait.
+    """
+    def __init__(self, retry_after):
+        super().__init__(f'password hashing is busy; retry in {retry_after}s')
+        self.retry_after = retry_after
+
+
+class PasswordHasher():
+    """
+    Flask extension hashing and checking the passwords of an app.
+
+        Notes
+            The worker processes are started on first use (not in init_app), so that they're not forked along with the app by preloading servers.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['password_hasher'] = _Hasher(app)
+
+    def _hasher(self):
+        return current_app.extensions['password_hasher']
+
+    def hash(self, password):
+        """
+        Returns the hash of the password, with PASSWORD_HASH_METHOD.
+
+            Raises
+                HashingBusy -- if the pool is full
+        """
+        hasher = self._hasher()
+        return hasher.run(generate_password_hash, password, hasher.method)
+
+    def check(self, pwhash, password):
+        """
+        Returns True if the password matches the hash.
+
+            Raises
+                HashingBusy -- if the pool is full
+        """
+        return self._hasher().run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """
+        Returns True if the hash wasn't made with PASSWORD_HASH_METHOD.
+        """
+        return pwhash.split('$', 1)[0] != self._hasher().method
+
+    def stats(self):
+        """
+        Returns the hashing statistics of this process: hashes (computed), rejected (HashingBusy raised), pending (running or waiting).
+        """
+        return self._hasher().stats()
+
+
+class _Hasher():
+    def __init__(self, app):
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.retry_after = app.config['PASSWORD_HASH_RETRY_AFTER']
+        self.slots = self.workers + app.config['PASSWORD_HASH_QUEUE']
+        self.executor = None
+        self.counts = {'hashes': 0, 'rejected': 0, 'pending': 0}
+        self.lock = threading.Lock()
+
+    def admit(self):
+        with self.lock:
+            if self.counts['pending'] >= self.slots:
+                self.counts['rejected'] += 1
+                raise HashingBusy(self.retry_after)
+            self.counts['pending'] += 1
+            if self.executor is None:
+                # note: spawned, not forked: the app has threads running
+                self.executor = ProcessPoolExecutor(self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    def run(self, func, *args):
+        if self.workers <= 0:
+            with self.lock:
+                self.counts['hashes'] += 1
+            return func(*args)
+        executor = self.admit()
+        try:
+            return executor.submit(func, *args).result()
+        finally:
+            with self.lock:
+                self.counts['pending'] -= 1
+                self.counts['hashes'] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,315 @@
+"""
+Asynchronous search indexing through a transactional outbox.
+
+When SEARCH_INDEXING is 'outbox', changes to searchable models are not sent
+to the search backend from the request that made them. Instead, each flush
+records one row per changed document in the `search_outbox` table, inside
+the same transaction as the change itself (so an update is recorded if and
+only if the change commits). A background worker drains the outbox with
+bulk requests: rows that fail are retried with exponential backoff, and the
+outbox row id is sent as the document's external version, so replays are
+idempotent and an older update can never overwrite a newer one.
+
+Every other write to an index takes its external version from the same
+sequence (see reserve_version()): 'sync' mode commits and reindexes. A
+version conflict (409) then always means that the index already holds a
+newer state of the document, never a write that jumped ahead of the outbox,
+so drained rows that conflict are done.
+"""
+# python packages
+import threading
+from datetime import datetime, timedelta
+# flask extensions
+from flask import current_app, has_app_context
+from sqlalchemy.engine.url import make_url
+# local modules
+from app import db, reindex
+from app.search import bulk_update, make_payload
+
+
+# Outbox table (`outbox`): one row per pending document update
+# note: sqlite_autoincrement stops SQLite from reusing the ids of drained
+# rows; ids must keep increasing because they are used as index versions.
+outbox = db.Table(
+    'search_outbox',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('index_name', db.String(64), nullable=False),
+    db.Column('doc_id', db.Integer, nullable=False),
+    db.Column('op', db.String(8), nullable=False),
+    db.Column('attempts', db.Integer, nullable=False, default=0,
+        server_default='0'),
+    db.Column('next_attempt', db.DateTime, nullable=False,
+        default=datetime.utcnow),
+    db.Index('ix_search_outbox_next_attempt', 'next_attempt'),
+    sqlite_autoincrement=True)
+
+# seconds before the n-th retry of a failed row: 2, 4, 8, ... up to 5 min
+RETRY_BACKOFF_CAP = 300
+
+
+def outbox_enabled():
+    """
+    Returns True if index updates go through the outbox (rather than being sent from after_commit).
+    """
+    return current_app.config['SEARCH_INDEXING'] == 'outbox' and \
+        current_app.search_backend is not None
+
+
+def enqueue(session, changes):
+    """
+    Record document updates in the outbox, in the session's transaction.
+
+        Params
+            session (obj)
+                SQLAlchemy session
+            changes (list)
+                (index, id, op) tuples; op is 'index' or 'delete'
+
+        Returns
+            None
+    """
+    now = datetime.utcnow()
+    session.execute(outbox.insert(), [
+        {'index_name': index, 'doc_id': id, 'op': op, 'attempts': 0,
+         'next_attempt': now}
+        for index, id, op in changes])
+    session.info['search_outbox'] = True
+
+
+def reserve_version(session):
+    """
+    Returns a new index version from the outbox id sequence, for a write that doesn't go through the outbox.
+
+        Notes
+            Inserts an outbox row and deletes it again, in the session's transaction: the row is never drained, and its id is only used up if the transaction commits.
+
+            Versions must be in commit order, so that a later commit's documents are never taken for older ones. Outbox ids are, on SQLite only: its writers are serialized, and a transaction takes its ids once it holds the write lock. On other databases a sequence hands out ids in the order transactions ask for them, not the order they commit in, so SearchIndexer.init_app() refuses them.
+    """
+    version = session.execute(outbox.insert().values(index_name='',
+        doc_id=0, op='reserve', attempts=0,
+        next_attempt=datetime.utcnow())).inserted_primary_key[0]
+    session.execute(outbox.delete().where(outbox.c.id == version))
+    return version
+
+
+def enqueue_select(session, index, ids):
+    """
+    Record an 'index' update in the outbox for every document id a SELECT returns, with a single INSERT ... SELECT (see enqueue()).
+    """
+    ids = ids.alias('ids')
+    session.execute(outbox.insert().from_select(
+        ['index_name', 'doc_id', 'op', 'attempts', 'next_attempt'],
+        db.select([db.literal(index), *ids.c, db.literal('index'),
+            db.literal(0), db.literal(datetime.utcnow())])))
+    session.info['search_outbox'] = True
+
+
+def after_rollback(session):
+    # the outbox rows recorded by the rolled-back flushes are gone too, and
+    # so are the changes their other session.info entries were about
+    session.info.pop('search_outbox', None)
+    session.info.pop('search_sync', None)
+    session.info.pop('search_sync_version', None)
+    session.info.pop('search_evict', None)
+
+
+def backlog():
+    """
+    Returns the outbox depth.
+
+        Returns
+            pending (int) -- count of rows waiting to be sent
+            failing (int) -- count of those that have failed at least once
+            oldest (datetime) -- next_attempt of the oldest row (None if the outbox is empty)
+    """
+    pending, failing, oldest = db.session.execute(db.select([
+        db.func.count(),
+        db.func.coalesce(db.func.sum(
+            db.case([(outbox.c.attempts > 0, 1)], else_=0)), 0),
+        db.func.min(outbox.c.next_attempt)])).first()
+    return pending, failing, oldest
+
+
+def searchable_models():
+    """
+    Returns a dict of the searchable model classes, by index name.
+    """
+    from app.models import SearchableMixin
+    return {model.__tablename__: model
+        for model in SearchableMixin.__subclasses__()}
+
+
+def drain_batch(batch_size):
+    """
+    Send one batch of due outbox rows to the search backend, in one bulk request.
+
+        Params
+            batch_size (int)
+                Maximum count of outbox rows to take.
+
+        Returns
+            sent (int) -- count of outbox rows applied (or found superseded); 0 if nothing was due or nothing could be applied
+
+        Notes
+            Rows are taken oldest first, and all rows for the same document are collapsed into a single operation carrying the newest row's id as its version. Documents are indexed as they are in the database at drain time (a document that no longer exists is deleted). Applied rows are deleted, failed rows are rescheduled, all in one transaction. The rows are locked with SKIP LOCKED, where the database supports it, so that several workers can drain concurrently.
+    """
+    now = datetime.utcnow()
+    rows = db.session.execute(outbox.select().
+        where(outbox.c.next_attempt <= now).
+        order_by(outbox.c.id).
+        limit(batch_size).
+        with_for_update(skip_locked=True)).fetchall()
+    if not rows:
+        db.session.commit()
+        return 0
+    latest = {} # (index, id) -> newest outbox row for the document
+    batched = {} # (index, id) -> every outbox row for the document
+    for row in rows:
+        key = (row.index_name, row.doc_id)
+        latest[key] = row
+        batched.setdefault(key, []).append(row)
+    models = searchable_models()
+    documents = {}
+    for index, model in models.items():
+        ids = [id for (row_index, id), row in latest.items()
+            if row_index == index and row.op == 'index']
+        if ids:
+            for row in model.search_rows().filter(model.id.in_(ids)):
+                documents[(index, row[0])] = make_payload(model, row[1:])
+    # indexes being rebuilt into a new index get every update twice, so
+    # that the new index doesn't miss the changes made during the build
+    build_targets = reindex.build_targets()
+    operations, operation_keys = [], []
+    for key, row in latest.items():
+        payload = documents.get(key)
+        op = 'index' if payload is not None else 'delete'
+        for index in [row.index_name] + build_targets.get(row.index_name, []):
+            operations.append((op, index, row.doc_id, row.id, payload))
+            operation_keys.append(key)
+    try:
+        applied = bulk_update(operations)
+    except Exception:
+        current_app.logger.exception('search outbox: bulk request failed')
+        applied = [False] * len(operations)
+    failed = {key for key, ok in zip(operation_keys, applied) if not ok}
+    done_ids, retries = [], []
+    for key in latest:
+        if key not in failed:
+            done_ids.extend(row.id for row in batched[key])
+            continue
+        for row in batched[key]:
+            delay = min(2 ** (row.attempts + 1), RETRY_BACKOFF_CAP)
+            retries.append({'row_id': row.id, 'attempts': row.attempts + 1,
+                'next_attempt': now + timedelta(seconds=delay)})
+    if done_ids:
+        db.session.execute(outbox.delete().where(outbox.c.id.in_(done_ids)))
+    if retries:
+        current_app.logger.warning(
+            f'search outbox: {len(retries)} row(s) failed; will retry')
+        db.session.execute(outbox.update().
+            where(outbox.c.id == db.bindparam('row_id')).
+            values(attempts=db.bindparam('attempts'),
+                next_attempt=db.bindparam('next_attempt')), retries)
+    db.session.commit()
+    return len(done_ids)
+
+
+def drain(batch_size=None):
+    """
+    Send every due outbox row to the search backend.
+
+        Returns
+            sent (int) -- count of outbox rows applied (or found superseded)
+
+        Notes
+            Stops at the first batch in which nothing could be applied, so that an unreachable elasticsearch costs one request per drain rather than one per batch.
+    """
+    batch_size = batch_size or current_app.config['SEARCH_OUTBOX_BATCH_SIZE']
+    sent = 0
+    while True:
+        batch_sent = drain_batch(batch_size)
+        if not batch_sent:
+            return sent
+        sent += batch_sent
+
+
+class SearchIndexer():
+    """
+    Flask extension running one outbox-draining worker thread per app.
+
+        Notes
+            The worker starts with the app's first request (or the first commit that recorded index updates, if sooner). It drains the outbox when woken by such a commit (see notify()), and otherwise every SEARCH_OUTBOX_POLL_INTERVAL seconds, which picks up rows due for a retry and rows left by other processes. Set SEARCH_OUTBOX_POLL_INTERVAL to 0 to run no worker (the outbox is then drained with `flask search drain`).
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        database = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        if app.search_backend is not None and \
+                database.get_backend_name() != 'sqlite':
+            raise ValueError('search index versions are outbox ids, which '
+                f'are only in commit order on SQLite, not {database.drivername}'
+                ' (see reserve_version())')
+        worker = _Worker(app)
+        app.extensions['search_indexer'] = worker
+        # note: not started here, so that CLI commands (and the master of a
+        # preforking server) don't run a worker
+        app.before_first_request(worker.start)
+
+    def notify(self):
+        """
+        Wake the worker: a transaction with index updates has committed.
+        """
+        current_app.extensions['search_indexer'].notify()
+
+    def drain(self):
+        """
+        Drain the outbox now, in the calling thread. Returns the count of rows sent.
+        """
+        return current_app.extensions['search_indexer'].drain()
+
+
+class _Worker():
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['SEARCH_OUTBOX_POLL_INTERVAL']
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.interval <= 0:
+            return None
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                    name='search-outbox-worker', daemon=True)
+                self.thread.start()
+
+    def notify(self):
+        if self.interval <= 0:
+            return None
+        self.start()
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.drain()
+            except Exception:
+                self.app.logger.exception('search outbox drain failed')
+
+    def drain(self):
+        if has_app_context():
+            return drain()
+        with self.app.app_context():
+            try:
+                return drain()
+            finally:
+                db.session.remove()
+
+
+search_indexer = SearchIndexer()
@@ -0,0 +1,297 @@
+"""
+New posts for open home timelines, pushed as they're committed.
+
+GET /posts/new?since=<post id> (main.new_posts) answers with the posts of the
+viewer's home timeline newer than `since`, newest first:
+    long poll (default) -- one JSON object, {since, ids, html}, sent as soon as there are new posts, or empty after LIVE_POLL_TIMEOUT seconds
+    Server-Sent Events (Accept: text/event-stream) -- a `posts` event with the same object for each batch of new posts, and a heartbeat every LIVE_HEARTBEAT seconds. The stream ends after LIVE_STREAM_SECONDS and the browser's EventSource reconnects, resuming from its Last-Event-ID, with the viewer's current follows.
+`since` in the object (and the events' ids, heartbeats included) is the
+newest post id checked, for the client's next request: it moves past the
+posts of accounts the viewer doesn't follow, so that a reconnecting client
+is served from the hub rather than the db. `html` holds the posts' rendered
+fragments (see app/fragments.py); pass html=0 for ids only.
+
+Waiting requests aren't fed by polling the db: each process keeps a hub of
+the last LIVE_BACKLOG posts committed (as PostRecords), and every commit
+that inserts posts publishes them to the hub (see after_commit()), which
+wakes the waiting requests. A request only queries the db when it connects:
+the ids of the accounts it follows, and, if `since` is older than the hub
+holds, the posts it missed. It then releases its session, so an idle
+connection holds no db connection.
+
+The commits of other processes (e.g., other gunicorn workers) reach the hub
+through the explore buffer's shared mark (EXPLORE_BUFFER_MARK_FILE; see
+app/explore.py): one watcher thread per process reads it every
+LIVE_SYNC_INTERVAL seconds (a memory read) and, when posts were inserted,
+fetches them once for every waiting request.
+
+An idle connection still holds a server worker. With gunicorn's plain sync
+workers that's a whole worker each, so boot.sh gives its sync workers
+GUNICORN_THREADS threads (which makes them gunicorn's threaded gthread
+workers): a connection holds one thread, and the hub's waits block only
+that thread.
+
+Note: `since` assumes ids are assigned in commit order (true of SQLite,
+whose writers are serialized). Deleted posts aren't retracted.
+
+Set LIVE_UPDATES to False to disable it.
+"""
+# python packages
+import json
+import threading
+import time
+from collections import deque
+# flask extensions
+from flask import current_app, has_app_context
+# local modules
+from app import db
+
+
+# milliseconds before an EventSource reconnects to an ended stream
+RETRY_MS = 1000
+
+
+class NotificationHub():
+    """
+    Flask extension holding one hub of recently committed posts per app.
+
+        Notes
+            The watcher thread is started on first use (not in init_app), so that it's not forked along with the app by preloading servers.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['live_hub'] = _Hub(app)
+
+    def _hub(self):
+        return current_app.extensions['live_hub']
+
+    def publish(self, records):
+        """
+        Add newly committed posts (PostRecords) to the hub, and wake the requests waiting for them.
+        """
+        self._hub().publish(records)
+
+    def wait(self, since, author_ids, timeout):
+        """
+        Returns the hub's posts newer than the id `since` by the author ids, newest first, waiting up to timeout seconds for one.
+
+            Returns
+                posts (list) -- PostRecords (empty on timeout), or None if the hub doesn't hold every post newer than `since` (query the db instead)
+                checked (int) -- the newest id checked; with posts None, the oldest id the hub holds every post above (which the db holds too)
+        """
+        return self._hub().wait(since, author_ids, timeout)
+
+    def stats(self):
+        """
+        Returns the hub statistics of this process: posts (published), waiting (requests), wakeups.
+        """
+        return self._hub().stats()
+
+
+class _Hub():
+    def __init__(self, app):
+        self.app = app
+        self.backlog = app.config['LIVE_BACKLOG']
+        self.sync_interval = app.config['LIVE_SYNC_INTERVAL']
+        self.posts = deque() # PostRecords, oldest first
+        self.floor = None # the hub holds every post with a greater id
+        self.counts = {'posts': 0, 'waiting': 0, 'wakeups': 0}
+        self.condition = threading.Condition()
+        self.watcher = None
+
+    def start(self):
+        # the newest id when the hub starts holding posts (under the lock)
+        from app.models import Post
+        if has_app_context():
+            self.floor = db.session.query(db.func.max(Post.id)).scalar() or 0
+        else:
+            with self.app.app_context():
+                try:
+                    self.floor = db.session.query(
+                        db.func.max(Post.id)).scalar() or 0
+                finally:
+                    db.session.remove()
+        mark = self.app.extensions['explore_buffer'].mark
+        if self.sync_interval > 0 and mark is not None and mark.path:
+            self.watcher = threading.Thread(target=self.watch, args=(mark,),
+                name='live-hub-watcher', daemon=True)
+            self.watcher.start()
+
+    def newest(self):
+        return self.posts[-1].id if self.posts else self.floor
+
+    def publish(self, records):
+        with self.condition:
+            if self.floor is None:
+                return None # not started: nobody's waiting
+            added = 0
+            for record in sorted(records, key=lambda record: record.id):
+                if record.id <= self.newest():
+                    continue # published already (e.g., by the watcher)
+                self.posts.append(record)
+                added += 1
+            while len(self.posts) > self.backlog:
+                self.floor = self.posts.popleft().id
+            if added:
+                self.counts['posts'] += added
+                self.counts['wakeups'] += self.counts['waiting']
+                self.condition.notify_all()
+
+    def collect(self, since, author_ids):
+        if since < self.floor:
+            return None
+        found = []
+        for record in reversed(self.posts):
+            if record.id <= since:
+                break
+            if record.author.id in author_ids:
+                found.append(record)
+        return found
+
+    def wait(self, since, author_ids, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            if self.floor is None:
+                self.start()
+            self.counts['waiting'] += 1
+            try:
+                while True:
+                    found = self.collect(since, author_ids)
+                    if found is None:
+                        return None, self.floor
+                    # note: on the next pass, skip what was checked
+                    since = max(since, self.newest())
+                    remaining = deadline - time.monotonic()
+                    if found or remaining <= 0:
+                        return found, since
+                    self.condition.wait(remaining)
+            finally:
+                self.counts['waiting'] -= 1
+
+    def watch(self, mark):
+        from app.models import Post
+        generation = mark.read()[0]
+        while True:
+            time.sleep(self.sync_interval)
+            if mark.read()[0] == generation:
+                continue
+            generation = mark.read()[0]
+            try:
+                with self.app.app_context():
+                    try:
+                        records = Post.query.filter(Post.id > self.newest()). \
+                            records().order_by(Post.id.desc()). \
+                            limit(self.backlog).all()
+                    finally:
+                        db.session.remove()
+                self.publish(records)
+            except Exception:
+                self.app.logger.exception('live hub sync failed')
+
+    def stats(self):
+        with self.condition:
+            return dict(self.counts)
+
+
+def feed_authors(user):
+    """
+    Returns the set of ids of the accounts whose posts are in the user's home timeline: the user and the accounts they follow.
+    """
+    from app.models import followers
+    followed = db.session.execute(db.select([followers.c.followed_id]).
+        where(followers.c.follower_id == user.id))
+    return {user.id} | {row[0] for row in followed}
+
+
+def missed_posts(since, author_ids, limit):
+    """
+    Returns the newest `limit` posts by the author ids newer than the id `since`, newest first, from the db.
+    """
+    from app.models import Post
+    return Post.query.filter(Post.id > since, Post.user_id.in_(author_ids)). \
+        records().order_by(Post.id.desc()).limit(limit).all()
+
+
+def poll(since, author_ids, timeout, limit):
+    """
+    Returns the posts by the author ids newer than the id `since` (the newest `limit`, newest first), waiting up to timeout seconds for one.
+
+        Returns
+            posts (list) -- PostRecords
+            since (int) -- the newest id checked, for the next poll
+
+        Notes
+            Releases the db session before waiting: a waiting request holds no db connection.
+    """
+    posts, checked = live_hub.wait(since, author_ids, 0)
+    if posts is None:
+        posts = missed_posts(since, author_ids, limit)
+    db.session.remove()
+    if not posts and timeout > 0:
+        posts, checked = live_hub.wait(max(since, checked), author_ids, timeout)
+        if posts is None: # fell out of the backlog meanwhile
+            posts = missed_posts(since, author_ids, limit)
+            db.session.remove()
+    posts = posts[:limit]
+    return posts, max([since, checked] + [post.id for post in posts[:1]])
+
+
+def stream(since, author_ids, render, limit):
+    """
+    Yields the Server-Sent Events of the new posts by the author ids: a `posts` event per batch (its id is the newest post id) and heartbeat comments, for LIVE_STREAM_SECONDS.
+    """
+    heartbeat = current_app.config['LIVE_HEARTBEAT']
+    deadline = time.monotonic() + current_app.config['LIVE_STREAM_SECONDS']
+    yield f'retry: {RETRY_MS}\n\n'
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        posts, since = poll(since, author_ids, min(heartbeat, remaining),
+            limit)
+        if posts:
+            yield f'id: {since}\nevent: posts\n' \
+                f'data: {payload(since, posts, render)}\n\n'
+        else:
+            # note: an event without data only updates the Last-Event-ID
+            yield f': heartbeat\nid: {since}\n\n'
+
+
+def payload(since, posts, render):
+    """
+    Returns the JSON of a batch of new posts (newest first) and the poll's since: {since, ids, html}.
+    """
+    return json.dumps({'since': since,
+        'ids': [post.id for post in posts],
+        'html': render(posts) if render and posts else ''},
+        separators=(',', ':'))
+
+
+def after_flush(session, flush_context):
+    """
+    Record the posts inserted by a flush, for after_commit() to publish.
+    """
+    if not current_app.config['LIVE_UPDATES']:
+        return None
+    from app.models import Post
+    from app.records import PostRecord
+    new = session.info.setdefault('live_posts', [])
+    for obj in session.new:
+        if isinstance(obj, Post) and obj.author is not None:
+            new.append(PostRecord.from_model(obj))
+
+
+def after_commit(session):
+    new = session.info.pop('live_posts', None)
+    if new:
+        session.app.extensions['live_hub'].publish(new)
+
+
+def after_rollback(session):
+    session.info.pop('live_posts', None)
+
+
+live_hub = NotificationHub()
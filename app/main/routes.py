@@ -1,38 +1,92 @@
-# python packages
-from datetime import datetime
 # extensions
-from flask import render_template, flash, redirect, url_for, request, current_app, g
+from flask import render_template, flash, redirect, url_for, request, current_app, g, abort, stream_with_context
 from flask_login import current_user, login_required
 from werkzeug.urls import url_parse
 # local modules
-from app import db
+from app import db, last_seen_buffer, live
+from app.conditional import conditional, explore_validator, feed_validator, \
+    profile_validator
+from app.explore import explore_buffer
 from app.models import User, Post
 from app.main import bp
 from app.main.forms import EditProfileForm, PostForm, SearchForm
+from app.pagination import encode_cursor, decode_cursor
+from app.replicas import primary_only
 
 @bp.before_app_request
 def before_request():
     """
     Executes before every request:
-        - Updates user's last seen time to time of request.
+        - Records user's last seen time as time of request. The write is buffered (see app/presence.py) rather than committed here, so page views stay read-only.
         - Stores search form in g. g is a Flask variable that can store data during duration of a request; exposed to templates (don't need to pass in as arg to each render_template() call in each view function).
             - Problem solved: The search form should appear on every page visited by an authenticated user but it would be inefficient to, in every route, create a form object and pass it to the template. So, instead, the solution is to implement the search form in this before_request handler which exposes the search form to g and then have the base.html use g to render the search form.
 
         Side-effects
-            Updates user's last seen time to time of request.
+            Records user's last seen time in the last_seen write-behind buffer.
             Stores search form in g, enabling the base.html template to render the search form on every page.
 
         Returns
             None
     """
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen_buffer.touch(current_user.id, previous=current_user.last_seen)
         g.search_form = SearchForm()
 
+def paginate_posts(posts, endpoint, recent=None, **values):
+    """
+    Returns one page of a post list plus the links to its neighbouring pages.
+    With POST_RECORDS set, the posts are read as PostRecords (see app/records.py): one joined SELECT, no ORM objects. Otherwise, callers pass in queries that eager-load Post.author, so rendering a page (_post.html) issues no per-post author SELECTs.
+
+        Params
+            posts (obj)
+                KeysetQuery (or MergedFeed) of posts, newest first
+            endpoint (str)
+                endpoint the next/prev links point at
+            recent (obj)
+                ExploreBuffer to serve cursor pages from, when it holds them (the query is only run otherwise)
+            values (dict)
+                extra url_for() values for the links (e.g., username)
+
+        Returns
+            items (list) -- posts (or PostRecords) on the page
+            next_url (str) -- link to older posts (None if there are none)
+            prev_url (str) -- link to newer posts (None if there are none)
+
+        Notes
+            Pages are keyed on opaque `after`/`before` cursors (keyset pagination; see app/pagination.py), so deep pages cost the same as the first one. Old `?page=` links still work through OFFSET pagination, without counting the posts (see offset_paginate()).
+    """
+    per_page = current_app.config['POSTS_PER_PAGE']
+    if current_app.config['POST_RECORDS']:
+        posts = posts.records()
+    page = request.args.get('page', type=int)
+    if page is not None:
+        page = max(page, 1)
+        items, has_next = posts.offset_paginate(page, per_page)
+        next_url = url_for(endpoint, page=page + 1, **values) \
+            if has_next else None
+        prev_url = url_for(endpoint, page=page - 1, **values) \
+            if page > 1 else None
+        return items, next_url, prev_url
+    after, before = request.args.get('after'), request.args.get('before')
+    try:
+        posts_page = recent.keyset_paginate(per_page, after, before) \
+            if recent is not None else None
+        if posts_page is None:
+            posts_page = posts.keyset_paginate(per_page, after=after,
+                before=before)
+    except ValueError:
+        abort(400)
+    next_url = url_for(endpoint, after=posts_page.next_cursor, **values) \
+        if posts_page.next_cursor else None
+    prev_url = url_for(endpoint, before=posts_page.prev_cursor, **values) \
+        if posts_page.prev_cursor else None
+    return posts_page.items, next_url, prev_url
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
+@conditional(feed_validator) # 304 if unchanged (see app/conditional.py)
 def index():
     # login form
     form = PostForm()
@@ -44,38 +98,69 @@ def index():
         return redirect(url_for('main.index'))
     
     # posts and pagination
-    page = request.args.get('page', 1, type=int)
-    feed_posts = current_user.feed_posts(). \
-        paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.index',
-        page=feed_posts.next_num if feed_posts.has_next else None)
-    prev_url = url_for('main.index',
-        page=feed_posts.prev_num if feed_posts.has_prev else None)
+    feed_posts, next_url, prev_url = paginate_posts(
+        current_user.feed_posts().options(db.joinedload(Post.author)),
+        'main.index')
     
     response_html = render_template('index.html', title='Home', form=form,
-        posts=feed_posts.items, next_url=next_url, prev_url=prev_url)
+        posts=feed_posts, next_url=next_url, prev_url=prev_url)
     return response_html
         
 
+@bp.route('/posts/new')
+@login_required
+def new_posts():
+    """
+    Returns the posts of the user's home timeline newer than post id `since`, as soon as there are any: as one JSON object (long poll) or as a Server-Sent Events stream (Accept: text/event-stream). See app/live.py.
+    """
+    if not current_app.config['LIVE_UPDATES']:
+        abort(404)
+    # an EventSource reconnecting resumes from the last event it got
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    if since is None:
+        abort(400)
+    author_ids = live.feed_authors(current_user)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    render = None if request.args.get('html') == '0' else \
+        lambda posts: render_template('_new_posts.html', posts=posts)
+    if request.accept_mimetypes.best_match(['application/json',
+            'text/event-stream']) == 'text/event-stream':
+        response = current_app.response_class(stream_with_context(
+            live.stream(since, author_ids, render, per_page)),
+            mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no' # unbuffered by nginx
+        return response
+    posts, since = live.poll(since, author_ids,
+        current_app.config['LIVE_POLL_TIMEOUT'], per_page)
+    response = current_app.response_class(
+        live.payload(since, posts, render), mimetype='application/json')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 @bp.route('/explore')
 @login_required
+@conditional(explore_validator) # 304 if unchanged (see app/conditional.py)
 def explore():
     # posts and pagination
-    page = request.args.get('page', 1, type=int)
-    feed_posts = Post.query.order_by(Post.timestamp.desc()). \
-        paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore',
-        page=feed_posts.next_num if feed_posts.has_next else None)
-    prev_url = url_for('main.explore',
-        page=feed_posts.prev_num if feed_posts.has_prev else None)
+    # note: the first pages come from the in-memory buffer of recent posts
+    # (see app/explore.py), without querying the post table
+    feed_posts, next_url, prev_url = paginate_posts(
+        Post.query.options(db.joinedload(Post.author)). \
+            order_by(Post.timestamp.desc(), Post.id.desc()),
+        'main.explore', recent=explore_buffer)
     
     response_html = render_template('index.html', 
-        title='Explore', posts=feed_posts.items, next_url=next_url, prev_url=prev_url)
+        title='Explore', posts=feed_posts, next_url=next_url, prev_url=prev_url)
     return response_html
 
 
 @bp.route('/user/<username>')
 @login_required
+@conditional(profile_validator) # 304 if unchanged (see app/conditional.py)
 def user(username):
     """
     Returns the user's profile page if the user exists in the db (else returns 404 page).
@@ -83,16 +168,16 @@ def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     
     # posts and pagination
-    page = request.args.get('page', 1, type=int)
-    feed_posts = user.posts.order_by(Post.timestamp.desc()). \
-        paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.user', username=username, 
-        page=feed_posts.next_num if feed_posts.has_next else None)
-    prev_url = url_for('main.user', username=username, 
-        page=feed_posts.prev_num if feed_posts.has_prev else None)
+    feed_posts, next_url, prev_url = paginate_posts(
+        user.posts.order_by(Post.timestamp.desc(), Post.id.desc()), 'main.user',
+        username=username)
+    
+    # show a pending (not yet flushed) last_seen if there is one
+    last_seen = last_seen_buffer.get(user.id) or user.last_seen
     
     response_html = render_template('user.html', user=user,
-        posts=feed_posts.items, next_url=next_url, prev_url=prev_url)
+        last_seen=last_seen, posts=feed_posts, next_url=next_url,
+        prev_url=prev_url)
     return response_html
 
 
@@ -118,6 +203,7 @@ def edit_profile():
 # route for follow
 @bp.route('/follow/<username>')
 @login_required
+@primary_only # writes on GET
 def follow(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
@@ -137,6 +223,7 @@ def follow(username):
 # route for unfollow
 @bp.route('/unfollow/<username>')
 @login_required
+@primary_only # writes on GET
 def unfollow(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
@@ -182,10 +269,24 @@ def search():
     page = request.args.get('page', 1, type=int)
     # get page arg from request (e.g., /search?q=search_query_here&page=2)
     # if no page arg passed, default to 1
-    posts, total = Post.search(g.search_form.q.data, page,
-        current_app.config['POSTS_PER_PAGE'])
+    try:
+        search_after = request.args.get('after')
+        search_after = decode_cursor(search_after) if search_after else None
+    except ValueError:
+        abort(400)
+    # get the opaque search_after cursor of the previous page, if any: with
+    # it, elasticsearch continues from the last hit instead of skipping
+    # (page - 1) * per_page hits
+    # the posts are records built from the hits' stored fields (the db is
+    # only queried for hits indexed without them)
+    posts, total, next_search_after = Post.search_records(
+        g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'],
+        search_after)
     # perform elasticsearch given the search form stored in g, the page to be returned, and the posts_per_page configuration
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
+    next_cursor = encode_cursor(next_search_after) \
+        if next_search_after else None
+    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1,
+        after=next_cursor) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
         if page > 1 else None
@@ -0,0 +1,307 @@
+"""
+Per-request instrumentation, exported in the Prometheus text format.
+
+When METRICS_ENABLED is set, every request records, by endpoint:
+    - its latency (a histogram with fixed buckets)
+    - the count and time of its SQL statements, by database (SQLAlchemy
+      engine events on the primary, each read replica and the SQLite write
+      queue)
+    - the time spent rendering templates (Flask template signals)
+    - the time spent in the search backend (see app/search.query_index())
+and the totals are served at METRICS_PATH (default /metrics). Requests
+slower than METRICS_SLOW_REQUEST_MS are logged with their SQL broken down
+by statement.
+
+Each request accumulates into its own RequestStats (in `g`, so no locking),
+which is merged into the process-wide totals under one lock acquisition
+when the request ends; per statement, the overhead is two perf_counter()
+calls and a dict update. The totals are per process: under gunicorn, each
+worker reports its own.
+"""
+# python packages
+import threading
+import time
+from bisect import bisect_left
+# flask extensions
+from flask import Response, current_app, g, has_app_context, request
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+
+# request latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# statements listed by the slow request log
+SLOW_LOG_STATEMENTS = 5
+
+
+class RequestStats():
+    """
+    Counters of the request being served.
+    """
+    __slots__ = ('start', 'status', 'sql_count', 'sql_time', 'sql_binds',
+        'statements', 'template_time', 'template_starts', 'search_time')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.status = 500 # until after_request says otherwise
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.sql_binds = {} # bind -> [count, seconds]
+        self.statements = {} # SQL text -> [count, seconds]
+        self.template_time = 0.0
+        self.template_starts = []
+        self.search_time = 0.0
+
+
+def current_stats():
+    """
+    Returns the RequestStats of the request being served, or None (metrics disabled, or outside of a request).
+    """
+    return g.get('_request_stats') if has_app_context() else None
+
+
+def record_search_time(seconds):
+    """
+    Add time spent in the search backend to the current request.
+    """
+    stats = current_stats()
+    if stats is not None:
+        stats.search_time += seconds
+
+
+class Metrics():
+    """
+    Flask extension holding the request metrics of an app.
+
+        Notes
+            Does nothing unless METRICS_ENABLED is set.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['METRICS_ENABLED']:
+            return None
+        registry = _Registry()
+        app.extensions['metrics'] = registry
+        app.before_request(start_request)
+        app.after_request(record_status)
+        app.teardown_request(end_request)
+        for bind, engine in engines(app).items():
+            event.listen(engine, 'before_cursor_execute',
+                before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute',
+                after_cursor_execute(bind))
+        before_render_template.connect(before_render, app)
+        template_rendered.connect(after_render, app)
+        app.add_url_rule(app.config['METRICS_PATH'], 'metrics', export)
+
+    def snapshot(self):
+        """
+        Returns a copy of the totals: {endpoint: {'requests': {status: count}, 'buckets': [...], 'latency': seconds, 'sql_count': n, 'sql_time': seconds, 'sql_binds': {bind: [n, seconds]}, 'template_time': seconds, 'search_time': seconds}}.
+        """
+        return current_app.extensions['metrics'].snapshot()
+
+
+def engines(app):
+    """
+    Returns the app's database engines by bind: 'primary', the read replicas' binds (see app/replicas.py) and 'writer', the SQLite write queue's (see app/sqlitedb.py).
+    """
+    from app import db
+    binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or {})
+    engines = {bind or 'primary': db.get_engine(app, bind=bind)
+        for bind in binds}
+    writer = app.extensions.get('sqlite_writer')
+    if writer is not None:
+        engines['writer'] = writer.engine
+    return engines
+
+
+class _Registry():
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def observe(self, endpoint, stats, elapsed):
+        with self.lock:
+            totals = self.endpoints.get(endpoint)
+            if totals is None:
+                totals = self.endpoints[endpoint] = {'requests': {},
+                    'buckets': [0] * len(BUCKETS), 'latency': 0.0,
+                    'sql_count': 0, 'sql_time': 0.0, 'sql_binds': {},
+                    'template_time': 0.0, 'search_time': 0.0}
+            requests = totals['requests']
+            requests[stats.status] = requests.get(stats.status, 0) + 1
+            bucket = bisect_left(BUCKETS, elapsed)
+            if bucket < len(BUCKETS):
+                totals['buckets'][bucket] += 1
+            totals['latency'] += elapsed
+            totals['sql_count'] += stats.sql_count
+            totals['sql_time'] += stats.sql_time
+            for bind, (count, seconds) in stats.sql_binds.items():
+                bind_totals = totals['sql_binds'].setdefault(bind, [0, 0.0])
+                bind_totals[0] += count
+                bind_totals[1] += seconds
+            totals['template_time'] += stats.template_time
+            totals['search_time'] += stats.search_time
+
+    def snapshot(self):
+        with self.lock:
+            return {endpoint: dict(totals, requests=dict(totals['requests']),
+                buckets=list(totals['buckets']), sql_binds={bind: list(values)
+                    for bind, values in totals['sql_binds'].items()})
+                for endpoint, totals in self.endpoints.items()}
+
+
+def start_request():
+    g._request_stats = RequestStats()
+
+
+def record_status(response):
+    stats = current_stats()
+    if stats is not None:
+        stats.status = response.status_code
+    return response
+
+
+def end_request(exception):
+    stats = g.pop('_request_stats', None)
+    if stats is None:
+        return None
+    elapsed = time.perf_counter() - stats.start
+    endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+    current_app.extensions['metrics'].observe(endpoint, stats, elapsed)
+    slow_ms = current_app.config['METRICS_SLOW_REQUEST_MS']
+    if slow_ms and elapsed * 1000 >= slow_ms:
+        log_slow_request(endpoint, stats, elapsed)
+
+
+def log_slow_request(endpoint, stats, elapsed):
+    statements = sorted(stats.statements.items(),
+        key=lambda item: item[1][1], reverse=True)[:SLOW_LOG_STATEMENTS]
+    breakdown = ''.join(f'\n    {count}x {seconds * 1000:.1f} ms: '
+        f"{' '.join(statement.split())[:200]}"
+        for statement, (count, seconds) in statements)
+    current_app.logger.warning(
+        f'slow request: {request.method} {request.full_path} ({endpoint}) '
+        f'{stats.status} in {elapsed * 1000:.1f} ms; sql: {stats.sql_count} '
+        f'statements in {stats.sql_time * 1000:.1f} ms; templates: '
+        f'{stats.template_time * 1000:.1f} ms; search: '
+        f'{stats.search_time * 1000:.1f} ms{breakdown}')
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+        executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(bind):
+    """
+    Returns the after_cursor_execute listener of the bind's engine.
+    """
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        stats = current_stats()
+        starts = conn.info.get('query_start')
+        if stats is None or not starts:
+            return None
+        seconds = time.perf_counter() - starts.pop()
+        stats.sql_count += 1
+        stats.sql_time += seconds
+        bind_totals = stats.sql_binds.get(bind)
+        if bind_totals is None:
+            stats.sql_binds[bind] = [1, seconds]
+        else:
+            bind_totals[0] += 1
+            bind_totals[1] += seconds
+        totals = stats.statements.get(statement)
+        if totals is None:
+            stats.statements[statement] = [1, seconds]
+        else:
+            totals[0] += 1
+            totals[1] += seconds
+    return listener
+
+
+def before_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        stats.template_starts.append(time.perf_counter())
+
+
+def after_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats.template_starts:
+        start = stats.template_starts.pop()
+        if not stats.template_starts: # nested renders are already counted
+            stats.template_time += time.perf_counter() - start
+
+
+def export():
+    """
+    Returns the metrics in the Prometheus text exposition format.
+    """
+    from app.live import live_hub
+    from app.searchcache import search_cache
+    from app.usercache import user_cache
+    endpoints = current_app.extensions['metrics'].snapshot()
+    lines = []
+
+    def family(name, kind, help):
+        lines.append(f'# HELP minitwitter_{name} {help}')
+        lines.append(f'# TYPE minitwitter_{name} {kind}')
+
+    family('requests_total', 'counter', 'Requests served, by endpoint and status.')
+    for endpoint, totals in sorted(endpoints.items()):
+        for status, count in sorted(totals['requests'].items()):
+            lines.append(f'minitwitter_requests_total{{endpoint="{endpoint}",'
+                f'status="{status}"}} {count}')
+    family('request_duration_seconds', 'histogram', 'Request latency.')
+    for endpoint, totals in sorted(endpoints.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, totals['buckets']):
+            cumulative += count
+            lines.append(f'minitwitter_request_duration_seconds_bucket'
+                f'{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+        count = sum(totals['requests'].values())
+        lines.append(f'minitwitter_request_duration_seconds_bucket'
+            f'{{endpoint="{endpoint}",le="+Inf"}} {count}')
+        lines.append(f'minitwitter_request_duration_seconds_sum'
+            f'{{endpoint="{endpoint}"}} {totals["latency"]:.6f}')
+        lines.append(f'minitwitter_request_duration_seconds_count'
+            f'{{endpoint="{endpoint}"}} {count}')
+    for name, position, help in (
+            ('sql_statements_total', 0, 'SQL statements executed.'),
+            ('sql_seconds_total', 1, 'Time spent executing SQL.')):
+        family(name, 'counter', help + ' By endpoint and database bind.')
+        for endpoint, totals in sorted(endpoints.items()):
+            for bind, values in sorted(totals['sql_binds'].items()):
+                value = values[position]
+                value = f'{value:.6f}' if isinstance(value, float) else value
+                lines.append(f'minitwitter_{name}{{endpoint="{endpoint}",'
+                    f'bind="{bind}"}} {value}')
+    for name, key, help in (
+            ('template_seconds_total', 'template_time',
+                'Time spent rendering templates.'),
+            ('search_seconds_total', 'search_time',
+                'Time spent in the search backend.')):
+        family(name, 'counter', help + ' By endpoint.')
+        for endpoint, totals in sorted(endpoints.items()):
+            value = totals[key]
+            value = f'{value:.6f}' if isinstance(value, float) else value
+            lines.append(f'minitwitter_{name}{{endpoint="{endpoint}"}} {value}')
+    for prefix, title, cache in (('search_cache', 'Search result cache',
+            search_cache), ('user_cache', 'User cache', user_cache)):
+        for name, value in sorted(cache.stats().items()):
+            kind = 'gauge' if name == 'size' else 'counter'
+            metric = f'{prefix}_{name}' + ('' if kind == 'gauge' else '_total')
+            family(metric, kind, f'{title} {name} (this process).')
+            lines.append(f'minitwitter_{metric} {value}')
+    for name, value in sorted(live_hub.stats().items()):
+        kind = 'gauge' if name == 'waiting' else 'counter'
+        metric = f'live_{name}' + ('' if kind == 'gauge' else '_total')
+        family(metric, kind, f'Live updates {name} (this process).')
+        lines.append(f'minitwitter_{metric} {value}')
+    return Response('\n'.join(lines) + '\n',
+        mimetype='text/plain; version=0.0.4')
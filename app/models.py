@@ -2,20 +2,32 @@
 from datetime import datetime
 from hashlib import md5
 # extensions
+from flask import current_app
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 # local modules
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app.hashing import password_hasher
+from app.search import bulk_update, make_payload, query_index
+from app import timeline
+from app import explore, indexer, live, reindex, replicas, sqlitedb, \
+    usercache
+from app.pagination import KeysetQuery
+from app.records import PostRecord, gravatar_url, post_records
+from app.usercache import user_cache
 
 class SearchableMixin():
     """
     Notes
         @classmethod -- defines a method only used for class objects (and not a specific instance of a class)
         cls -- renaming of the `self` keyword to clarify that the method receives a class and not a class instance
+        __searchable__ -- fields that are indexed (searched)
+        __stored__ -- fields that are stored with each document and returned with its hits, but not searched; 'relationship.field' names a field of a related object (e.g., 'author.username')
+        __record__ -- class of the records that search_records() builds from the stored fields
     """
+    __stored__ = []
+
     @classmethod
-    def search(cls, expression, page, per_page):
+    def search(cls, expression, page, per_page, search_after=None):
         """
         Returns search results as list of models (rather than model IDs). Does this by wrapping the app/search.query_index() function and replacing the object IDs with models.
 
@@ -24,39 +36,198 @@ class SearchableMixin():
                 expression
                 page
                 per_page
+                search_after -- sort values of the previous page's last hit (see app/search.query_index())
+
+            Returns
+                hits_objects_list -- query of the hits' models, in hit order
+                hits_count -- total count of hits
+                last_sort -- `search_after` value for the next page
 
             Notes
                 To order the objects in hits_objects_list by object ID (elasticsearch orders results by importance), the SQL query needs to include a CASE WHEN statement in the ORDERY BY statement to order by the object's ID (the CASE WHEN provides this mapping)
         """
-        ids, hits_count = query_index(cls.__tablename__, expression, page, per_page)
-        if hits_count == 0:
-            return cls.query.filter_by(id=0), 0
+        ids, hits_count, last_sort, _ = query_index(cls.__tablename__,
+            expression, page, per_page, search_after, cls.__searchable__)
+        if hits_count == 0 or not ids:
+            return cls.query.filter_by(id=0), hits_count, None
         when_clause = []
         for i in range(len(ids)):
             when_clause.append((ids[i], i))
         hits_objects_list = cls.query.filter(cls.id.in_(ids)). \
             order_by(db.case(when_clause, value=cls.id))
-        return hits_objects_list, hits_count
-            
+        return hits_objects_list, hits_count, last_sort
 
     @classmethod
-    def before_commit(cls, session):
+    def search_records(cls, expression, page, per_page, search_after=None):
         """
-        Store session data before commit to enable using this information to update the elasticsearch index.
+        Returns search results as __record__ objects, built from the hits' stored fields where possible.
 
             Params
+                expression, page, per_page, search_after -- see search()
+
+            Returns
+                records (list) -- __record__ objects, in hit order
+                hits_count -- total count of hits
+                last_sort -- `search_after` value for the next page
+
+            Notes
+                Hits without stored fields (e.g., documents indexed before __stored__ was declared) are looked up in the record cache (see app/records.py), then loaded from the db with a single query. Since hits aren't checked against the db, a post deleted moments ago is listed until its deletion reaches the index.
+        """
+        ids, hits_count, last_sort, stored = query_index(cls.__tablename__,
+            expression, page, per_page, search_after, cls.__searchable__)
+        records = {id: cls.__record__.from_stored(id, stored[id])
+            for id in ids if id in stored}
+        missing = [id for id in ids if id not in records]
+        if missing:
+            records.update(post_records.get_many(missing))
+            missing = [id for id in missing if id not in records]
+        if missing:
+            loaded = cls.load_records(missing)
+            post_records.put_many(loaded)
+            records.update((record.id, record) for record in loaded)
+        return [records[id] for id in ids if id in records], hits_count, \
+            last_sort
+
+    @classmethod
+    def load_records(cls, ids):
+        """
+        Returns the __record__ objects of the ids (in no particular order), loaded from the db with a single query.
+        """
+        query = cls.query.filter(cls.id.in_(ids))
+        for relationship in cls.stored_relationships():
+            query = query.options(db.joinedload(getattr(cls, relationship)))
+        return [cls.__record__.from_model(obj) for obj in query]
+
+    @classmethod
+    def stored_relationships(cls):
+        """
+        Returns the names of the relationships that __stored__ fields go through, in order.
+        """
+        relationships = []
+        for field in cls.__stored__:
+            if '.' in field and field.split('.')[0] not in relationships:
+                relationships.append(field.split('.')[0])
+        return relationships
+
+    @classmethod
+    def search_rows(cls):
+        """
+        Returns a query of (id, *values of the __searchable__ then __stored__ fields) rows, the columns make_payload() takes (see app/search.py).
+
+            Notes
+                Related objects' fields come from outer joins, so indexing needs neither ORM objects nor lazy loads.
+        """
+        query = db.session.query(cls.id)
+        for relationship in cls.stored_relationships():
+            query = query.outerjoin(getattr(cls, relationship))
+        for field in cls.__searchable__ + cls.__stored__:
+            if '.' in field:
+                relationship, attribute = field.split('.', 1)
+                related = getattr(cls, relationship).property.mapper.class_
+                query = query.add_columns(getattr(related, attribute))
+            else:
+                query = query.add_columns(getattr(cls, field))
+        return query
+
+    @classmethod
+    def stale_documents(cls, obj):
+        """
+        Returns a SELECT of the ids of the documents whose stored fields include a changed field of `obj`, a related object (None if there are none).
+        """
+        for field in cls.__stored__:
+            if '.' not in field:
+                continue
+            relationship, attribute = field.split('.', 1)
+            prop = getattr(cls, relationship).property
+            if not isinstance(obj, prop.mapper.class_):
+                continue
+            if db.inspect(obj).attrs[attribute].history.has_changes():
+                (column,) = prop.local_columns
+                return db.select([cls.id]).where(column == obj.id)
+        return None
+
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        """
+        Record the index updates made by a flush in the search outbox, in the flush's transaction ('outbox' SEARCH_INDEXING mode), or in session.info for after_commit() to send ('sync' mode).
+
+            Params
+                cls (obj)
+                session (obj)
+                    SQLAlchemy session. Its new/dirty/deleted collections (and attribute histories) still hold their pre-flush contents at this point.
+                flush_context (obj)
 
             Side-Effects
-                session._changes (dict) -- create dicti 
+                search_outbox table
+                    One row inserted per new, deleted, or updated (in a __searchable__ or __stored__ field) object, and per document whose stored fields include a changed field of a related object (e.g., all of a user's posts when the user's username changes).
+                session.info
+                    'search_evict': ids of the posts and authors whose cached records after_commit() evicts; 'search_sync': in 'sync' mode, the documents after_commit() sends instead (by (index, id); None for deletions), and 'search_sync_version' the version they're sent with (see indexer.reserve_version()).
 
             Returns
                 None
+
+            Notes
+                after_flush is used rather than before_commit because new objects only have ids once flushed, and because objects that are autoflushed before the commit are no longer in session.new by then (before_commit never sees them).
+        """
+        post_ids, author_ids = session.info.setdefault('search_evict',
+            (set(), set()))
+        changes, stale = [], []
+        for obj in session.new:
+            if isinstance(obj, SearchableMixin):
+                changes.append((obj.__tablename__, obj.id, 'index'))
+        for obj in session.dirty:
+            if isinstance(obj, SearchableMixin):
+                if obj.search_fields_changed():
+                    changes.append((obj.__tablename__, obj.id, 'index'))
+                    post_ids.add(obj.id)
+                continue
+            for index, model in indexer.searchable_models().items():
+                ids = model.stale_documents(obj)
+                if ids is not None:
+                    stale.append((index, ids))
+                    author_ids.add(obj.id)
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                changes.append((obj.__tablename__, obj.id, 'delete'))
+                post_ids.add(obj.id)
+        if current_app.search_backend is None:
+            return None
+        if not indexer.outbox_enabled():
+            # 'sync' mode: the documents are read now, as after_commit() can
+            # no longer query the db (its transaction is over)
+            pending = session.info.setdefault('search_sync', {})
+            models = indexer.searchable_models()
+            for index, id, op in changes:
+                pending[(index, id)] = None
+            for index, model in models.items():
+                ids = [id for (pending_index, id), payload in pending.items()
+                    if pending_index == index and payload is None]
+                filters = [model.id.in_(ids)] if ids else []
+                filters.extend(model.id.in_(select) for stale_index, select
+                    in stale if stale_index == index)
+                if filters:
+                    for row in model.search_rows().filter(db.or_(*filters)):
+                        pending[(index, row[0])] = make_payload(model, row[1:])
+            if pending:
+                # note: a version per flush; the transaction's last one is
+                # newer than every document it read
+                session.info['search_sync_version'] = \
+                    indexer.reserve_version(session)
+            return None
+        if changes:
+            indexer.enqueue(session, changes)
+        for index, ids in stale:
+            indexer.enqueue_select(session, index, ids)
+
+    def search_fields_changed(self):
+        """
+        Returns True if any of the object's __searchable__ or (own) __stored__ fields has a pending change.
         """
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+        state = db.inspect(self)
+        return any(state.attrs[field].history.has_changes()
+            for field in self.__searchable__ + self.__stored__
+            if '.' not in field)
 
     @classmethod
     def after_commit(cls, session):
@@ -70,56 +241,119 @@ class SearchableMixin():
                     SQLAlchemy session object. Records changes intended to be made to the db.
 
             Side-Effects
-                Elasticsearch object attached to app
-                    Mutated to mirror changes made to the db during the session.
-                session._changes
-                    Set to None
+                Search backend attached to app
+                    Mutated to mirror changes made to the db during the session (with a single bulk request).
 
             Returns
                 None
+
+            Notes
+                In 'outbox' SEARCH_INDEXING mode, the updates were recorded in the search outbox by after_flush(); this only wakes the outbox worker.
+                Either way, the cached records of the posts (and authors) changed by the transaction are evicted.
         """
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        post_ids, author_ids = session.info.pop('search_evict', ((), ()))
+        if post_ids or author_ids:
+            post_records.evict(post_ids, author_ids)
+        if indexer.outbox_enabled():
+            if session.info.pop('search_outbox', False):
+                indexer.search_indexer.notify()
+            return None
+        pending = session.info.pop('search_sync', {})
+        version = session.info.pop('search_sync_version', None)
+        if pending and current_app.search_backend:
+            bulk_update([('index' if payload is not None else 'delete', index,
+                id, version, payload)
+                for (index, id), payload in pending.items()])
 
 
     @classmethod
-    def reindex(cls):
+    def reindex(cls, **options):
         """
         Initialize the index from all the records in the table.
             
             Params
                 cls (obj)
                     Emphasizing this method receives a class object rather than an instance of a class object, the latter of which is typical and which is denoted using the `self` keyword.
+                options
+                    chunk_size, workers, new_index, restart, progress (see app/reindex.reindex())
 
             Side-effects
                 cls (obj)
                     Re-initializes the index given all the records of the class in the database.
 
             Returns
-                None
+                ReindexResult -- count of documents indexed, time taken, etc.
+
+            Notes
+                Streams the table in id-ordered chunks, sent as parallel bulk requests, and checkpoints its progress: an interrupted reindex resumes where it stopped (see app/reindex.py).
         """
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+        return reindex.reindex(cls, **options)
+
+
+def update_post_counts(session, flush_context):
+    """
+    Keep User.posts_count in step with the posts inserted/deleted by a flush.
+
+        Notes
+            Runs in after_flush (the posts' user_ids are only set once they're flushed) and issues relative UPDATEs (SET posts_count = posts_count + n) in the same transaction as the posts. Authors loaded in the session have their posts_count expired so that it's reloaded.
+    """
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, Post):
+            deltas[obj.user_id] = deltas.get(obj.user_id, 0) + 1
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            deltas[obj.user_id] = deltas.get(obj.user_id, 0) - 1
+    for user_id, delta in deltas.items():
+        if user_id is None or delta == 0:
+            continue
+        session.execute(User.__table__.update().
+            where(User.id == user_id).
+            values(posts_count=User.posts_count + delta))
+        author = session.identity_map.get(
+            db.inspect(User).identity_key_from_primary_key([user_id]))
+        if author is not None:
+            session.expire(author, ['posts_count'])
 
 
 # Event listeners
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+# note: first, so that the other after_commit handlers run once the write
+# queue's group commit is done (see app/sqlitedb.py)
+db.event.listen(db.session, 'after_commit', sqlitedb.after_commit)
+db.event.listen(db.session, 'after_transaction_end',
+    sqlitedb.after_transaction_end)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
+db.event.listen(db.session, 'after_rollback', indexer.after_rollback)
+db.event.listen(db.session, 'before_flush', timeline.before_flush)
+db.event.listen(db.session, 'after_flush', update_post_counts)
+db.event.listen(db.session, 'after_flush', timeline.after_flush)
+db.event.listen(db.session, 'after_flush', explore.after_flush)
+db.event.listen(db.session, 'after_commit', explore.after_commit)
+db.event.listen(db.session, 'after_rollback', explore.after_rollback)
+db.event.listen(db.session, 'after_flush', replicas.after_flush)
+db.event.listen(db.session, 'after_commit', replicas.after_commit)
+db.event.listen(db.session, 'after_rollback', replicas.after_rollback)
+db.event.listen(db.session, 'after_flush', usercache.after_flush)
+db.event.listen(db.session, 'after_commit', usercache.after_commit)
+db.event.listen(db.session, 'after_rollback', usercache.after_rollback)
+db.event.listen(db.session, 'after_flush', live.after_flush)
+db.event.listen(db.session, 'after_commit', live.after_commit)
+db.event.listen(db.session, 'after_rollback', live.after_rollback)
 
 
 # Association table
+# note: the unique (follower_id, followed_id) index serves is_following()
+# and the 'followed' side of the relationship (and rules out duplicate
+# follows); the (followed_id, follower_id) index serves the 'followers' side.
 followers = db.Table(
     'followers',
     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')))
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+    db.Index('ix_followers_follower_id_followed_id',
+        'follower_id', 'followed_id', unique=True),
+    db.Index('ix_followers_followed_id_follower_id',
+        'followed_id', 'follower_id'))
 
 
 # Users table
@@ -131,9 +365,26 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(128))
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    is_celebrity = db.Column(db.Boolean, default=False,
+        server_default=db.false())
+    # MD5 of the lowercased email, for Gravatar; kept in step with email
+    avatar_digest = db.Column(db.String(32))
+    # bumped whenever the username or avatar changes; keys the cached
+    # fragments of the user's posts (see app/fragments.py)
+    profile_version = db.Column(db.Integer, default=0, server_default='0')
+    # bumped by follow()/unfollow(); versions the user's home timeline in
+    # its ETag (see app/conditional.py)
+    follow_version = db.Column(db.Integer, default=0, server_default='0')
+    # denormalized counters; maintained by follow()/unfollow() and on post
+    # inserts/deletes (see update_post_counts()); repaired by
+    # repair_counters() (`flask counters repair`)
+    followers_count = db.Column(db.Integer, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, default=0, server_default='0')
+    posts_count = db.Column(db.Integer, default=0, server_default='0')
 
     # relationships
-    posts = db.relationship('Post', backref='author', lazy='dynamic')
+    posts = db.relationship('Post', backref='author', lazy='dynamic',
+        query_class=KeysetQuery)
     followed = db.relationship(
         'User',
         secondary=followers,
@@ -156,30 +407,77 @@ class User(UserMixin, db.Model):
         return username_and_id
 
     # set user's password
+    # note: hashed in the password hashing pool (see app/hashing.py)
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     # check user's password
     def check_password(self, password):
-        password_is_correct = check_password_hash(self.password_hash, password)
+        password_is_correct = password_hasher.check(self.password_hash,
+            password)
         return password_is_correct
 
+    @staticmethod
+    def make_avatar_digest(email):
+        return md5(email.lower().encode('utf-8')).hexdigest()
+
+    @db.validates('email')
+    def validate_email(self, key, email):
+        # precompute the Gravatar digest whenever the email is set, so that
+        # rendering avatars needs no hashing
+        avatar_digest = self.make_avatar_digest(email) if email else None
+        if self.avatar_digest is not None and \
+                avatar_digest != self.avatar_digest:
+            self.bump_profile_version()
+        self.avatar_digest = avatar_digest
+        return email
+
+    @db.validates('username')
+    def validate_username(self, key, username):
+        if self.username is not None and username != self.username:
+            self.bump_profile_version()
+        return username
+
+    # note: a SQL expression (SET profile_version = profile_version + 1),
+    # like the follow counters: the loaded value may be stale (e.g., from
+    # the user cache), and a read-modify-write on it could leave the version
+    # where another process already moved it.
+    def bump_profile_version(self):
+        self.profile_version = User.profile_version + 1
+
     def get_avatar_image(self, size=70, default='identicon'):
         """
-        Returns an avatar image for the user. Uses the Gravatar service which returns a unique avatar for each user by using a MD5 hash of their email address.
+        Returns an avatar image for the user. Uses the Gravatar service which returns a unique avatar for each user by using a MD5 hash of their email address (precomputed in avatar_digest).
         """
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        gravatar_avatar_url = f"https://www.gravatar.com/avatar/{digest}?d={default}&s={size}"
+        digest = self.avatar_digest or self.make_avatar_digest(self.email)
+        gravatar_avatar_url = gravatar_url(digest, size, default)
         return gravatar_avatar_url
 
     # follow logic
+    # note: the counters are bumped with SQL expressions (SET n = n + 1)
+    # rather than read-modify-write, so concurrent follows can't lose
+    # updates; the attributes reload from the db after the flush.
+    # note: with materialized timelines ('fanout'/'hybrid' TIMELINE_MODE),
+    # following backfills the followed user's existing posts into this
+    # user's timeline and unfollowing evicts them. is_following()
+    # autoflushes, so both users have ids by then.
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.followed_count = User.followed_count + 1
+            self.follow_version = User.follow_version + 1
+            user.followers_count = User.followers_count + 1
+            if timeline.fanout_enabled():
+                timeline.follow(db.session, self, user)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.followed_count = User.followed_count - 1
+            self.follow_version = User.follow_version + 1
+            user.followers_count = User.followers_count - 1
+            if timeline.fanout_enabled():
+                timeline.unfollow(db.session, self, user)
 
     def is_following(self, user):
         # check association table ('followers') for self following user
@@ -188,33 +486,77 @@ class User(UserMixin, db.Model):
             ).count() > 0
     
     def feed_posts(self):
-        # all posts from all users who are followed
+        # 'fanout'/'hybrid' modes: read the precomputed timeline
+        if timeline.fanout_enabled():
+            return timeline.feed(self)
+        # 'query' mode: all posts from all users who are followed
         # filter to posts where the user is followed by self
         followed_posts = Post.query. \
             join(followers, (followers.c.followed_id == Post.user_id)). \
                 filter(followers.c.follower_id == self.id)
         own_posts = Post.query.filter_by(user_id=self.id)
         feed_posts = followed_posts.union(own_posts) \
-            .order_by(Post.timestamp.desc())
+            .order_by(Post.timestamp.desc(), Post.id.desc())
         return feed_posts
 
 
+    @classmethod
+    def repair_counters(cls):
+        """
+        Recompute every user's follower/following/post counters from the followers and post tables, in one UPDATE.
+
+            Returns
+                count (int) -- number of users whose counters had drifted
+        """
+        followers_count = db.select([db.func.count()]). \
+            where(followers.c.followed_id == cls.id).as_scalar()
+        followed_count = db.select([db.func.count()]). \
+            where(followers.c.follower_id == cls.id).as_scalar()
+        posts_count = db.select([db.func.count()]). \
+            where(Post.user_id == cls.id).as_scalar()
+        result = db.session.execute(cls.__table__.update().
+            where(db.or_(
+                db.func.coalesce(cls.followers_count, -1) != followers_count,
+                db.func.coalesce(cls.followed_count, -1) != followed_count,
+                db.func.coalesce(cls.posts_count, -1) != posts_count)).
+            values(followers_count=followers_count,
+                followed_count=followed_count,
+                posts_count=posts_count))
+        return result.rowcount
+
+
 # enable the login object to access a User record when it calls its 
 # user_loader method on a stringified version of a user_id. do this
 # by decorating a method on the User table.
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    # note: usually without a query (see app/usercache.py)
+    return user_cache.load(int(id))
     
 
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
+    # everything _post.html renders, so search results need no db query
+    __stored__ = ['body', 'timestamp', 'user_id', 'author.username',
+        'author.avatar_digest', 'author.profile_version']
+    __record__ = PostRecord
+    query_class = KeysetQuery
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+    # (user_id, timestamp) serves profile pages and the feed's per-author
+    # lookups, already in timestamp order
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),)
+
     def __repr__(self):
         post_user_and_body = f"user: {self.user_id}; post: {self.body}"
         return post_user_and_body
 
+    @classmethod
+    def load_records(cls, ids):
+        # as joined rows, without Post/User objects (see app/pagination.py)
+        return cls.query.filter(cls.id.in_(ids)).records().all()
+
@@ -0,0 +1,190 @@
+"""
+Keyset (cursor) pagination.
+
+Post lists are ordered newest-first by (timestamp, id). Rather than OFFSET
+scans, which get slower the deeper the page, each page is fetched with a
+range condition on that key relative to an opaque cursor (the key of the
+last/first post on the neighbouring page), so every page is an index range
+scan of per_page + 1 rows.
+
+Post lists can also be read as PostRecords (KeysetQuery.records()): the
+posts' and their authors' columns in one joined SELECT, executed as a Core
+statement, so rendering a page builds no Post/User objects and fills no
+identity map.
+"""
+# python packages
+import base64
+import json
+from datetime import datetime
+# flask extensions
+from flask_sqlalchemy import BaseQuery
+# local modules
+from app import db
+from app.records import PostRecord
+
+
+def encode_cursor(values):
+    """
+    Returns an opaque, URL-safe cursor for a list of JSON-serializable (or datetime) sort key values.
+    """
+    values = [{'ts': value.isoformat()} if isinstance(value, datetime) else value
+        for value in values]
+    payload = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the list of sort key values encoded by encode_cursor().
+
+        Raises
+            ValueError -- if the cursor is malformed
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+        return [datetime.fromisoformat(value['ts']) if isinstance(value, dict)
+            else value for value in values]
+    except (TypeError, ValueError, KeyError) as error:
+        raise ValueError(f'invalid cursor: {cursor!r}') from error
+
+
+def post_key(post):
+    # every post list is ordered by (timestamp, id), newest first
+    return (post.timestamp, post.id)
+
+
+class KeysetPage():
+    """
+    One page of a keyset-paginated post list.
+
+        Attributes
+            items (list) -- posts on the page, newest first
+            next_cursor (str) -- cursor for the page of older posts (None if there is none)
+            prev_cursor (str) -- cursor for the page of newer posts (None if there is none)
+    """
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def make_page(rows, per_page, after=None, before=None):
+    """
+    Build a KeysetPage from the per_page + 1 rows fetched past the cursor.
+
+        Params
+            rows (list)
+                Posts fetched for the page: newest-first when paging forward (`after`, or first page), oldest-first when paging backward (`before`). One extra row signals that another page exists in that direction.
+            per_page (int)
+            after, before (str)
+                The cursor the rows were fetched with (at most one of them).
+    """
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before is not None:
+        rows.reverse()
+    if not rows:
+        return KeysetPage([], None, None)
+    older_cursor = encode_cursor(post_key(rows[-1]))
+    newer_cursor = encode_cursor(post_key(rows[0]))
+    if before is not None:
+        return KeysetPage(rows, older_cursor, newer_cursor if has_more else None)
+    return KeysetPage(rows, older_cursor if has_more else None,
+        newer_cursor if after is not None else None)
+
+
+class KeysetQuery(BaseQuery):
+    """
+    Query class for post lists that adds keyset pagination.
+
+        Notes
+            By default the keyset is (timestamp, id) of the query's first entity. keyset_by() overrides it, e.g. so that a materialized timeline pages on its own (indexed) copy of the key.
+    """
+    _keyset_columns = None
+    _row_factory = None
+    _counted = None # records(): the query before the author join
+
+    def keyset_by(self, timestamp_column, id_column):
+        query = self._clone()
+        query._keyset_columns = (timestamp_column, id_column)
+        return query
+
+    def records(self):
+        """
+        Returns this query reading PostRecords rather than Post objects: the post and author columns that _post.html renders, joined in one SELECT and executed as a Core statement.
+
+            Notes
+                The result still supports keyset_paginate(), paginate(), all(), etc. ORM options (e.g., joinedload(Post.author)) are moot and ignored.
+        """
+        from app.models import Post, User
+        query = self.with_entities(Post.id, Post.body, Post.timestamp,
+            User.id, User.username, User.avatar_digest, User.profile_version). \
+            join(User, User.id == Post.user_id)
+        query._row_factory = PostRecord.from_row
+        query._counted = self
+        return query
+
+    def __iter__(self):
+        if self._row_factory is None:
+            return super().__iter__()
+        if self._autoflush and not self._populate_existing:
+            self.session._autoflush()
+        rows = self.session.execute(self.statement, self._params)
+        return map(self._row_factory, rows)
+
+    def count(self):
+        if self._row_factory is None:
+            return super().count()
+        counted = self._counted
+        if self._criterion is counted._criterion and \
+                (self._limit, self._offset) == (counted._limit, counted._offset):
+            # the author join doesn't change the count: count without it
+            return counted.order_by(None).count()
+        query = self._clone()
+        query._row_factory = None
+        return super(KeysetQuery, query).count()
+
+    def keyset_window(self, per_page, after=None, before=None):
+        """
+        Returns this query restricted to the per_page + 1 rows past a cursor: older than `after` (newest first) or newer than `before` (oldest first). Without a cursor, returns the newest per_page + 1 rows.
+
+            Raises
+                ValueError -- if the cursor is malformed
+        """
+        if self._keyset_columns:
+            timestamp_column, id_column = self._keyset_columns
+        else:
+            entity = self.column_descriptions[0]['entity']
+            timestamp_column, id_column = entity.timestamp, entity.id
+        query = self.order_by(None)
+        if before is not None:
+            timestamp, id = decode_cursor(before)
+            # note: the leading `>=` gives every backend a plain index range
+            return query.filter(timestamp_column >= timestamp). \
+                filter(db.or_(timestamp_column > timestamp, id_column > id)). \
+                order_by(timestamp_column.asc(), id_column.asc()). \
+                limit(per_page + 1)
+        if after is not None:
+            timestamp, id = decode_cursor(after)
+            query = query.filter(timestamp_column <= timestamp). \
+                filter(db.or_(timestamp_column < timestamp, id_column < id))
+        return query.order_by(timestamp_column.desc(), id_column.desc()). \
+            limit(per_page + 1)
+
+    def keyset_paginate(self, per_page, after=None, before=None):
+        """
+        Returns a KeysetPage of per_page posts past the cursor (see keyset_window()).
+        """
+        rows = self.keyset_window(per_page, after, before).all()
+        return make_page(rows, per_page, after, before)
+
+    def offset_paginate(self, page, per_page):
+        """
+        Returns the posts of the page-th page of per_page posts, by OFFSET, and whether there's another page after it.
+
+            Notes
+                Unlike paginate(), doesn't count the posts: the count of a whole list is a scan of every row (or index entry) of it. One extra row is fetched instead.
+        """
+        rows = self.offset((page - 1) * per_page).limit(per_page + 1).all()
+        return rows[:per_page], len(rows) > per_page
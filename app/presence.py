@@ -0,0 +1,143 @@
+"""
+Write-behind buffer for User.last_seen.
+
+Rather than committing a write transaction on every authenticated request,
+before_request records the time in memory (at most once per user per
+LAST_SEEN_GRANULARITY seconds) and a background thread applies all pending
+values every LAST_SEEN_FLUSH_INTERVAL seconds in one batched UPDATE.
+"""
+# python packages
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta
+# flask extensions
+from flask import current_app, has_app_context
+
+
+class LastSeenBuffer():
+    """
+    Flask extension holding one buffer of pending last_seen values per app.
+
+        Notes
+            Set LAST_SEEN_FLUSH_INTERVAL to 0 to write through (each accepted update is flushed straight away, in the calling thread).
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['last_seen'] = _Buffer(app)
+
+    def _buffer(self):
+        return current_app.extensions['last_seen']
+
+    def touch(self, user_id, previous=None, when=None):
+        """
+        Record that the user was seen at `when` (default: now).
+
+            Params
+                user_id (int)
+                previous (datetime)
+                    The user's last_seen as currently stored, if known. Updates within LAST_SEEN_GRANULARITY of it (or of the last recorded value) are dropped.
+                when (datetime)
+
+            Returns
+                None
+        """
+        self._buffer().touch(user_id, previous, when or datetime.utcnow())
+
+    def get(self, user_id):
+        """
+        Returns the user's pending (not yet flushed) last_seen, or None.
+        """
+        return self._buffer().get(user_id)
+
+    def flush(self):
+        """
+        Write all pending values to the database now. Returns the count of users updated.
+        """
+        return self._buffer().flush()
+
+
+class _Buffer():
+    def __init__(self, app):
+        self.app = app
+        self.granularity = timedelta(
+            seconds=app.config['LAST_SEEN_GRANULARITY'])
+        self.interval = app.config['LAST_SEEN_FLUSH_INTERVAL']
+        self.pending = {} # user_id -> last_seen not yet written
+        self.recorded = {} # user_id -> last accepted last_seen
+        self.lock = threading.Lock()
+        self.thread = None
+        atexit.register(self.flush)
+
+    def touch(self, user_id, previous, when):
+        with self.lock:
+            latest = self.recorded.get(user_id) or previous
+            if latest is not None and when - latest < self.granularity:
+                return None
+            self.recorded[user_id] = when
+            self.pending[user_id] = when
+            start_flusher = self.interval > 0 and self.thread is None
+            if start_flusher:
+                self.thread = threading.Thread(target=self.run,
+                    name='last-seen-flusher', daemon=True)
+        if self.interval <= 0:
+            self.flush()
+        elif start_flusher:
+            self.thread.start()
+
+    def get(self, user_id):
+        with self.lock:
+            return self.pending.get(user_id)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('last_seen flush failed')
+
+    def flush(self):
+        # swap the pending dict out under the lock; write outside of it
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            cutoff = datetime.utcnow() - self.granularity
+            self.recorded = {user_id: when for user_id, when
+                in self.recorded.items() if when > cutoff}
+        if not pending:
+            return 0
+        from app import db
+        from app.models import User
+        update = User.__table__.update(). \
+            where(User.id == db.bindparam('user_id')). \
+            values(last_seen=db.bindparam('seen'))
+        rows = [{'user_id': user_id, 'seen': when}
+            for user_id, when in pending.items()]
+        try:
+            if has_app_context(): # write-through, from the request
+                self.write(update, rows)
+            else: # flusher thread or interpreter exit
+                with self.app.app_context():
+                    self.write(update, rows)
+        except Exception:
+            # put the values back unless newer ones arrived meanwhile
+            with self.lock:
+                for user_id, when in pending.items():
+                    self.pending.setdefault(user_id, when)
+            raise
+        return len(rows)
+
+    def write(self, update, rows):
+        from app import db
+        from app.usercache import user_cache
+        try:
+            db.session.execute(update, rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        # the cached users have the previous last_seen
+        user_cache.evict([row['user_id'] for row in rows])
@@ -0,0 +1,168 @@
+"""
+Lightweight, read-only records of posts, for rendering post lists.
+
+Timelines, explore and profile pages read their posts as records, built
+straight from joined Core rows (see KeysetQuery.records() in
+app/pagination.py) with POST_RECORDS set.
+
+Search hits carry the stored fields of their post (see
+SearchableMixin.__stored__), which are turned into PostRecords without
+touching the database. Hits without stored fields (documents indexed before
+the fields were stored) are looked up in an in-process LRU cache of records
+by post id, and only the remaining misses are loaded from the database (as
+rows too).
+Cached records expire after SEARCH_RECORD_CACHE_TTL seconds, which bounds
+how long an edit made by another process can go unseen.
+"""
+# python packages
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+# flask extensions
+from flask import current_app
+
+
+def gravatar_url(digest, size=70, default='identicon'):
+    return f"https://www.gravatar.com/avatar/{digest}?d={default}&s={size}"
+
+
+class AuthorRecord():
+    __slots__ = ('id', 'username', 'avatar_digest', 'profile_version')
+
+    def __init__(self, id, username, avatar_digest, profile_version=None):
+        self.id = id
+        self.username = username
+        self.avatar_digest = avatar_digest
+        self.profile_version = profile_version
+
+    def get_avatar_image(self, size=70, default='identicon'):
+        return gravatar_url(self.avatar_digest, size, default)
+
+
+class PostRecord():
+    """
+    A post and its author, as rendered by _post.html.
+
+        Attributes
+            id (int)
+            body (str)
+            timestamp (datetime)
+            author (AuthorRecord)
+    """
+    __slots__ = ('id', 'body', 'timestamp', 'author')
+
+    def __init__(self, id, body, timestamp, author):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.author = author
+
+    @classmethod
+    def from_stored(cls, id, stored):
+        """
+        Returns the record for a search hit's stored fields (see app/search.make_payload()).
+        """
+        timestamp = stored.get('timestamp')
+        return cls(id, stored.get('body'),
+            datetime.fromisoformat(timestamp) if timestamp else None,
+            AuthorRecord(stored.get('user_id'), stored.get('author.username'),
+                stored.get('author.avatar_digest'),
+                stored.get('author.profile_version')))
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Returns the record for a row of KeysetQuery.records(): (id, body, timestamp, author id, username, avatar_digest, profile_version).
+        """
+        return cls(row[0], row[1], row[2], AuthorRecord(*row[3:]))
+
+    @classmethod
+    def from_model(cls, post):
+        author = post.author
+        return cls(post.id, post.body, post.timestamp,
+            AuthorRecord(author.id, author.username, author.avatar_digest,
+                author.profile_version))
+
+
+class RecordCache():
+    """
+    Flask extension holding one LRU cache of PostRecords by post id per app.
+
+        Notes
+            Holds up to SEARCH_RECORD_CACHE_SIZE records (0 disables the cache), each for up to SEARCH_RECORD_CACHE_TTL seconds. Records are evicted when their post is updated or deleted, or their author's username or avatar changes, in this process (see SearchableMixin.after_commit()).
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['post_records'] = _Cache(
+            app.config['SEARCH_RECORD_CACHE_SIZE'],
+            app.config['SEARCH_RECORD_CACHE_TTL'])
+
+    def _cache(self):
+        return current_app.extensions['post_records']
+
+    def get_many(self, ids):
+        """
+        Returns a dict of the cached, unexpired records of the ids, by id.
+        """
+        return self._cache().get_many(ids)
+
+    def put_many(self, records):
+        self._cache().put_many(records)
+
+    def evict(self, ids=(), author_ids=()):
+        """
+        Drop the records of the post ids, and those of the posts by the author ids.
+        """
+        self._cache().evict(ids, author_ids)
+
+
+class _Cache():
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.records = OrderedDict() # id -> (expiry, record), oldest first
+        self.lock = threading.Lock()
+
+    def get_many(self, ids):
+        found = {}
+        now = time.monotonic()
+        with self.lock:
+            for id in ids:
+                entry = self.records.get(id)
+                if entry is None:
+                    continue
+                if entry[0] <= now:
+                    del self.records[id]
+                    continue
+                self.records.move_to_end(id)
+                found[id] = entry[1]
+        return found
+
+    def put_many(self, records):
+        if self.size <= 0:
+            return None
+        expiry = time.monotonic() + self.ttl
+        with self.lock:
+            for record in records:
+                self.records[record.id] = (expiry, record)
+                self.records.move_to_end(record.id)
+            while len(self.records) > self.size:
+                self.records.popitem(last=False)
+
+    def evict(self, ids, author_ids):
+        author_ids = set(author_ids)
+        with self.lock:
+            for id in ids:
+                self.records.pop(id, None)
+            if author_ids:
+                # note: a scan, but author changes are rare and the cache small
+                for id in [id for id, (_, record) in self.records.items()
+                        if record.author.id in author_ids]:
+                    del self.records[id]
+
+
+post_records = RecordCache()
@@ -0,0 +1,257 @@
+"""
+Streaming, parallel, resumable rebuilds of a search index.
+
+A reindex reads the table in id order, one keyset chunk of
+SEARCH_REINDEX_CHUNK_SIZE rows at a time (only the id, __searchable__ and
+__stored__ columns; no ORM objects), and ships each chunk as one bulk request from a
+pool of SEARCH_REINDEX_WORKERS threads. After every chunk that completes
+(together with every chunk before it), the last indexed id is saved to the
+`search_reindex` table, so an interrupted reindex resumes where it stopped.
+
+Each run reserves a version from the search outbox's id sequence when it
+starts (see app/indexer.py), i.e. above every update committed before it,
+and writes its documents with it as an external version that they only need
+to match ('external_gte'). A document the outbox updates during the run gets
+a higher version, so the run leaves it as it is, and the outbox's later
+updates still apply over the run's documents.
+
+With new_index=True, the documents are written into a fresh physical index
+and the index name is then atomically switched over to it as an alias, so
+searches keep using the old index until the new one is complete. While the
+build runs, the search outbox also sends its updates to the new index, so
+changes made during the build are not lost.
+"""
+# python packages
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+# flask extensions
+from flask import current_app
+# local modules
+from app import db
+from app.search import bulk_index, create_index, delete_index, \
+    alias_targets, swap_alias, make_payload
+
+
+# Checkpoint table (`checkpoints`): one row per index being rebuilt
+checkpoints = db.Table(
+    'search_reindex',
+    db.Column('index_name', db.String(64), primary_key=True),
+    # physical index written to (== index_name when rebuilding in place)
+    db.Column('target', db.String(128), nullable=False),
+    db.Column('last_id', db.Integer, nullable=False, default=0),
+    db.Column('indexed', db.Integer, nullable=False, default=0),
+    db.Column('started', db.DateTime, nullable=False,
+        default=datetime.utcnow))
+
+# attempts per bulk request before the reindex gives up (it can be resumed)
+BULK_ATTEMPTS = 3
+
+
+class ReindexError(Exception):
+    pass
+
+
+class ReindexResult():
+    """
+    Summary of a (possibly resumed) reindex run.
+
+        Attributes
+            index (str) -- index name
+            target (str) -- physical index the documents were written to
+            indexed (int) -- documents indexed by this run
+            elapsed (float) -- seconds taken by this run
+            resumed_from (int) -- id the run started after (0 for a fresh run)
+    """
+    def __init__(self, index, target, indexed, elapsed, resumed_from):
+        self.index = index
+        self.target = target
+        self.indexed = indexed
+        self.elapsed = elapsed
+        self.resumed_from = resumed_from
+
+    @property
+    def rate(self):
+        """Documents indexed per second."""
+        return self.indexed / self.elapsed if self.elapsed else 0.0
+
+
+def build_targets():
+    """
+    Returns the new physical indexes currently being built, as a dict of lists by index name (see app/indexer.py).
+    """
+    targets = {}
+    for index, target in db.session.execute(db.select(
+            [checkpoints.c.index_name, checkpoints.c.target])):
+        if target != index:
+            targets.setdefault(index, []).append(target)
+    return targets
+
+
+def get_checkpoint(index):
+    return db.session.execute(checkpoints.select().
+        where(checkpoints.c.index_name == index)).first()
+
+
+def save_checkpoint(index, last_id, indexed):
+    db.session.execute(checkpoints.update().
+        where(checkpoints.c.index_name == index).
+        values(last_id=last_id, indexed=indexed))
+    db.session.commit()
+
+
+def stream_chunks(model, after_id, chunk_size):
+    """
+    Yields the model's table as lists of (id, document) tuples, in id order, starting after `after_id`.
+
+        Notes
+            Each chunk is its own keyset query (WHERE id > last id ORDER BY id LIMIT chunk_size), read in full, so every read is a primary key range scan, memory is bounded by one chunk, and no cursor stays open across the checkpoint commits.
+    """
+    while True:
+        rows = model.search_rows(). \
+            filter(model.id > after_id). \
+                order_by(model.id). \
+                    limit(chunk_size)
+        chunk = [(row[0], make_payload(model, row[1:])) for row in rows]
+        if not chunk:
+            return None
+        yield chunk
+        after_id = chunk[-1][0]
+
+
+def ship_chunk(app, target, chunk, version):
+    """
+    Send one chunk with a bulk request (in a pool thread), retrying with backoff. Returns the count of documents indexed.
+    """
+    with app.app_context():
+        for attempt in range(1, BULK_ATTEMPTS + 1):
+            try:
+                failed = bulk_index(target, chunk, version)
+            except Exception:
+                if attempt == BULK_ATTEMPTS:
+                    raise
+                failed = None
+            if failed == []:
+                return len(chunk)
+            if attempt == BULK_ATTEMPTS:
+                raise ReindexError(f'{len(failed)} document(s) could not be '
+                    f'indexed into {target}, e.g. id {failed[0]}')
+            time.sleep(2 ** attempt)
+
+
+def reindex(model, chunk_size=None, workers=None, new_index=False,
+        restart=False, progress=None):
+    """
+    Rebuild the model's search index from its table.
+
+        Params
+            model (obj)
+                SearchableMixin model class
+            chunk_size (int)
+                Documents per bulk request (default: SEARCH_REINDEX_CHUNK_SIZE).
+            workers (int)
+                Concurrent bulk requests (default: SEARCH_REINDEX_WORKERS).
+            new_index (bool)
+                Build into a new physical index and swap the index name (an alias) over to it when done. Otherwise, documents are written into the live index.
+            restart (bool)
+                Discard the checkpoint of an interrupted run instead of resuming it.
+            progress (function)
+                Called as progress(indexed, elapsed) after each checkpoint.
+
+        Returns
+            ReindexResult
+
+        Raises
+            ReindexError -- if a chunk still fails after BULK_ATTEMPTS attempts (the checkpoint is kept, so running again resumes)
+    """
+    index = model.__tablename__
+    chunk_size = chunk_size or current_app.config['SEARCH_REINDEX_CHUNK_SIZE']
+    workers = workers or current_app.config['SEARCH_REINDEX_WORKERS']
+    checkpoint = get_checkpoint(index)
+    if checkpoint is not None and (restart or
+            (checkpoint.target != index) != new_index):
+        if checkpoint.target != index:
+            delete_index(checkpoint.target)
+        db.session.execute(checkpoints.delete().
+            where(checkpoints.c.index_name == index))
+        checkpoint = None
+    if checkpoint is None:
+        target = index
+        if new_index:
+            target = f"{index}-{datetime.utcnow():%Y%m%d%H%M%S}"
+            create_index(target)
+        db.session.execute(checkpoints.insert().values(index_name=index,
+            target=target, last_id=0, indexed=0, started=datetime.utcnow()))
+        db.session.commit()
+        checkpoint = get_checkpoint(index)
+    target, resumed_from = checkpoint.target, checkpoint.last_id
+    last_id, total = checkpoint.last_id, checkpoint.indexed
+    from app.indexer import reserve_version
+    version = reserve_version(db.session)
+    db.session.commit()
+
+    app = current_app._get_current_object()
+    start = time.perf_counter()
+    indexed = 0
+    in_flight = deque() # (future, last id of chunk), in id order
+    with ThreadPoolExecutor(max_workers=workers,
+            thread_name_prefix='reindex') as pool:
+        try:
+            for chunk in stream_chunks(model, last_id, chunk_size):
+                # keep at most 2 chunks per worker in memory
+                while len(in_flight) >= workers * 2:
+                    wait([future for future, _ in in_flight],
+                        return_when=FIRST_COMPLETED)
+                    last_id, total, indexed = checkpoint_done(index, in_flight,
+                        last_id, total, indexed, start, progress)
+                in_flight.append((pool.submit(ship_chunk, app, target, chunk,
+                    version), chunk[-1][0]))
+            while in_flight:
+                wait([future for future, _ in in_flight])
+                last_id, total, indexed = checkpoint_done(index, in_flight,
+                    last_id, total, indexed, start, progress)
+        except BaseException:
+            for future, _ in in_flight:
+                future.cancel()
+            raise
+
+    if target != index:
+        old_indexes = alias_targets(index)
+        swap_alias(index, target)
+        for old_index in old_indexes:
+            if old_index != target:
+                delete_index(old_index)
+    db.session.execute(checkpoints.delete().
+        where(checkpoints.c.index_name == index))
+    db.session.commit()
+    return ReindexResult(index, target, indexed, time.perf_counter() - start,
+        resumed_from)
+
+
+def checkpoint_done(index, in_flight, last_id, total, indexed, start,
+        progress):
+    """
+    Pop the leading run of completed chunks off `in_flight` and save the checkpoint past them.
+
+        Returns
+            last_id, total, indexed -- updated counters
+
+        Raises
+            the chunk's exception, if a completed chunk failed
+    """
+    checkpoint = last_id
+    try:
+        while in_flight and in_flight[0][0].done():
+            future, chunk_last_id = in_flight[0]
+            count = future.result()
+            in_flight.popleft()
+            last_id = chunk_last_id
+            total += count
+            indexed += count
+    finally:
+        if last_id != checkpoint:
+            save_checkpoint(index, last_id, total)
+    if last_id != checkpoint and progress is not None:
+        progress(indexed, time.perf_counter() - start)
+    return last_id, total, indexed
@@ -0,0 +1,161 @@
+"""
+Read replicas: the SELECTs of GET/HEAD/OPTIONS requests are sent to a
+replica of the database, everything else to the primary.
+
+SQLALCHEMY_REPLICA_URIS lists the replicas (configured as Flask-SQLAlchemy
+binds named replica0, replica1, ...). The `db` session is a RoutingSession,
+whose get_bind() picks a replica (one per session, i.e. per request) for
+SELECT statements when all of these hold:
+    - the request uses a safe method and its view isn't marked primary_only (views that write on GET, e.g. main.follow, are)
+    - the session hasn't flushed in this request (once a request writes, it reads its own writes from the primary)
+    - the user isn't pinned to the primary: every request that commits a flush pins its user (through the signed session cookie) for REPLICA_PIN_SECONDS, so that the pages they see next include their own writes while the replicas catch up
+Writes, flushes, SELECT ... FOR UPDATE, raw SQL and everything outside of a
+request (CLI commands, background threads) use the primary.
+
+To try it locally, copy the SQLite database file and point
+DATABASE_REPLICA_URLS at the copy (it then lags forever, which makes the
+routing easy to see).
+"""
+# python packages
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
+# flask extensions
+from flask import current_app, g, has_request_context, request
+from flask import session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql.expression import SelectBase
+# local modules
+from app import sqlitedb
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# key of the pin's expiry time in the session cookie
+PIN_KEY = '_primary_until'
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session routing the reads of safe requests to a replica.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        # the SQLite write queue's connection, if enabled (see app/sqlitedb.py)
+        connection = sqlitedb.writer_bind(self, clause)
+        if connection is not None:
+            return connection
+        if isinstance(clause, SelectBase) and not self._flushing and \
+                getattr(clause, '_for_update_arg', None) is None:
+            engine = self.replica()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+    def replica(self):
+        """
+        Returns the replica engine for this session's reads, or None to read from the primary.
+        """
+        if not has_request_context() or not g.get('_read_replica') or \
+                g.get('_use_primary') or self.info.get('replica_wrote'):
+            return None
+        engine = self.info.get('replica_engine')
+        if engine is None:
+            replicas = self.app.extensions['replicas']
+            engine = self.info['replica_engine'] = self.app.extensions[
+                'sqlalchemy'].db.get_engine(self.app,
+                    bind=random.choice(replicas.binds))
+        return engine
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy extension whose sessions are RoutingSessions.
+    """
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReadReplicas():
+    """
+    Flask extension holding the read replicas of an app.
+
+        Notes
+            Does nothing unless SQLALCHEMY_REPLICA_URIS lists at least one replica. Initialized after `db`, whose binds it adds to.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        uris = app.config['SQLALCHEMY_REPLICA_URIS']
+        if not uris:
+            return None
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        names = []
+        for number, uri in enumerate(uris):
+            names.append(f'replica{number}')
+            binds[names[-1]] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds
+        app.extensions['replicas'] = _Replicas(names,
+            app.config['REPLICA_PIN_SECONDS'])
+        app.before_request(route_request)
+
+
+class _Replicas():
+    def __init__(self, binds, pin_seconds):
+        self.binds = binds
+        self.pin_seconds = pin_seconds
+
+
+def route_request():
+    g._read_replica = request.method in SAFE_METHODS and \
+        flask_session.get(PIN_KEY, 0) <= time.time()
+
+
+@contextmanager
+def use_primary():
+    """
+    Read from the primary within the block (e.g., reads that decide a write, or that fill a cache shared with other requests).
+    """
+    if not has_request_context():
+        yield
+        return None
+    g._use_primary = g.get('_use_primary', 0) + 1
+    try:
+        yield
+    finally:
+        g._use_primary -= 1
+
+
+def primary_only(view):
+    """
+    Decorator for views that write on safe methods: all their reads go to the primary.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with use_primary():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def after_flush(session, flush_context):
+    session.info['replica_wrote'] = True
+
+
+def after_commit(session):
+    """
+    Pin the user to the primary after a commit that wrote.
+    """
+    if not session.info.pop('replica_wrote', False) or \
+            not has_request_context():
+        return None
+    replicas = current_app.extensions.get('replicas')
+    if replicas is None:
+        return None
+    g._read_replica = False
+    flask_session[PIN_KEY] = time.time() + replicas.pin_seconds
+
+
+def after_rollback(session):
+    session.info.pop('replica_wrote', None)
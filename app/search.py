@@ -1,41 +1,260 @@
 """
 Search functions.
+
+The functions below are backend-agnostic: they delegate to the app's search
+backend (app.search_backend), which is one of
+    ElasticsearchBackend -- an elasticsearch cluster (ELASTICSEARCH_URL)
+    EmbeddedBackend -- the in-process engine of app/searchengine.py, which stores its indexes under SEARCH_INDEX_DIR
+or None if search is disabled (see init_backend()).
+
+Results of query_index() are cached (see app/searchcache.py); every function
+that writes documents invalidates the cached results of the indexes written.
 """
+# python packages
+import time
+from datetime import datetime
 # flask extensions
 from flask import current_app
+# local modules
+from app.metrics import record_search_time
+from app.searchcache import search_cache
+from app.searchengine import EmbeddedEngine, STORED_FIELD
+
+
+class SearchBackend():
+    """
+    Interface of the search backends.
+
+        Notes
+            Writes go through bulk(), which takes (op, index, id, version, payload) operations. op is 'index', 'create' (index unless the document exists) or 'delete'; payload is the document (None for 'delete'): its searchable fields, plus its stored fields under the 'stored' key (see make_payload()), which are returned with hits but not searched. version, if not None, is an external version: the operation is only applied if it is higher than the version of the document in the index (or, with version_type 'external_gte', at least as high). bulk() returns an HTTP-like status per operation, as elasticsearch's bulk API does (2xx: applied; 404: no such document; 409: version conflict, or 'create' of an existing document).
+    """
+    def bulk(self, operations, version_type='external'):
+        raise NotImplementedError
+
+    def search(self, index, query, page, per_page, search_after=None,
+            fields=None):
+        """
+        Returns (ids, hits_count, last_sort, stored) of a page of hits, ranked by relevance then id (see query_index()).
+        """
+        raise NotImplementedError
+
+    def create_index(self, index):
+        raise NotImplementedError
+
+    def delete_index(self, index):
+        raise NotImplementedError
+
+    def alias_targets(self, alias):
+        raise NotImplementedError
+
+    def swap_alias(self, alias, index):
+        raise NotImplementedError
+
+
+class ElasticsearchBackend(SearchBackend):
+    def __init__(self, client):
+        self.client = client
+
+    def bulk(self, operations, version_type='external'):
+        body = []
+        for op, index, id, version, payload in operations:
+            action = {'_index': index, '_id': id}
+            if version is not None:
+                action.update(version=version, version_type=version_type)
+            body.append({op: action})
+            if op != 'delete':
+                body.append(payload)
+        response = self.client.bulk(body=body)
+        return [next(iter(item.values()))['status']
+            for item in response['items']]
+
+    def search(self, index, query, page, per_page, search_after=None,
+            fields=None):
+        # note: the stored fields are only returned, not searched, and are
+        # the only part of _source that's fetched
+        body = {'query': {'multi_match': {'query': query,
+                    'fields': fields or ['*']}},
+                'sort': [{'_score': 'desc'}, {'_id': 'desc'}],
+                '_source': [STORED_FIELD],
+                'size': per_page}
+        # note: the _id tiebreaker makes the sort total, which search_after needs
+        if search_after:
+            body['search_after'] = search_after
+        else:
+            body['from'] = (page - 1) * per_page
+        search = self.client.search(index=index, body=body)
+        hits = search['hits']['hits']
+        ids = [int(hit['_id']) for hit in hits]
+        hits_count = search['hits']['total']
+        if isinstance(hits_count, dict): # elasticsearch 7+: {'value': n, ...}
+            hits_count = hits_count['value']
+        last_sort = hits[-1]['sort'] if hits else None
+        stored = {int(hit['_id']): hit['_source'][STORED_FIELD] for hit in hits
+            if hit.get('_source', {}).get(STORED_FIELD)}
+        return ids, hits_count, last_sort, stored
+
+    def create_index(self, index):
+        self.client.indices.create(index=index)
+
+    def delete_index(self, index):
+        self.client.indices.delete(index=index, ignore=[404])
+
+    def alias_targets(self, alias):
+        if not self.client.indices.exists_alias(name=alias):
+            return []
+        return list(self.client.indices.get_alias(name=alias))
+
+    def swap_alias(self, alias, index):
+        actions = [{'add': {'index': index, 'alias': alias}}]
+        old_indexes = self.alias_targets(alias)
+        if old_indexes:
+            actions.insert(0, {'remove': {'index': ','.join(old_indexes),
+                'alias': alias}})
+        elif self.client.indices.exists(index=alias):
+            actions.append({'remove_index': {'index': alias}})
+        self.client.indices.update_aliases(body={'actions': actions})
+
+
+class EmbeddedBackend(SearchBackend):
+    def __init__(self, path):
+        self.engine = EmbeddedEngine(path)
+
+    def bulk(self, operations, version_type='external'):
+        return self.engine.bulk(operations, version_type)
+
+    def search(self, index, query, page, per_page, search_after=None,
+            fields=None):
+        # note: the engine never indexes stored fields, so `fields` is moot
+        return self.engine.search(index, query, page, per_page, search_after)
+
+    def create_index(self, index):
+        self.engine.create_index(index)
+
+    def delete_index(self, index):
+        self.engine.delete_index(index)
+
+    def alias_targets(self, alias):
+        return self.engine.alias_targets(alias)
+
+    def swap_alias(self, alias, index):
+        self.engine.swap_alias(alias, index)
+
+
+def init_backend(app):
+    """
+    Returns the search backend selected by the app's config.
 
-def add_to_index(index, model):
+        Notes
+            SEARCH_BACKEND is 'elasticsearch', 'embedded' or 'none'. If unset, elasticsearch is used when ELASTICSEARCH_URL is set, and the embedded engine otherwise.
     """
+    backend = app.config['SEARCH_BACKEND']
+    if backend is None:
+        backend = 'elasticsearch' if app.elasticsearch else 'embedded'
+    if backend == 'elasticsearch':
+        return ElasticsearchBackend(app.elasticsearch) \
+            if app.elasticsearch else None
+    if backend == 'embedded':
+        return EmbeddedBackend(app.config['SEARCH_INDEX_DIR'])
+    return None
+
+
+def make_payload(model, values):
+    """
+    Returns the document for the values of the model's __searchable__ and then __stored__ fields, in order.
+    """
+    searchable_count = len(model.__searchable__)
+    payload = dict(zip(model.__searchable__, values[:searchable_count]))
+    if model.__stored__:
+        payload[STORED_FIELD] = {field: value.isoformat()
+            if isinstance(value, datetime) else value for field, value
+            in zip(model.__stored__, values[searchable_count:])}
+    return payload
+
+
+def bulk_update(operations):
+    """
+    Applies a batch of index/delete operations with a single bulk request.
 
     Params
-        index (str)
-            name of index as string where index is the database Model that has an index in elasticsearch
-        model (obj)
-            the object in the index that represents the row or record in the index to be added.
+        operations (list)
+            (op, index, id, version, payload) tuples. op is 'index' or 'delete'; payload is the document to index (None for 'delete'). version is an external version: the backend only applies an operation if its version is higher than that of the document already in the index, so replaying an operation, or applying it after a newer one, is a no-op.
 
+    Returns
+        applied (list) -- one bool per operation: True if it was applied, or was already superseded (version conflict, or deleting a missing document); False if it failed and should be retried
+
+    Raises
+        backend exceptions -- if the request as a whole fails
     """
-    if not current_app.elasticsearch:
-        return None
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    if not current_app.search_backend or not operations:
+        return [False] * len(operations)
+    try:
+        statuses = current_app.search_backend.bulk(operations)
+    finally:
+        # note: even a failed request may have applied some operations
+        search_cache.invalidate({index for _, index, _, _, _ in operations})
+    # 409: a newer version is already indexed (every writer takes its
+    # versions from the outbox sequence; see app/indexer.py); 404: already
+    # deleted
+    return [200 <= status < 300 or status in (404, 409)
+        for status in statuses]
 
-def remove_from_index(index, model):
+
+def bulk_index(index, documents, version):
     """
-    
+    Index a batch of documents with a single bulk request.
+
     Params
         index (str)
-            name of index as string where index is the database Model that has an index in elasticsearch
-        model (obj)
-            the object in the index that represents the row or record in the index to be added.
+            name of the (physical) index to write to
+        documents (list)
+            (id, payload) tuples
+        version (int)
+            external version of the documents (see indexer.reserve_version()), applied if at least as high as the indexed one: documents the outbox has updated since (to a higher version) are left as they are
+
+    Returns
+        failed (list) -- ids of the documents that could not be indexed
+
+    Raises
+        backend exceptions -- if the request as a whole fails
     """
-    if not current_app.elasticsearch:
-        return None
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    try:
+        statuses = current_app.search_backend.bulk([('index', index, id,
+            version, payload) for id, payload in documents],
+            version_type='external_gte')
+    finally:
+        search_cache.invalidate([index])
+    # 409: a newer version is already indexed
+    return [id for (id, _), status in zip(documents, statuses)
+        if not (200 <= status < 300 or status == 409)]
 
 
-def query_index(index, query, page, per_page):
+def create_index(index):
+    current_app.search_backend.create_index(index)
+
+
+def delete_index(index):
+    current_app.search_backend.delete_index(index)
+
+
+def alias_targets(alias):
+    """
+    Returns the names of the physical indexes behind an alias ([] if `alias` is not an alias).
+    """
+    return current_app.search_backend.alias_targets(alias)
+
+
+def swap_alias(alias, index):
+    """
+    Atomically point `alias` at `index` (and only at it).
+
+    Notes
+        If `alias` is still the name of a physical index (i.e., the index was built before aliases were used), that index is removed in the same atomic action.
+    """
+    current_app.search_backend.swap_alias(alias, index)
+    search_cache.invalidate([alias])
+
+
+def query_index(index, query, page, per_page, search_after=None, fields=None):
     """
     Returns search results.
 
@@ -43,23 +262,33 @@ def query_index(index, query, page, per_page):
         index (str)
             name of index to query
         query (str)
-            query string. Note: 'from' and 'size' keys in body arg of .search() define the subset of the entire result set to be returned.
+            query string
         page (int)
             page number to return from the set of search result pages
         per_page (int)
             count of hits per page
-    
+        search_after (list)
+            sort values of the last hit of the previous page (as returned by the previous call). If given, the page starts right after that hit (elasticsearch's `search_after`) rather than at (page - 1) * per_page, so deep pages don't get slower.
+        fields (list)
+            fields to search (default: all of them); pass the model's __searchable__ fields, so that stored copies aren't searched too
+
     Returns
         ids (list) -- list of ids of hits
         hits (int) -- count of hits
+        last_sort (list) -- sort values of the last hit; pass as `search_after` to get the next page (None if no hits)
+        stored (dict) -- stored fields of the hits that have them, by id
+
+    Notes
+        Results are served from the search cache while no document of the index has been written (and for at most SEARCH_CACHE_TTL seconds).
     """
-    if not current_app.elasticsearch:
-        return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page,
-              'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    hits_count = search['hits']['total']
-    return ids, hits_count
\ No newline at end of file
+    if not current_app.search_backend:
+        return [], 0, None, {}
+    key = search_cache.key(index, query, page, per_page, search_after, fields)
+    result = search_cache.get(key)
+    if result is None:
+        start = time.perf_counter()
+        result = current_app.search_backend.search(index, query, page,
+            per_page, search_after, fields)
+        record_search_time(time.perf_counter() - start)
+        search_cache.put(key, result)
+    return result
@@ -0,0 +1,227 @@
+"""
+Cache of search results, in front of app/search.query_index().
+
+Results are cached by (index, index version, normalized query, page) for up
+to SEARCH_CACHE_TTL seconds. Whenever documents of an index are written
+(see app/search.py), the index's version is bumped, so every cached result
+of the index is superseded at once instead of being looked up and deleted.
+
+The entries and versions live in one of two backends:
+    LocalBackend -- an LRU of SEARCH_CACHE_SIZE entries in this process
+    RedisBackend -- a redis server shared by all processes (SEARCH_CACHE_URL; needs the `redis` package)
+With LocalBackend, a process only sees the version bumps of its own writes,
+so results written by another process (e.g., another worker draining the
+search outbox) can be stale for up to SEARCH_CACHE_TTL seconds.
+"""
+# python packages
+import json
+import threading
+import time
+from collections import OrderedDict
+# flask extensions
+from flask import current_app
+
+
+class LocalBackend():
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict() # key -> (expiry, result), oldest first
+        self.versions = {} # index -> version
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def version(self, index):
+        return self.versions.get(index, 0)
+
+    def bump(self, index):
+        with self.lock:
+            self.versions[index] = self.versions.get(index, 0) + 1
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                self.evictions += 1
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, result, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisBackend():
+    """
+    Shared backend: entries are redis strings (JSON) that expire after the TTL, and versions are redis counters.
+
+        Notes
+            Eviction under memory pressure is left to the server's maxmemory-policy (e.g., allkeys-lru).
+    """
+    prefix = 'search-cache:'
+
+    def __init__(self, client):
+        self.client = client
+        self.evictions = 0
+
+    def version(self, index):
+        return int(self.client.get(f'{self.prefix}version:{index}') or 0)
+
+    def bump(self, index):
+        self.client.incr(f'{self.prefix}version:{index}')
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        ids, hits_count, last_sort, stored = json.loads(value)
+        # note: JSON object keys are strings
+        return ids, hits_count, last_sort, \
+            {int(id): fields for id, fields in stored.items()}
+
+    def set(self, key, result, ttl):
+        self.client.set(self.prefix + key, json.dumps(result), ex=ttl)
+
+    def __len__(self):
+        return 0 # not tracked per process
+
+
+class SearchCache():
+    """
+    Flask extension holding the search result cache of an app.
+
+        Notes
+            Set SEARCH_CACHE_SIZE to 0 to disable the cache. Backend errors are logged and treated as misses: the cache never fails a search.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['search_cache'] = _Cache(app)
+
+    def _cache(self):
+        return current_app.extensions['search_cache']
+
+    def key(self, index, query, page, per_page, search_after=None,
+            fields=None):
+        """
+        Returns the cache key of a query_index() call (None if the cache is disabled or unavailable).
+
+            Notes
+                The key embeds the index's current version, so it's taken before searching: a result is then never stored under a version bumped while it was being computed.
+        """
+        return self._cache().key(index, query, page, per_page, search_after,
+            fields)
+
+    def get(self, key):
+        """
+        Returns the cached result for the key, or None.
+        """
+        return self._cache().get(key)
+
+    def put(self, key, result):
+        self._cache().put(key, result)
+
+    def invalidate(self, indexes):
+        """
+        Bump the versions of the indexes, superseding their cached results.
+        """
+        self._cache().invalidate(indexes)
+
+    def stats(self):
+        """
+        Returns the cache statistics of this process.
+
+            Returns
+                stats (dict) -- hits, misses, evictions (LRU and expired), invalidations (version bumps), errors (backend failures), size (entries held; 0 for a shared backend)
+        """
+        return self._cache().stats()
+
+
+class _Cache():
+    def __init__(self, app):
+        self.app = app
+        self.ttl = app.config['SEARCH_CACHE_TTL']
+        self.enabled = app.config['SEARCH_CACHE_SIZE'] > 0
+        if app.config['SEARCH_CACHE_URL']:
+            from redis import Redis
+            self.backend = RedisBackend(
+                Redis.from_url(app.config['SEARCH_CACHE_URL']))
+        else:
+            self.backend = LocalBackend(app.config['SEARCH_CACHE_SIZE'])
+        self.counts = {'hits': 0, 'misses': 0, 'invalidations': 0,
+            'errors': 0}
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def key(self, index, query, page, per_page, search_after, fields):
+        if not self.enabled:
+            return None
+        try:
+            version = self.backend.version(index)
+        except Exception:
+            self.app.logger.exception('search cache: version lookup failed')
+            self.count('errors')
+            return None
+        query = ' '.join(query.lower().split())
+        position = f'after={json.dumps(search_after)}' if search_after \
+            else f'page={page}'
+        fields = ','.join(fields) if fields else '*'
+        return f'{index}:{version}:{per_page}:{position}:{fields}:{query}'
+
+    def get(self, key):
+        if key is None:
+            return None
+        try:
+            result = self.backend.get(key)
+        except Exception:
+            self.app.logger.exception('search cache: lookup failed')
+            self.count('errors')
+            result = None
+        self.count('misses' if result is None else 'hits')
+        return result
+
+    def put(self, key, result):
+        if key is None:
+            return None
+        try:
+            self.backend.set(key, result, self.ttl)
+        except Exception:
+            self.app.logger.exception('search cache: store failed')
+            self.count('errors')
+
+    def invalidate(self, indexes):
+        if not self.enabled:
+            return None
+        for index in indexes:
+            try:
+                self.backend.bump(index)
+            except Exception:
+                self.app.logger.exception('search cache: invalidation failed')
+                self.count('errors')
+                continue
+            self.count('invalidations')
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        stats['evictions'] = self.backend.evictions
+        stats['size'] = len(self.backend)
+        return stats
+
+
+search_cache = SearchCache()
@@ -0,0 +1,760 @@
+"""
+Embedded full-text search engine (the 'embedded' search backend).
+
+Each index is a directory of immutable segment files plus a manifest that
+lists the live segments. A segment is an inverted index over a batch of
+documents: a sorted term dictionary, and for each term a postings list of
+the documents containing it, stored as delta-encoded document ordinals
+packed at the narrowest width (1, 2 or 4 bytes) that fits the list's
+largest gap, followed by one byte of term frequency per document. Segments
+are read through mmap, so queries only touch the pages they need and every
+process serving the index shares them through the page cache.
+
+Updates are incremental: every bulk write becomes a new small segment, and
+older copies of the documents it replaces (or deletes) are tombstoned in the
+manifest. Segments are merged by size tier (tier n holds segments of
+MERGE_FACTOR ** n to MERGE_FACTOR ** (n + 1) live documents): once a tier
+has MERGE_FACTOR segments, they're merged into one of the next tier, which
+also purges their tombstones. A document is thus rewritten about once per
+tier, log(documents) times in all, rather than on every merge. Writers are
+serialized with a lock file; the manifest is replaced atomically, and
+readers pick up the new one on their next query.
+
+The manifest also keeps the versions of deleted documents, so that a stale
+write of a deleted document still conflicts. Merges drop those older than
+TOMBSTONE_SECONDS whose document no segment holds any more, so that the
+manifest (rewritten by every write) doesn't grow with every delete.
+
+Queries are OR-ed terms ranked with BM25, scored a block of documents at a
+time into a heap of the page's hits. Hit counts are exact up to TRACK_TOTAL_HITS (like
+elasticsearch's default); past it, documents that only match terms which
+can't lift them into the page (MaxScore) are skipped, and the count is a
+lower bound.
+
+A document's 'stored' field is not indexed. It is kept in the segment as is
+(as JSON) and returned with the hits, so that callers can render results
+without going back to the database.
+"""
+# python packages
+import array
+import bisect
+import copy
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from itertools import accumulate, groupby
+try:
+    import fcntl
+except ImportError: # Windows: writers are only serialized within a process
+    fcntl = None
+
+
+TOKEN = re.compile(r'\w+')
+MAX_TOKEN_LENGTH = 64
+INDEX_NAME = re.compile(r'^[a-z0-9][a-z0-9_.\-]*$')
+# segments per size tier that trigger a merge (and the tiers' size ratio)
+MERGE_FACTOR = 10
+# seconds the version of a deleted document is kept (see Index.merge())
+TOMBSTONE_SECONDS = 600
+# hits counted exactly, and ordinals scored at a time (see Index.search())
+TRACK_TOTAL_HITS = 10000
+SCORE_BLOCK = 4096
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# segment file layout (native byte order; each section is 8-byte aligned):
+# header, doc ids ('I'), doc versions ('Q'), doc lengths ('H'),
+# term offsets ('I', term count + 1), terms (utf-8), postings offsets
+# ('Q', term count + 1), postings widths ('B'), stored field offsets ('Q',
+# doc count + 1), stored fields (JSON), postings
+MAGIC = b'MT2' + sys.byteorder[0].encode('ascii')
+# header: magic, doc count, term count, terms length, stored fields length
+HEADER = struct.Struct('<4sIIIQ')
+STORED_FIELD = 'stored'
+WIDTH_FORMATS = {1: 'B', 2: 'H', 4: 'I'}
+
+
+def tokenize(text):
+    """
+    Returns the lowercased word tokens of the text.
+    """
+    return [token for token in TOKEN.findall(text.lower())
+        if len(token) <= MAX_TOKEN_LENGTH]
+
+
+def document_tokens(payload):
+    tokens = []
+    for field, value in payload.items():
+        if value is not None and field != STORED_FIELD:
+            tokens.extend(tokenize(str(value)))
+    return tokens
+
+
+def size_tier(docs):
+    """
+    Returns the merge tier of a segment of `docs` live documents: n for MERGE_FACTOR ** n to MERGE_FACTOR ** (n + 1) - 1.
+    """
+    tier = 0
+    while docs >= MERGE_FACTOR:
+        docs //= MERGE_FACTOR
+        tier += 1
+    return tier
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def write_segment(path, docs, postings):
+    """
+    Write a segment file.
+
+        Params
+            path (str)
+            docs (list)
+                (doc_id, version, length, stored) tuples, sorted by doc_id; stored is the document's stored fields, as JSON (bytes). A document's ordinal is its position in this list.
+            postings (iterable)
+                (term, ordinals, tfs) tuples, sorted by term (utf-8 bytes): the sorted ordinals of the documents containing the term, and the term's frequency in each.
+
+        Returns
+            None
+    """
+    terms = bytearray()
+    term_offsets = array.array('I', [0])
+    postings_offsets = array.array('Q', [0])
+    widths = array.array('B')
+    blob = bytearray()
+    for term, ordinals, tfs in postings:
+        gaps = [ordinals[0]]
+        gaps.extend(b - a for a, b in zip(ordinals, ordinals[1:]))
+        largest = max(gaps)
+        width = 1 if largest < 1 << 8 else 2 if largest < 1 << 16 else 4
+        blob += array.array(WIDTH_FORMATS[width], gaps).tobytes()
+        blob += bytes(min(tf, 255) for tf in tfs)
+        terms += term
+        term_offsets.append(len(terms))
+        postings_offsets.append(len(blob))
+        widths.append(width)
+    stored_offsets = array.array('Q', [0])
+    for doc in docs:
+        stored_offsets.append(stored_offsets[-1] + len(doc[3]))
+    sections = [
+        HEADER.pack(MAGIC, len(docs), len(widths), len(terms),
+            stored_offsets[-1]),
+        array.array('I', [doc[0] for doc in docs]).tobytes(),
+        array.array('Q', [doc[1] for doc in docs]).tobytes(),
+        array.array('H', [min(doc[2], 65535) for doc in docs]).tobytes(),
+        term_offsets.tobytes(),
+        bytes(terms),
+        postings_offsets.tobytes(),
+        widths.tobytes(),
+        stored_offsets.tobytes(),
+        b''.join(doc[3] for doc in docs),
+        bytes(blob)]
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as segment_file:
+        for section in sections:
+            segment_file.write(section)
+            segment_file.write(b'\0' * (_align(len(section)) - len(section)))
+        segment_file.flush()
+        os.fsync(segment_file.fileno())
+    os.replace(temp_path, path)
+
+
+class Segment():
+    """
+    Memory-mapped, read-only view of a segment file.
+
+        Attributes
+            docs (int) -- count of documents, including tombstoned ones
+            deleted (frozenset) -- tombstoned doc ids
+            total_length (int) -- sum of the document lengths (in tokens)
+            shortest (int) -- length of the shortest document (bounds its scores)
+    """
+    def __init__(self, path, deleted=()):
+        with open(path, 'rb') as segment_file:
+            self.map = mmap.mmap(segment_file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        magic, docs, term_count, terms_length, stored_length = \
+            HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a segment file of this version '
+                'and platform; rebuild it with `flask search reindex`')
+        position = _align(HEADER.size)
+        sections = []
+        for length, format in ((4 * docs, 'I'), (8 * docs, 'Q'),
+                (2 * docs, 'H'), (4 * (term_count + 1), 'I'),
+                (terms_length, None), (8 * (term_count + 1), 'Q'),
+                (term_count, 'B'), (8 * (docs + 1), 'Q'),
+                (stored_length, None)):
+            section = view[position:position + length]
+            sections.append((section.cast(format) if format else position))
+            position = _align(position + length)
+        self.doc_ids, self.versions, self.lengths, self.term_offsets, \
+            self.terms_start, self.postings_offsets, self.widths, \
+            self.stored_offsets, self.stored_start = sections
+        self.postings = view[position:]
+        self.docs = docs
+        self.term_count = term_count
+        self.total_length = sum(self.lengths)
+        self.shortest = min(self.lengths, default=0)
+        self.deleted = frozenset(deleted)
+
+    def with_deleted(self, deleted):
+        """
+        Returns a view of the same file with another set of tombstones.
+        """
+        segment = copy.copy(self)
+        segment.deleted = frozenset(deleted)
+        return segment
+
+    def term(self, i):
+        start = self.terms_start
+        return self.map[start + self.term_offsets[i]:
+            start + self.term_offsets[i + 1]]
+
+    def terms(self, tag=None):
+        """
+        Yields (term, tag, position) for every term in the dictionary, in order.
+        """
+        for i in range(self.term_count):
+            yield self.term(i), tag, i
+
+    def find_term(self, term):
+        """
+        Returns the position of the term (utf-8 bytes) in the term dictionary, or None.
+        """
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.term_count and self.term(low) == term:
+            return low
+        return None
+
+    def postings_count(self, i):
+        return (self.postings_offsets[i + 1] - self.postings_offsets[i]) // \
+            (self.widths[i] + 1)
+
+    def read_postings(self, i):
+        """
+        Returns the ordinals (iterator) and term frequencies (sequence) of the term at position i.
+        """
+        start = self.postings_offsets[i]
+        width = self.widths[i]
+        count = self.postings_count(i)
+        gaps = self.postings[start:start + count * width]. \
+            cast(WIDTH_FORMATS[width])
+        tfs = self.postings[start + count * width:start + count * (width + 1)]
+        return accumulate(gaps), tfs
+
+    def stored_json(self, ordinal):
+        start = self.stored_start
+        return self.map[start + self.stored_offsets[ordinal]:
+            start + self.stored_offsets[ordinal + 1]]
+
+    def stored(self, ordinal):
+        """
+        Returns the document's stored fields (None if it has none).
+        """
+        stored_json = self.stored_json(ordinal)
+        return json.loads(stored_json) if stored_json else None
+
+    def find(self, doc_id):
+        """
+        Returns the ordinal of the document if it is live in this segment, or None.
+        """
+        if doc_id in self.deleted:
+            return None
+        return self.holds(doc_id)
+
+    def holds(self, doc_id):
+        """
+        Returns the ordinal of the document's copy in this segment (live or tombstoned), or None.
+        """
+        i = bisect.bisect_left(self.doc_ids, doc_id)
+        if i < self.docs and self.doc_ids[i] == doc_id:
+            return i
+        return None
+
+
+class Index():
+    """
+    One index directory: its manifest, segments and writer.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.segments = {} # file name -> Segment
+        # (manifest, [Segment]); replaced as a whole, so readers can take
+        # a consistent snapshot without locking
+        self.snapshot = (self.empty_manifest(), [])
+
+    @staticmethod
+    def empty_manifest():
+        return {'generation': 0, 'next_segment': 1, 'segments': [],
+            'deleted_versions': {}}
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.path, 'manifest.json')
+
+    def refresh(self, force=False):
+        """
+        Reload the manifest (and open any new segments) if it has changed on disk.
+        """
+        try:
+            stat = os.stat(self.manifest_path)
+            stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self.stamp and not force:
+            return None
+        manifest = self.empty_manifest()
+        if stamp is not None:
+            with open(self.manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        segments = {}
+        for entry in manifest['segments']:
+            segment = self.segments.get(entry['name'])
+            if segment is None:
+                try:
+                    segment = Segment(os.path.join(self.path, entry['name']))
+                except FileNotFoundError:
+                    # merged away since the manifest was read; reread it
+                    return self.refresh(force=True)
+            segments[entry['name']] = segment.with_deleted(entry['deleted'])
+        self.segments = segments
+        self.snapshot = (manifest, [segments[entry['name']]
+            for entry in manifest['segments']])
+        self.stamp = stamp
+
+    @contextmanager
+    def writer(self):
+        """
+        Serialize writers (threads of this process, and other processes) and load the latest manifest.
+        """
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, 'write.lock'), 'w') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self.refresh(force=True)
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def write(self, operations, version_type='external'):
+        """
+        Apply a batch of (op, id, version, payload) operations as one new segment. version_type is 'external' (a version must be higher than the document's) or 'external_gte' (at least as high).
+
+            Returns
+                statuses (list) -- an HTTP-like status per operation, as elasticsearch's bulk API: 201 (indexed), 200 (deleted), 404 (no such document), 409 (version conflict, or 'create' of an existing document)
+        """
+        with self.writer():
+            manifest, segments = self.snapshot
+            manifest = json.loads(json.dumps(manifest))
+            deleted_versions = manifest['deleted_versions']
+            changes = {} # doc_id -> (version, payload, or None if deleted)
+            statuses = []
+            for op, id, version, payload in operations:
+                id = int(id)
+                exists, current = self.current(id, changes, segments,
+                    deleted_versions)
+                if current is not None and version is not None and (
+                        version < current if version_type == 'external_gte'
+                        else version <= current):
+                    statuses.append(409)
+                elif op == 'create' and exists:
+                    statuses.append(409)
+                elif op == 'delete':
+                    if version is not None:
+                        changes[id] = (version, None)
+                    elif exists:
+                        changes[id] = (current + 1, None)
+                    statuses.append(200 if exists else 404)
+                else:
+                    if version is None:
+                        version = current + 1 if current else 1
+                    changes[id] = (version, payload)
+                    statuses.append(201)
+            if not changes:
+                return statuses
+
+            # tombstone the previous copies of every changed document
+            for segment, entry in zip(segments, manifest['segments']):
+                superseded = [id for id in changes if segment.find(id) is not None]
+                if superseded:
+                    entry['deleted'] = sorted(set(entry['deleted']) |
+                        set(superseded))
+            for id, (version, payload) in changes.items():
+                if payload is None:
+                    deleted_versions[str(id)] = [version, int(time.time())]
+                else:
+                    deleted_versions.pop(str(id), None)
+            added = {id: change for id, change in changes.items()
+                if change[1] is not None}
+            if added:
+                name = f"{manifest['next_segment']:08d}.seg"
+                manifest['next_segment'] += 1
+                length = self.build_segment(name, added)
+                manifest['segments'].append({'name': name,
+                    'docs': len(added), 'length': length, 'deleted': []})
+            removed = self.merge(manifest)
+            self.commit(manifest)
+            for name in removed:
+                os.remove(os.path.join(self.path, name))
+            return statuses
+
+    def current(self, id, changes, segments, deleted_versions):
+        """
+        Returns (exists, version) of the document's latest copy (version None if the index has never seen it).
+        """
+        if id in changes:
+            version, payload = changes[id]
+            return payload is not None, version
+        for segment in reversed(segments):
+            ordinal = segment.find(id)
+            if ordinal is not None:
+                return True, segment.versions[ordinal]
+        deleted = deleted_versions.get(str(id))
+        # note: [version, deleted at]; older manifests hold the version alone
+        return False, deleted[0] if isinstance(deleted, list) else deleted
+
+    def build_segment(self, name, documents):
+        """
+        Write a segment for a dict of doc_id -> (version, payload). Returns the total document length.
+        """
+        docs = []
+        term_postings = {} # term -> ([ordinal], [tf])
+        for ordinal, id in enumerate(sorted(documents)):
+            version, payload = documents[id]
+            tokens = document_tokens(payload)
+            stored = payload.get(STORED_FIELD)
+            docs.append((id, version, len(tokens), json.dumps(stored,
+                separators=(',', ':')).encode('utf-8') if stored else b''))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                ordinals, tfs = term_postings.setdefault(
+                    token.encode('utf-8'), ([], []))
+                ordinals.append(ordinal)
+                tfs.append(tf)
+        write_segment(os.path.join(self.path, name), docs,
+            ((term, ordinals, tfs) for term, (ordinals, tfs)
+                in sorted(term_postings.items())))
+        return sum(doc[2] for doc in docs)
+
+    def merge(self, manifest):
+        """
+        Merge the segments of the smallest size tier that has MERGE_FACTOR of them into one (along with segments that are mostly tombstones), and drop the expired versions of deleted documents. Updates the manifest in place; returns the names of the merged segment files (to remove once the manifest is committed).
+        """
+        tiers = {}
+        for entry in manifest['segments']:
+            tiers.setdefault(size_tier(entry['docs'] - len(entry['deleted'])),
+                []).append(entry)
+        chosen = next((entries for _, entries in sorted(tiers.items())
+            if len(entries) >= MERGE_FACTOR), [])[:MERGE_FACTOR]
+        chosen += [entry for entry in manifest['segments']
+            if entry not in chosen and len(entry['deleted']) * 2 > entry['docs']]
+        if not chosen:
+            return []
+        segments = [self.open_segment(entry) for entry in chosen]
+        docs = [] # (doc_id, version, length, stored, segment, old ordinal)
+        for number, segment in enumerate(segments):
+            for ordinal in range(segment.docs):
+                id = segment.doc_ids[ordinal]
+                if id not in segment.deleted:
+                    docs.append((id, segment.versions[ordinal],
+                        segment.lengths[ordinal], segment.stored_json(ordinal),
+                        number, ordinal))
+        docs.sort()
+        remaps = [array.array('i', [-1]) * segment.docs for segment in segments]
+        for new_ordinal, doc in enumerate(docs):
+            remaps[doc[4]][doc[5]] = new_ordinal
+
+        def merged_postings():
+            streams = [segment.terms(number)
+                for number, segment in enumerate(segments)]
+            for term, group in groupby(heapq.merge(*streams),
+                    key=lambda item: item[0]):
+                pairs = []
+                for _, number, i in group:
+                    remap = remaps[number]
+                    ordinals, tfs = segments[number].read_postings(i)
+                    pairs.extend((remap[ordinal], tf) for ordinal, tf
+                        in zip(ordinals, tfs) if remap[ordinal] >= 0)
+                if pairs:
+                    pairs.sort()
+                    yield (term, [pair[0] for pair in pairs],
+                        [pair[1] for pair in pairs])
+
+        names = {entry['name'] for entry in chosen}
+        manifest['segments'] = [entry for entry in manifest['segments']
+            if entry['name'] not in names]
+        if docs:
+            name = f"{manifest['next_segment']:08d}.seg"
+            manifest['next_segment'] += 1
+            write_segment(os.path.join(self.path, name),
+                [doc[:4] for doc in docs], merged_postings())
+            manifest['segments'].insert(0, {'name': name, 'docs': len(docs),
+                'length': sum(doc[2] for doc in docs), 'deleted': []})
+        self.drop_tombstones(manifest)
+        return sorted(names)
+
+    def drop_tombstones(self, manifest):
+        """
+        Drop the versions of the documents deleted over TOMBSTONE_SECONDS ago that no segment holds a copy of any more.
+
+            Notes
+                Like elasticsearch's index.gc_deletes: a write of a deleted document with an older version conflicts for TOMBSTONE_SECONDS, then indexes it.
+        """
+        expiry = time.time() - TOMBSTONE_SECONDS
+        segments = [self.open_segment(entry) for entry in manifest['segments']]
+        deleted_versions = manifest['deleted_versions']
+        for id, deleted in list(deleted_versions.items()):
+            deleted_at = deleted[1] if isinstance(deleted, list) else 0
+            if deleted_at < expiry and not any(
+                    segment.holds(int(id)) is not None for segment in segments):
+                del deleted_versions[id]
+
+    def open_segment(self, entry):
+        segment = self.segments.get(entry['name']) or \
+            Segment(os.path.join(self.path, entry['name']))
+        return segment.with_deleted(entry['deleted'])
+
+    def commit(self, manifest):
+        manifest['generation'] += 1
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, separators=(',', ':'))
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(temp_path, self.manifest_path)
+        self.refresh(force=True)
+
+    def search(self, query, page, per_page, search_after=None):
+        """
+        Returns the ids of a page of hits, the count of hits, the sort values ([score, id]) of the page's last hit, and the hits' stored fields (by id).
+        """
+        self.refresh()
+        manifest, segments = self.snapshot
+        terms = {token.encode('utf-8') for token in tokenize(query)}
+        docs = sum(segment.docs - len(segment.deleted) for segment in segments)
+        if not terms or not docs:
+            return [], 0, None, {}
+        average_length = sum(segment.total_length for segment in segments) / \
+            max(sum(segment.docs for segment in segments), 1)
+        idfs = {}
+        for term in terms:
+            df = 0
+            for segment in segments:
+                i = segment.find_term(term)
+                if i is not None:
+                    df += segment.postings_count(i)
+            if df:
+                idfs[term] = math.log(1 + (docs - df + 0.5) / (df + 0.5))
+        # rank by score, then id (newest first), like the elasticsearch sort
+        after = (search_after[0], int(search_after[1])) \
+            if search_after else None
+        skip = 0 if after else (page - 1) * per_page
+        top = [] # min-heap of the best (score, id) hits, at most skip + per_page
+        total = 0
+        for segment in segments:
+            total = self.score_segment(segment, idfs, average_length,
+                skip + per_page, after, top, total)
+        top = sorted(top, reverse=True)[skip:]
+        last_sort = [top[-1][0], top[-1][1]] if top else None
+        ids = [id for _, id in top]
+        return ids, total, last_sort, self.stored(ids, segments)
+
+    @staticmethod
+    def score_segment(segment, idfs, average_length, size, after, top, total):
+        """
+        Score the segment's documents matching the terms (by idf) into the `top` heap (kept to `size` hits before `after`), SCORE_BLOCK ordinals at a time. Returns the hit count so far.
+        """
+        lengths, deleted = segment.lengths, segment.deleted
+        norm = K1 * (1 - B) # + K1 * B * length / average_length
+        per_length = K1 * B / average_length
+        # per term: the bound of its score (its largest tf in the shortest
+        # document; with some slack for rounding), idf, and its postings'
+        # ordinals (decoded in one go) and tfs
+        terms = []
+        for term, idf in idfs.items():
+            i = segment.find_term(term)
+            if i is not None:
+                ordinals, tfs = segment.read_postings(i)
+                tf = max(tfs)
+                bound = idf * tf * (K1 + 1) / \
+                    (tf + norm + per_length * segment.shortest) * (1 + 1e-9)
+                terms.append((bound, idf, list(ordinals), tfs.tolist()))
+        if not terms:
+            return total
+        # MaxScore: the terms by bound, highest first; once the heap is full,
+        # the trailing terms whose bounds add up to less than its lowest score
+        # can't lift a document into it by themselves, so they only add to
+        # the scores of documents the others matched (and those they alone
+        # match aren't counted)
+        terms.sort(key=lambda term: term[0], reverse=True)
+        trailing = list(accumulate(term[0] for term in reversed(terms)))[::-1]
+        positions = [0] * len(terms)
+        essential = len(terms)
+        for block in range(0, segment.docs, SCORE_BLOCK):
+            block_end = block + SCORE_BLOCK
+            scores = {}
+            for n, (_, idf, ordinals, tfs) in enumerate(terms):
+                start = positions[n]
+                end = positions[n] = bisect.bisect_left(ordinals, block_end,
+                    start)
+                for ordinal, tf in zip(ordinals[start:end], tfs[start:end]):
+                    if n >= essential and ordinal not in scores:
+                        continue
+                    scores[ordinal] = scores.get(ordinal, 0.0) + idf * tf * \
+                        (K1 + 1) / (tf + norm + per_length * lengths[ordinal])
+            for ordinal, score in scores.items():
+                id = segment.doc_ids[ordinal]
+                if deleted and id in deleted:
+                    continue
+                total += 1
+                hit = (score, id)
+                if after is not None and hit >= after:
+                    continue
+                if len(top) < size:
+                    heapq.heappush(top, hit)
+                elif hit > top[0]:
+                    heapq.heapreplace(top, hit)
+            if len(top) == size and total >= TRACK_TOTAL_HITS:
+                # note: strictly below, as ties go to the higher id
+                while essential > 1 and trailing[essential - 1] < top[0][0]:
+                    essential -= 1
+        return total
+
+    @staticmethod
+    def stored(ids, segments):
+        """
+        Returns the stored fields of the documents, by id.
+        """
+        stored = {}
+        for id in ids:
+            for segment in segments:
+                ordinal = segment.find(id)
+                if ordinal is not None:
+                    fields = segment.stored(ordinal)
+                    if fields is not None:
+                        stored[id] = fields
+                    break
+        return stored
+
+
+class EmbeddedEngine():
+    """
+    A directory of indexes (one subdirectory each) and their aliases.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.aliases_stamp = None
+        self.aliases = {}
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def aliases_path(self):
+        return os.path.join(self.path, 'aliases.json')
+
+    def index_path(self, name):
+        if not INDEX_NAME.match(name):
+            raise ValueError(f'invalid index name: {name!r}')
+        return os.path.join(self.path, name)
+
+    def load_aliases(self):
+        try:
+            stamp = os.stat(self.aliases_path).st_mtime_ns
+        except FileNotFoundError:
+            stamp = None
+        if stamp != self.aliases_stamp:
+            aliases = {}
+            if stamp is not None:
+                with open(self.aliases_path) as aliases_file:
+                    aliases = json.load(aliases_file)
+            self.aliases, self.aliases_stamp = aliases, stamp
+        return self.aliases
+
+    def resolve(self, name):
+        return self.load_aliases().get(name, name)
+
+    def index(self, name):
+        """
+        Returns the Index an index name (or alias) refers to.
+        """
+        name = self.resolve(name)
+        with self.lock:
+            index = self.indexes.get(name)
+            if index is None:
+                index = self.indexes[name] = Index(self.index_path(name))
+            return index
+
+    def bulk(self, operations, version_type='external'):
+        """
+        Apply (op, index, id, version, payload) operations; one new segment per index. Returns a status per operation.
+        """
+        by_index = {}
+        for position, (op, name, id, version, payload) in \
+                enumerate(operations):
+            by_index.setdefault(self.resolve(name), []).append(
+                (position, (op, id, version, payload)))
+        statuses = [None] * len(operations)
+        for name, batch in by_index.items():
+            results = self.index(name).write([item for _, item in batch],
+                version_type)
+            for (position, _), status in zip(batch, results):
+                statuses[position] = status
+        return statuses
+
+    def search(self, name, query, page, per_page, search_after=None):
+        return self.index(name).search(query, page, per_page, search_after)
+
+    def create_index(self, name):
+        os.makedirs(self.index_path(name), exist_ok=True)
+
+    def delete_index(self, name):
+        with self.lock:
+            self.indexes.pop(name, None)
+        shutil.rmtree(self.index_path(name), ignore_errors=True)
+
+    def alias_targets(self, alias):
+        target = self.load_aliases().get(alias)
+        return [target] if target else []
+
+    def swap_alias(self, alias, name):
+        """
+        Point `alias` at the index `name`. An index named `alias` is deleted.
+        """
+        with self.lock:
+            aliases = dict(self.load_aliases())
+            aliases[alias] = name
+            temp_path = self.aliases_path + '.tmp'
+            with open(temp_path, 'w') as aliases_file:
+                json.dump(aliases, aliases_file)
+            os.replace(temp_path, self.aliases_path)
+            self.aliases, self.aliases_stamp = aliases, None
+            self.indexes.pop(alias, None)
+        shutil.rmtree(self.index_path(alias), ignore_errors=True)
@@ -0,0 +1,242 @@
+"""
+SQLite tuning for production: connection pragmas, pooling, and an optional
+single-writer queue with group commit.
+
+With SQLITE_PROFILE = 'production' (and a SQLite database file):
+    - every connection gets PRODUCTION_PRAGMAS (overridable with SQLITE_PRAGMAS): WAL journaling (readers and the writer don't block each other), synchronous=NORMAL (no fsync per commit in WAL mode; a power loss can lose the last commits, not corrupt the db), a larger page cache, memory-mapped reads, and a busy timeout (a writer waits for the lock instead of failing with "database is locked")
+    - connections are pooled (SQLITE_POOL_SIZE, shared across threads) instead of opened per checkout, so the pragmas are only paid once per connection
+The replicas' engines (see app/replicas.py) get the same settings.
+
+With SQLITE_WRITE_QUEUE set, the writes of this process go through one
+writer connection, one transaction at a time (in arrival order), instead of
+every thread's connection contending for SQLite's write lock:
+    - a session's first write (flush, or non-SELECT statement) waits for its turn, then opens a SAVEPOINT on the writer connection; the session's reads go to the writer connection too until it commits, so it reads its own writes
+    - its commit releases the savepoint and hands the turn over; the actual COMMIT is done by a committer thread, once for every transaction released while the previous COMMIT ran (group commit); session.commit() returns when its group is committed
+    - a rollback (or a session closed without committing) rolls back to the savepoint, without affecting the rest of the group
+Writes from other processes still contend for the lock (BEGIN IMMEDIATE,
+waiting up to the busy timeout).
+"""
+# python packages
+import threading
+# flask extensions
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.sql.expression import SelectBase
+
+
+PRODUCTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000, # KiB
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000, # ms
+}
+
+
+class WriteQueueError(Exception):
+    pass
+
+
+class SQLiteProfile():
+    """
+    Flask extension applying the SQLite profile of an app.
+
+        Notes
+            Initialized after `db` (and the read replicas), before anything creates the engines.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app import db
+        production = app.config['SQLITE_PROFILE'] == 'production'
+        if not production and not app.config['SQLITE_WRITE_QUEUE']:
+            return None
+        if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+            return None
+        pragmas = dict(PRODUCTION_PRAGMAS, **app.config['SQLITE_PRAGMAS']) \
+            if production else {}
+        if production and not is_memory(app.config['SQLALCHEMY_DATABASE_URI']):
+            options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+            options.setdefault('poolclass', QueuePool)
+            options.setdefault('pool_size', app.config['SQLITE_POOL_SIZE'])
+            options.setdefault('max_overflow', app.config['SQLITE_POOL_SIZE'])
+            connect_args = dict(options.get('connect_args') or {})
+            connect_args.setdefault('check_same_thread', False)
+            options['connect_args'] = connect_args
+            app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+        binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or {})
+        for bind in binds:
+            engine = db.get_engine(app, bind=bind)
+            if engine.dialect.name == 'sqlite' and pragmas:
+                event.listen(engine, 'connect', set_pragmas(pragmas))
+        if app.config['SQLITE_WRITE_QUEUE']:
+            engine = db.get_engine(app)
+            if is_memory(str(engine.url)):
+                raise ValueError('SQLITE_WRITE_QUEUE needs a database file')
+            app.extensions['sqlite_writer'] = _Writer(engine.url, pragmas)
+
+
+def is_memory(uri):
+    return uri in ('sqlite://', 'sqlite:///:memory:')
+
+
+def set_pragmas(pragmas):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+    return on_connect
+
+
+class _Writer():
+    def __init__(self, url, pragmas):
+        # note: autocommit at the driver level (isolation_level=None) and
+        # explicit BEGIN IMMEDIATE, so that SAVEPOINTs nest inside the
+        # group's transaction and the write lock is taken up front
+        self.engine = create_engine(url, poolclass=StaticPool,
+            connect_args={'check_same_thread': False, 'isolation_level': None})
+        event.listen(self.engine, 'connect',
+            set_pragmas(dict({'busy_timeout': 5000}, **pragmas)))
+        event.listen(self.engine, 'begin',
+            lambda connection: connection.execute('BEGIN IMMEDIATE'))
+        self.connection = self.engine.connect()
+        self.transaction = None # the group's, while it's open
+        self.condition = threading.Condition()
+        # FIFO turns on the writer connection
+        self.next_ticket = 0
+        self.serving = 0
+        # groups: transactions released into the open group are committed
+        # together; group n is done once committed >= n
+        self.group = 1
+        self.released = 0 # transactions released into the open group
+        self.committed = 0
+        self.errors = {} # group -> exception of its COMMIT
+        self.thread = threading.Thread(target=self.run, daemon=True,
+            name='sqlite-writer')
+        self.thread.start()
+
+    def take_turn(self):
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while ticket != self.serving:
+                self.condition.wait()
+
+    def end_turn(self):
+        with self.condition:
+            self.serving += 1
+            self.condition.notify_all()
+
+    def begin(self):
+        """
+        Wait for our turn, then open a savepoint in the group's transaction. Returns the savepoint.
+        """
+        self.take_turn()
+        try:
+            if self.transaction is None:
+                self.transaction = self.connection.begin()
+            return self.connection.begin_nested()
+        except Exception:
+            self.end_turn()
+            raise
+
+    def commit(self, savepoint):
+        """
+        Release the savepoint into the group, and wait until the group is committed.
+
+            Raises
+                WriteQueueError -- if the group's COMMIT failed (its writes are lost)
+        """
+        try:
+            savepoint.commit()
+        except Exception:
+            self.rollback(savepoint)
+            raise
+        with self.condition:
+            group = self.group
+            self.released += 1
+            self.serving += 1
+            self.condition.notify_all()
+            while self.committed < group:
+                self.condition.wait()
+            error = self.errors.get(group)
+        if error is not None:
+            raise WriteQueueError(f'group commit failed: {error!r}')
+
+    def rollback(self, savepoint):
+        try:
+            if savepoint.is_active:
+                savepoint.rollback()
+        finally:
+            self.end_turn()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.released:
+                    self.condition.wait()
+            # queue behind the writers already waiting: they join the group
+            self.take_turn()
+            with self.condition:
+                group = self.group
+                self.group += 1
+                self.released = 0
+            error = None
+            try:
+                self.transaction.commit()
+            except Exception as e:
+                error = e
+                try:
+                    self.transaction.rollback()
+                except Exception:
+                    pass
+            self.transaction = None
+            with self.condition:
+                if error is not None:
+                    self.errors[group] = error
+                self.errors.pop(group - 100, None)
+                self.committed = group
+                self.serving += 1
+                self.condition.notify_all()
+
+
+def writer_bind(session, clause):
+    """
+    Returns the writer connection if the session's statement must go through the write queue (i.e., it writes, or the session already wrote), else None.
+    """
+    writer = session.app.extensions.get('sqlite_writer')
+    if writer is None:
+        return None
+    if 'sqlite_savepoint' not in session.info:
+        if isinstance(clause, SelectBase) and not session._flushing and \
+                getattr(clause, '_for_update_arg', None) is None:
+            return None
+        session.info['sqlite_savepoint'] = writer.begin()
+    return writer.connection
+
+
+def after_commit(session):
+    """
+    Release the session's savepoint into the group commit, and wait for it.
+
+        Notes
+            Listens before the other after_commit handlers, so that they run once the data is committed.
+    """
+    savepoint = session.info.pop('sqlite_savepoint', None)
+    if savepoint is not None:
+        session.app.extensions['sqlite_writer'].commit(savepoint)
+
+
+def after_transaction_end(session, transaction):
+    """
+    Roll back to the savepoint of a session whose transaction ended without committing.
+    """
+    if transaction.parent is not None:
+        return None
+    savepoint = session.info.pop('sqlite_savepoint', None)
+    if savepoint is not None:
+        session.app.extensions['sqlite_writer'].rollback(savepoint)
@@ -0,0 +1,433 @@
+"""
+Materialized home timelines (fan-out-on-write).
+
+When TIMELINE_MODE is 'fanout', every new post is pushed into the `timeline`
+table once per follower (plus once for its author), so reading a home
+timeline is an ordered index range scan on (user_id, timestamp) rather than
+the join + UNION + sort done by User.feed_posts() in 'query' mode.
+
+When TIMELINE_MODE is 'hybrid', accounts with more than
+TIMELINE_CELEBRITY_THRESHOLD followers are tagged as celebrities. Their posts
+are not pushed (one post would mean one timeline row per follower); instead,
+each reader's pushed timeline is k-way merged at read time with the recent
+posts of the celebrities they follow. Tags are updated in the background
+(see retag()), not by the follows that cross a threshold.
+"""
+# python packages
+import heapq
+import threading
+import time
+from itertools import islice
+# flask extensions
+from flask import current_app
+from flask_sqlalchemy import Pagination
+# local modules
+from app import db
+from app.pagination import make_page, post_key
+
+
+# Materialized timeline table (`entries`): one row per (reader, post)
+# note: the post's timestamp is copied onto the row so that a reader's
+# timeline can be returned already ordered straight from the index.
+entries = db.Table(
+    'timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'),
+        primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'),
+        primary_key=True),
+    db.Column('timestamp', db.DateTime),
+    db.Index('ix_timeline_user_id_timestamp_post_id',
+        'user_id', 'timestamp', 'post_id'),
+    db.Index('ix_timeline_post_id', 'post_id'))
+
+
+def fanout_enabled():
+    """
+    Returns True if home timelines are materialized (i.e., are read from and written to the timeline table).
+    """
+    return current_app.config['TIMELINE_MODE'] in ('fanout', 'hybrid')
+
+
+def hybrid_enabled():
+    """
+    Returns True if celebrities' posts are pulled at read time rather than pushed.
+    """
+    return current_app.config['TIMELINE_MODE'] == 'hybrid'
+
+
+def celebrity_thresholds():
+    """
+    Returns the follower counts above which users are promoted to celebrities, and at or under which they are demoted.
+    """
+    promote = current_app.config['TIMELINE_CELEBRITY_THRESHOLD']
+    demote = current_app.config['TIMELINE_CELEBRITY_DEMOTE_THRESHOLD']
+    return promote, promote * 4 // 5 if demote is None else demote
+
+
+class MergedFeed():
+    """
+    A home timeline assembled at read time from several individually-ordered post queries (the reader's pushed timeline plus one query per followed celebrity).
+
+    Exposes the subset of the Query interface that callers of User.feed_posts() use: all(), count(), options(), records(), paginate(), offset_paginate(), keyset_paginate() and iteration.
+
+        Notes
+            Each source is already ordered newest-first by its index, so the sources are combined with a k-way merge (heapq.merge) and each one only needs to be read up to the end of the requested page.
+    """
+    def __init__(self, queries):
+        self.queries = queries
+
+    def _merge(self, limit=None, sources=None, newest_first=True):
+        if sources is None:
+            sources = [query.limit(limit) if limit else query
+                for query in self.queries]
+        seen_ids = set()
+        merged = heapq.merge(*sources, key=post_key, reverse=newest_first)
+        for post in merged:
+            if post.id not in seen_ids:
+                seen_ids.add(post.id)
+                yield post
+
+    def __iter__(self):
+        return self._merge()
+
+    def options(self, *options):
+        return MergedFeed([query.options(*options) for query in self.queries])
+
+    def records(self):
+        return MergedFeed([query.records() for query in self.queries])
+
+    def all(self):
+        return list(self._merge())
+
+    def count(self):
+        # note: the sources can overlap (e.g., a celebrity's posts pushed
+        # before they were retagged), so count the ids of their union
+        from app.models import Post
+        ids = db.union(*[query.order_by(None).with_entities(Post.id).statement
+            for query in self.queries])
+        return self.queries[0].session.execute(db.select([db.func.count()]).
+            select_from(ids.alias('ids'))).scalar()
+
+    def paginate(self, page, per_page, error_out=True):
+        """
+        Returns a flask_sqlalchemy Pagination for the page, like Query.paginate().
+        """
+        start = (page - 1) * per_page
+        items = list(islice(self._merge(limit=start + per_page),
+            start, start + per_page))
+        return Pagination(None, page, per_page, self.count(), items)
+
+    def offset_paginate(self, page, per_page):
+        """
+        Returns the posts of the page and whether there's a next one, like KeysetQuery.offset_paginate().
+        """
+        start = (page - 1) * per_page
+        rows = list(islice(self._merge(limit=start + per_page + 1),
+            start, start + per_page + 1))
+        return rows[:per_page], len(rows) > per_page
+
+    def keyset_paginate(self, per_page, after=None, before=None):
+        """
+        Returns a KeysetPage for the page past the cursor, like KeysetQuery.keyset_paginate().
+        """
+        windows = [query.keyset_window(per_page, after, before)
+            for query in self.queries]
+        rows = list(islice(self._merge(sources=windows,
+            newest_first=before is None), per_page + 1))
+        return make_page(rows, per_page, after, before)
+
+
+def feed(user):
+    """
+    Returns the user's materialized home timeline, newest first.
+
+        Returns
+            Query ('fanout' mode, or 'hybrid' mode when the user follows no celebrities) or MergedFeed ('hybrid' mode otherwise)
+    """
+    from app.models import Post, User
+    pushed_posts = Post.query. \
+        join(entries, entries.c.post_id == Post.id). \
+            filter(entries.c.user_id == user.id). \
+                order_by(entries.c.timestamp.desc(), entries.c.post_id.desc()). \
+                    keyset_by(entries.c.timestamp, entries.c.post_id)
+    if not hybrid_enabled():
+        return pushed_posts
+    celebrity_ids = [followed.id for followed in
+        user.followed.filter(User.is_celebrity == db.true())]
+    if not celebrity_ids:
+        return pushed_posts
+    pulled_posts = [Post.query.filter_by(user_id=celebrity_id). \
+        order_by(Post.timestamp.desc(), Post.id.desc())
+        for celebrity_id in celebrity_ids]
+    return MergedFeed([pushed_posts] + pulled_posts)
+
+
+def push_posts(session, posts):
+    """
+    Fan a batch of newly-flushed posts out to the timelines of their authors and of their authors' followers.
+
+        Params
+            session (obj)
+                SQLAlchemy session the posts were flushed in. The inserts run inside the session's transaction so they commit (or roll back) together with the posts.
+            posts (list)
+                Post objects that have been assigned an id.
+
+        Returns
+            None
+
+        Notes
+            One INSERT ... SELECT per post: the follower ids never leave the database. In 'hybrid' mode, celebrities' posts only go to their own timeline.
+    """
+    from app.models import followers
+    for post in posts:
+        session.execute(entries.insert().values(
+            user_id=post.user_id, post_id=post.id, timestamp=post.timestamp))
+        if hybrid_enabled() and post.author.is_celebrity:
+            continue
+        session.execute(entries.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([
+                followers.c.follower_id,
+                db.literal(post.id),
+                db.literal(post.timestamp, db.DateTime)]).
+            where(followers.c.followed_id == post.user_id)))
+
+
+def remove_posts(session, posts):
+    """
+    Remove deleted posts from every timeline they were pushed to.
+    """
+    ids = [post.id for post in posts]
+    session.execute(entries.delete().where(entries.c.post_id.in_(ids)))
+
+
+def backfill(session, follower_id, followed_id):
+    """
+    Copy all of a followed user's existing posts into the follower's timeline.
+    """
+    from app.models import Post
+    session.execute(entries.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        db.select([db.literal(follower_id), Post.id, Post.timestamp]).
+        where(Post.user_id == followed_id)))
+
+
+def evict(session, follower_id, followed_id):
+    """
+    Remove all of an unfollowed user's posts from the former follower's timeline.
+    """
+    from app.models import Post
+    followed_posts = db.select([Post.id]).where(Post.user_id == followed_id)
+    session.execute(entries.delete().where(db.and_(
+        entries.c.user_id == follower_id,
+        entries.c.post_id.in_(followed_posts))))
+
+
+def push_user(session, user_id):
+    """
+    Push all of a user's posts to the timelines of all of their followers.
+    """
+    from app.models import Post, followers
+    session.execute(entries.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        db.select([followers.c.follower_id, Post.id, Post.timestamp]).
+        select_from(followers.join(Post,
+            followers.c.followed_id == Post.user_id)).
+        where(followers.c.followed_id == user_id)))
+
+
+def unpush_user(session, user_id):
+    """
+    Remove all of a user's posts from every timeline except their own.
+    """
+    from app.models import Post
+    user_posts = db.select([Post.id]).where(Post.user_id == user_id)
+    session.execute(entries.delete().where(db.and_(
+        entries.c.user_id != user_id,
+        entries.c.post_id.in_(user_posts))))
+
+
+def follow(session, follower, followed):
+    """
+    Update timelines after `follower` starts following `followed`. Called by User.follow().
+
+        Notes
+            In 'hybrid' mode, a celebrity's posts are pulled at read time, so there is nothing to backfill. A follow that takes `followed` over the celebrity threshold doesn't retag them: retag() does, out of the request.
+    """
+    if hybrid_enabled() and followed.is_celebrity:
+        return None
+    backfill(session, follower.id, followed.id)
+
+
+def unfollow(session, follower, followed):
+    """
+    Update timelines after `follower` stops following `followed`. Called by User.unfollow().
+    """
+    if hybrid_enabled() and followed.is_celebrity:
+        return None
+    evict(session, follower.id, followed.id)
+
+
+def retag(session):
+    """
+    Promote the users with more followers than the celebrity threshold and demote those at or under the demote threshold, moving their posts out of (or back into) their followers' timelines.
+
+        Returns
+            promoted (list) -- ids of the new celebrities
+            demoted (list) -- ids of the former ones
+
+        Notes
+            The two thresholds keep an account whose follower count hovers around one of them from having all of its posts pushed and removed again with every follow. Run by the app's retag worker every TIMELINE_RETAG_INTERVAL seconds, or by `flask timeline retag`.
+    """
+    from app.models import User
+    promote, demote = celebrity_thresholds()
+    changes = (
+        (True, User.followers_count > promote, unpush_user),
+        (False, User.followers_count <= demote, push_user))
+    results = []
+    for tag, crossed, move_posts in changes:
+        ids = [id for id, in session.query(User.id).filter(
+            User.is_celebrity == (not tag), crossed)]
+        retagged = []
+        for id in ids:
+            # note: only if still untagged, so that concurrent retags don't
+            # both move the posts
+            if session.execute(User.__table__.update().
+                    where(db.and_(User.id == id, User.is_celebrity == (not tag))).
+                    values(is_celebrity=tag)).rowcount:
+                move_posts(session, id)
+                retagged.append(id)
+        results.append(retagged)
+    return tuple(results)
+
+
+def retag_all(session):
+    """
+    Recompute every user's celebrity tag from their follower count (without moving any posts; see rebuild()).
+    """
+    from app.models import User, followers
+    promote, demote = celebrity_thresholds()
+    follower_count = db.select([db.func.count()]). \
+        where(followers.c.followed_id == User.id).as_scalar()
+    session.execute(User.__table__.update().values(is_celebrity=db.case([
+        (follower_count > promote, db.true()),
+        (follower_count <= demote, db.false())],
+        else_=User.is_celebrity)))
+
+
+def rebuild(session, user_id=None):
+    """
+    Recompute materialized timelines from the followers and post tables.
+
+        Params
+            session (obj)
+                SQLAlchemy session
+            user_id (int)
+                Only rebuild this user's timeline. If None, rebuild every timeline (and, in 'hybrid' mode, every celebrity tag).
+
+        Returns
+            None
+
+        Notes
+            Used to backfill timelines when switching an existing database to 'fanout' or 'hybrid' mode and to repair drift.
+    """
+    from app.models import Post, User, followers
+    if user_id is None:
+        session.execute(entries.delete())
+        if hybrid_enabled():
+            retag_all(session)
+    else:
+        session.execute(entries.delete().where(entries.c.user_id == user_id))
+    followed_posts = db.select([followers.c.follower_id, Post.id, Post.timestamp]). \
+        select_from(followers.join(Post, followers.c.followed_id == Post.user_id))
+    own_posts = db.select([Post.user_id, Post.id, Post.timestamp])
+    if hybrid_enabled():
+        celebrity_ids = db.select([User.id]).where(User.is_celebrity == db.true())
+        followed_posts = followed_posts.where(Post.user_id.notin_(celebrity_ids))
+    if user_id is not None:
+        followed_posts = followed_posts.where(followers.c.follower_id == user_id)
+        own_posts = own_posts.where(Post.user_id == user_id)
+    for select in (followed_posts, own_posts):
+        session.execute(entries.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], select))
+
+
+def before_flush(session, flush_context, instances):
+    """
+    Remove posts that are about to be deleted from every timeline they were pushed to (ahead of the DELETE so the foreign keys stay valid).
+    """
+    if not fanout_enabled():
+        return None
+    from app.models import Post
+    deleted_posts = [obj for obj in session.deleted if isinstance(obj, Post)]
+    if deleted_posts:
+        remove_posts(session, deleted_posts)
+
+
+def after_flush(session, flush_context):
+    """
+    Push newly-inserted posts into timelines within the flush that wrote them.
+
+        Notes
+            after_flush is used rather than before_commit because the post ids are only known once the INSERTs have run. The session's `new` collection still holds its pre-flush contents at this point.
+    """
+    if not fanout_enabled():
+        return None
+    from app.models import Post
+    new_posts = [obj for obj in session.new if isinstance(obj, Post)]
+    if new_posts:
+        push_posts(session, new_posts)
+
+
+class CelebrityRetagger():
+    """
+    Flask extension running retag() every TIMELINE_RETAG_INTERVAL seconds in a background thread, in 'hybrid' mode.
+
+        Notes
+            The thread starts with the app's first request. Set TIMELINE_RETAG_INTERVAL to 0 to run none (and retag with `flask timeline retag`).
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        worker = _Retagger(app)
+        app.extensions['celebrity_retagger'] = worker
+        app.before_first_request(worker.start)
+
+
+class _Retagger():
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['TIMELINE_RETAG_INTERVAL']
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.interval <= 0 or \
+                self.app.config['TIMELINE_MODE'] != 'hybrid':
+            return None
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                    name='celebrity-retagger', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.retag()
+            except Exception:
+                self.app.logger.exception('celebrity retag failed')
+
+    def retag(self):
+        with self.app.app_context():
+            try:
+                retag(db.session)
+                db.session.commit()
+            finally:
+                db.session.remove()
+
+
+celebrity_retagger = CelebrityRetagger()
@@ -0,0 +1,261 @@
+"""
+Cache of the users loaded from the session cookie (Flask-Login's
+user_loader), so that an authenticated request gets its current_user without
+a SELECT.
+
+The cache holds the column values of each user (except the password hash,
+which is loaded on access) for up to USER_CACHE_TTL seconds; a hit is turned
+back into a User attached to the request's session without querying (its
+relationships, e.g. followed, still load on access). Entries are evicted once
+a transaction that changed the user commits: profile edits, password
+changes, follows/unfollows (counters) and posts (posts_count) go through the
+ORM and are picked up in after_flush; the last_seen write-behind buffer
+evicts the users it flushes (see app/presence.py).
+
+The entries live in one of two backends:
+    LocalBackend -- an LRU of USER_CACHE_SIZE users in this process
+    RedisBackend -- a redis server shared by all processes (USER_CACHE_URL; needs the `redis` package)
+With LocalBackend, a process only sees the evictions of its own writes, so a
+user changed by another process can be stale for up to USER_CACHE_TTL
+seconds. Requests that may write (unsafe methods, e.g. the profile form's
+POST) therefore skip the cache and load the user from the primary, and the
+profile version is bumped in SQL rather than from the loaded value (see
+User.bump_profile_version), so a stale entry is never written back. Misses
+are read from the primary too: a replica could still hold the row a commit
+just evicted, and cache it for another TTL.
+"""
+# python packages
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+# flask extensions
+from flask import current_app, has_request_context, request
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+# local modules
+from app import db
+from app.replicas import SAFE_METHODS, use_primary
+
+
+# columns loaded on access instead (they're only needed to log in)
+UNCACHED_COLUMNS = ('password_hash',)
+
+
+class LocalBackend():
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict() # user_id -> (expiry, values), oldest first
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return entry[1]
+
+    def set(self, user_id, values, ttl):
+        with self.lock:
+            self.entries[user_id] = (time.monotonic() + ttl, values)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisBackend():
+    """
+    Shared backend: each user is a redis string (JSON; datetimes as ISO 8601) that expires after the TTL.
+    """
+    prefix = 'user-cache:'
+
+    def __init__(self, client, datetime_columns):
+        self.client = client
+        self.datetime_columns = datetime_columns
+
+    def get(self, user_id):
+        value = self.client.get(f'{self.prefix}{user_id}')
+        if value is None:
+            return None
+        values = json.loads(value)
+        for column in self.datetime_columns:
+            if values.get(column) is not None:
+                values[column] = datetime.fromisoformat(values[column])
+        return values
+
+    def set(self, user_id, values, ttl):
+        self.client.set(f'{self.prefix}{user_id}', json.dumps({column:
+            value.isoformat() if isinstance(value, datetime) else value
+            for column, value in values.items()}), ex=ttl)
+
+    def delete(self, user_ids):
+        if user_ids:
+            self.client.delete(*[f'{self.prefix}{user_id}'
+                for user_id in user_ids])
+
+    def __len__(self):
+        return 0 # not tracked per process
+
+
+class UserCache():
+    """
+    Flask extension holding the user cache of an app.
+
+        Notes
+            Set USER_CACHE_SIZE or USER_CACHE_TTL to 0 to disable the cache. Backend errors are logged and treated as misses: the cache never fails a request.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['user_cache'] = _Cache(app)
+
+    def _cache(self):
+        return current_app.extensions['user_cache']
+
+    def load(self, user_id):
+        """
+        Returns the user with this id (attached to db.session), or None if there's no such user.
+        """
+        return self._cache().load(user_id)
+
+    def evict(self, user_ids):
+        """
+        Drop the cached users with these ids (once their changes are committed).
+        """
+        self._cache().evict(user_ids)
+
+    def stats(self):
+        """
+        Returns the cache statistics of this process: hits, misses, evictions, errors (backend failures), size (users held; 0 for a shared backend).
+        """
+        return self._cache().stats()
+
+
+class _Cache():
+    def __init__(self, app):
+        from app.models import User
+        self.app = app
+        self.ttl = app.config['USER_CACHE_TTL']
+        self.enabled = app.config['USER_CACHE_SIZE'] > 0 and self.ttl > 0
+        self.columns = [attr.key for attr in db.inspect(User).column_attrs
+            if attr.key not in UNCACHED_COLUMNS]
+        if app.config['USER_CACHE_URL']:
+            from redis import Redis
+            self.backend = RedisBackend(
+                Redis.from_url(app.config['USER_CACHE_URL']),
+                [attr.key for attr in db.inspect(User).column_attrs
+                    if isinstance(attr.columns[0].type, db.DateTime)])
+        else:
+            self.backend = LocalBackend(app.config['USER_CACHE_SIZE'])
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0, 'errors': 0}
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def load(self, user_id):
+        from app.models import User
+        if not self.enabled:
+            return User.query.get(user_id)
+        if has_request_context() and request.method not in SAFE_METHODS:
+            # note: the request may write the user: start from its row
+            with use_primary():
+                return User.query.get(user_id)
+        try:
+            values = self.backend.get(user_id)
+        except Exception:
+            self.app.logger.exception('user cache: lookup failed')
+            self.count('errors')
+            values = None
+        if values is not None:
+            self.count('hits')
+            return self.attach(values)
+        self.count('misses')
+        with use_primary():
+            user = User.query.get(user_id)
+        if user is not None:
+            try:
+                self.backend.set(user_id, {column: getattr(user, column)
+                    for column in self.columns}, self.ttl)
+            except Exception:
+                self.app.logger.exception('user cache: store failed')
+                self.count('errors')
+        return user
+
+    def attach(self, values):
+        """
+        Returns a User with the cached values, attached to the session as if it had been loaded (the session's own copy, if it already has one).
+        """
+        from app.models import User
+        mapper = db.inspect(User)
+        user = db.session.identity_map.get(
+            mapper.identity_key_from_primary_key([values['id']]))
+        if user is not None:
+            return user
+        user = mapper.class_manager.new_instance()
+        for column, value in values.items():
+            set_committed_value(user, column, value)
+        # note: the uncached columns are expired, i.e., loaded on access
+        make_transient_to_detached(user)
+        db.session.add(user)
+        return user
+
+    def evict(self, user_ids):
+        if not self.enabled or not user_ids:
+            return None
+        try:
+            self.backend.delete(user_ids)
+        except Exception:
+            self.app.logger.exception('user cache: eviction failed')
+            self.count('errors')
+            return None
+        self.count('evictions', len(user_ids))
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        stats['size'] = len(self.backend)
+        return stats
+
+
+def after_flush(session, flush_context):
+    """
+    Record the users changed by a flush (directly, or through the counters of their posts), for after_commit() to evict.
+    """
+    from app.models import Post, User
+    user_ids = session.info.setdefault('user_cache_evict', set())
+    for obj in session.dirty | session.deleted:
+        if isinstance(obj, User):
+            user_ids.add(obj.id)
+    for obj in session.new | session.deleted:
+        if isinstance(obj, Post) and obj.user_id is not None:
+            user_ids.add(obj.user_id)
+
+
+def after_commit(session):
+    user_ids = session.info.pop('user_cache_evict', None)
+    if user_ids:
+        session.app.extensions['user_cache'].evict(list(user_ids))
+
+
+def after_rollback(session):
+    session.info.pop('user_cache_evict', None)
+
+
+user_cache = UserCache()
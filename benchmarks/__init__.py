@@ -0,0 +1,15 @@
+"""
+Offline benchmarks for MiniTwitter. Each module is runnable on its own, e.g.:
+
+    python -m benchmarks.fanout --help
+
+All benchmarks run against a throwaway SQLite database, filled by the seeded
+synthetic graph generator (benchmarks/generator.py). benchmarks.suite times
+the model methods and routes; it, benchmarks.fanout,
+benchmarks.concurrency (concurrent SQLite writers), benchmarks.hashing
+(reads during a login burst), benchmarks.compression (bytes and latency
+of a compressed timeline page), benchmarks.records (post lists read as
+records vs ORM objects) and benchmarks.live (idle timelines waiting for new
+posts) write their results as JSON with --output, and benchmarks.compare
+diffs two such files (e.g., runs against two commits).
+"""
@@ -0,0 +1,74 @@
+"""
+Compare two benchmark result files (written with --output), e.g. runs of
+benchmarks.suite against two commits:
+
+    python -m benchmarks.compare base.json run.json --metric p99_ms
+
+Prints each benchmark's latency in both runs and the relative change, and
+warns if the runs' parameters differ (their numbers aren't comparable then).
+Exits with status 1 if a benchmark got slower than --threshold percent.
+"""
+# python packages
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(base, run, metric):
+    """
+    Returns [(name, base value, run value, change in percent)] for the benchmarks both runs have (the value is None if a run lacks it).
+    """
+    rows = []
+    names = sorted(set(base['results']) | set(run['results']))
+    for name in names:
+        before = base['results'].get(name, {})
+        after = run['results'].get(name, {})
+        if not isinstance(before, dict) or not isinstance(after, dict) or \
+                metric not in before.keys() | after.keys():
+            continue
+        before, after = before.get(metric), after.get(metric)
+        change = (after - before) / before * 100 \
+            if before and after is not None else None
+        rows.append((name, before, after, change))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('run')
+    parser.add_argument('--metric', default='p50_ms',
+        choices=['p50_ms', 'p90_ms', 'p99_ms', 'mean_ms'])
+    parser.add_argument('--threshold', type=float, default=None,
+        help='fail if a benchmark got slower by more than this many percent')
+    args = parser.parse_args()
+
+    base, run = load(args.base), load(args.run)
+    if base['params'] != run['params']:
+        print(f"warning: parameters differ: {base['params']} vs "
+              f"{run['params']}", file=sys.stderr)
+    print(f"base: {base.get('commit')}  run: {run.get('commit')}  "
+          f"({args.metric})")
+    regressions = 0
+    for name, before, after, change in compare(base, run, args.metric):
+        before = f'{before:.2f}' if before is not None else '-'
+        after = f'{after:.2f}' if after is not None else '-'
+        flag = ''
+        if change is not None and args.threshold is not None and \
+                change > args.threshold:
+            flag = '  regression'
+            regressions += 1
+        change = f'{change:+.1f}%' if change is not None else ''
+        print(f'{name:<22} {before:>10} {after:>10} {change:>9}{flag}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
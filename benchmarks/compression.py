@@ -0,0 +1,132 @@
+"""
+Compression benchmark: bytes sent and latency of a 25-post home timeline
+(/index, POSTS_PER_PAGE = 25), uncompressed and with each encoding the app
+offers (gzip, and br with the `brotli` package installed; see
+app/compression.py).
+
+Server latency is timed through the test client (compression included);
+transfer time is estimated for a link of --bandwidth-mbps, and the total is
+their sum. Also reports the sizes of Flask-Bootstrap's local static files
+against their precompressed versions (as `flask assets compress` writes them;
+computed in memory here).
+
+    python -m benchmarks.compression --users 2000 --posts 50000 --bandwidth-mbps 5
+"""
+# python packages
+import argparse
+import gzip
+import os
+import random
+from itertools import cycle
+# local modules
+from benchmarks.generator import generate
+from benchmarks.harness import bench_app, percentile, summarize, \
+    time_calls, write_results
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Flask-Bootstrap's files that the pages load with BOOTSTRAP_SERVE_LOCAL set
+STATIC_FILES = ('css/bootstrap.min.css', 'js/bootstrap.min.js',
+    'jquery.min.js')
+
+
+def timeline_results(app, graph, args):
+    """
+    Returns {encoding: (bytes, server latencies)} of /index for random readers.
+    """
+    client = app.test_client()
+    rng = random.Random(args.seed)
+    readers = [rng.choice(graph.ids[:len(graph.ids) // 2])
+        for _ in range(args.samples)]
+    encodings = ['identity'] + \
+        app.extensions['compression'].encodings[::-1]
+    results = {}
+    for encoding in encodings:
+        sizes = []
+        queue = cycle(readers)
+
+        def get():
+            with client.session_transaction() as session:
+                session['user_id'] = str(next(queue))
+                session['_fresh'] = True
+            response = client.get('/index',
+                headers={'Accept-Encoding': encoding})
+            if response.status_code != 200 or \
+                    response.headers.get('Content-Encoding',
+                        'identity') != encoding:
+                raise RuntimeError(f'GET /index ({encoding}): '
+                    f'{response.status_code}')
+            sizes.append(len(response.get_data()))
+
+        latencies = time_calls(get, args.samples, warmup=args.warmup)
+        results[encoding] = (sizes[args.warmup:], latencies)
+    return results
+
+
+def static_results(app):
+    """
+    Returns {file: {encoding: bytes}} of Flask-Bootstrap's static files, compressed as by compress_static.
+    """
+    folder = app.blueprints['bootstrap'].static_folder
+    results = {}
+    for name in STATIC_FILES:
+        with open(os.path.join(folder, name), 'rb') as f:
+            data = f.read()
+        sizes = {'identity': len(data), 'gzip': len(gzip.compress(data, 9))}
+        if brotli is not None:
+            sizes['br'] = len(brotli.compress(data, quality=11))
+        results[name] = sizes
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--posts', type=int, default=50000,
+        help='total posts')
+    parser.add_argument('--follows', type=int, default=20,
+        help='mean accounts followed per user')
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--bandwidth-mbps', type=float, default=5.0,
+        help='link speed of the estimated transfer times')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {}
+    bytes_per_second = args.bandwidth_mbps * 1e6 / 8
+    with bench_app(POSTS_PER_PAGE=25, CONDITIONAL_GET=False) as app:
+        graph = generate(args.users, args.posts, follows=args.follows,
+            seed=args.seed)
+        print(f"{'/index':<10} {'bytes':>8} {'server p50':>11} "
+              f"{'transfer':>9} {'total':>9}   (ms)")
+        for encoding, (sizes, latencies) in \
+                timeline_results(app, graph, args).items():
+            size = sum(sizes) / len(sizes)
+            transfer = size / bytes_per_second
+            results[f'index.{encoding}'] = dict(summarize(latencies),
+                bytes=round(size), transfer_ms=round(transfer * 1000, 3))
+            print(f'{encoding:<10} {size:>8.0f} '
+                  f'{percentile(latencies, 50) * 1000:>11.2f} '
+                  f'{transfer * 1000:>9.2f} '
+                  f'{(percentile(latencies, 50) + transfer) * 1000:>9.2f}')
+        print(f"\n{'static':<22} " + ' '.join(f'{encoding:>9}'
+            for encoding in ('identity', 'gzip', 'br')) + '   (bytes)')
+        for name, sizes in static_results(app).items():
+            results[f'static.{name}'] = sizes
+            print(f'{name:<22} ' + ' '.join(f"{sizes.get(encoding, '-'):>9}"
+                for encoding in ('identity', 'gzip', 'br')))
+
+    if args.output:
+        params = {name: value for name, value in vars(args).items()
+            if name != 'output'}
+        write_results(args.output, 'compression', params, results)
+
+
+if __name__ == '__main__':
+    main()
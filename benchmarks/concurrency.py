@@ -0,0 +1,139 @@
+"""
+SQLite concurrency benchmark: write throughput and commit latency of
+concurrent writer threads (each creating posts, one commit per post), with
+reader threads loading home timelines alongside, for each setup:
+
+    default     -- the drivers' defaults (rollback journal, synchronous=FULL, a connection per checkout)
+    production  -- SQLITE_PROFILE = 'production' (WAL, tuned pragmas, pooled connections)
+    queue       -- 'production' plus SQLITE_WRITE_QUEUE (one writer connection, group commit)
+
+    python -m benchmarks.concurrency --writers 8 --writes 200 --readers 2
+
+Writes that fail (e.g. "database is locked" once the busy timeout runs out)
+are counted as errors, not retried. See app/sqlitedb.py.
+"""
+# python packages
+import argparse
+import random
+import threading
+import time
+# local modules
+from app import db
+from app.models import User, Post
+from benchmarks.generator import generate
+from benchmarks.harness import bench_app, percentile, summarize, \
+    write_results
+
+
+SETUPS = {
+    'default': {},
+    'production': {'SQLITE_PROFILE': 'production'},
+    'queue': {'SQLITE_PROFILE': 'production', 'SQLITE_WRITE_QUEUE': True}}
+
+
+def run_setup(setup, args):
+    """
+    Generate a fresh database with the setup's config and run the writer and reader threads against it.
+
+        Returns
+            latencies (list) -- seconds per successful post commit
+            elapsed (float) -- seconds until the last writer finished
+            errors (int) -- failed writes
+            reads (int) -- timelines loaded meanwhile
+    """
+    with bench_app(**SETUPS[setup]) as app:
+        ids = generate(args.users, args.users * args.posts,
+            follows=args.follows, seed=args.seed).ids
+        db.session.remove()
+        latencies, errors, reads = [], [], []
+        writing = threading.Event()
+        barrier = threading.Barrier(args.writers + args.readers + 1)
+
+        def writer(number):
+            rng = random.Random(args.seed + number)
+            with app.app_context():
+                barrier.wait()
+                for n in range(args.writes):
+                    author = User.query.get(rng.choice(ids))
+                    start = time.perf_counter()
+                    try:
+                        db.session.add(Post(body=f'post {number}.{n}',
+                            author=author))
+                        db.session.commit()
+                    except Exception as e:
+                        db.session.rollback()
+                        errors.append(e)
+                        continue
+                    latencies.append(time.perf_counter() - start)
+                db.session.remove()
+
+        def reader(number):
+            rng = random.Random(-args.seed - number)
+            with app.app_context():
+                barrier.wait()
+                while writing.is_set():
+                    User.query.get(rng.choice(ids)).feed_posts().limit(
+                        app.config['POSTS_PER_PAGE']).all()
+                    db.session.commit()
+                    reads.append(1)
+                db.session.remove()
+
+        writing.set()
+        writers = [threading.Thread(target=writer, args=(n,))
+            for n in range(args.writers)]
+        readers = [threading.Thread(target=reader, args=(n,))
+            for n in range(args.readers)]
+        for thread in writers + readers:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in writers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        writing.clear()
+        for thread in readers:
+            thread.join()
+    return latencies, elapsed, len(errors), len(reads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=20,
+        help='mean accounts followed per user')
+    parser.add_argument('--posts', type=int, default=5,
+        help='initial posts per user')
+    parser.add_argument('--writers', type=int, default=8,
+        help='writer threads')
+    parser.add_argument('--writes', type=int, default=200,
+        help='posts created per writer thread')
+    parser.add_argument('--readers', type=int, default=2,
+        help='reader threads (home timelines, while the writers run)')
+    parser.add_argument('--setups', nargs='+', default=list(SETUPS),
+        choices=list(SETUPS))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'setup':<11} {'writes/s':>9} {'p50':>9} {'p99':>9} "
+          f"{'errors':>7} {'reads/s':>8}   (ms)")
+    for setup in args.setups:
+        latencies, elapsed, errors, reads = run_setup(setup, args)
+        results[setup] = dict(summarize(latencies) if latencies else {},
+            writes_per_s=round(len(latencies) / elapsed, 1),
+            reads_per_s=round(reads / elapsed, 1), errors=errors)
+        p50 = percentile(latencies, 50) * 1000 if latencies else 0
+        p99 = percentile(latencies, 99) * 1000 if latencies else 0
+        print(f'{setup:<11} {len(latencies) / elapsed:>9.1f} {p50:>9.2f} '
+              f'{p99:>9.2f} {errors:>7} {reads / elapsed:>8.1f}')
+
+    if args.output:
+        params = {name: value for name, value in vars(args).items()
+            if name != 'output'}
+        write_results(args.output, 'concurrency', params, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Timeline mode benchmark: p50/p99 post-creation latency and home page latency
+for each TIMELINE_MODE ('query', 'fanout', 'hybrid') on a synthetic, skewed
+follow graph (a handful of accounts have most of the followers; see
+benchmarks/generator.py).
+
+    python -m benchmarks.fanout --users 2000 --threshold 200
+"""
+# python packages
+import argparse
+import random
+import time
+# local modules
+from app import db
+from app.models import User, Post
+from benchmarks.generator import generate
+from benchmarks.harness import bench_app, percentile, summarize, \
+    write_results
+
+
+def run_mode(mode, args):
+    """
+    Generate a fresh database in `mode` and time post creation and the home page.
+    """
+    rng = random.Random(args.seed)
+    with bench_app(TIMELINE_MODE=mode,
+            TIMELINE_CELEBRITY_THRESHOLD=args.threshold) as app:
+        ids = generate(args.users, args.users * args.posts,
+            follows=args.follows, seed=args.seed).ids
+        # post creation: mostly uniform authors, plus the top accounts
+        post_latencies = []
+        for n in range(args.samples):
+            author_id = ids[n % 10] if n % 20 == 0 else rng.choice(ids)
+            author = User.query.get(author_id)
+            start = time.perf_counter()
+            db.session.add(Post(body=f'benchmark post {n}', author=author))
+            db.session.commit()
+            post_latencies.append(time.perf_counter() - start)
+        # home page through the test client
+        client = app.test_client()
+        home_latencies = []
+        for n in range(args.samples):
+            with client.session_transaction() as session:
+                session['user_id'] = str(rng.choice(ids))
+                session['_fresh'] = True
+            start = time.perf_counter()
+            response = client.get('/index')
+            home_latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200
+    return post_latencies, home_latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--follows', type=int, default=20,
+        help='mean accounts followed per user')
+    parser.add_argument('--posts', type=int, default=5,
+        help='initial posts per user')
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--threshold', type=int, default=200,
+        help='TIMELINE_CELEBRITY_THRESHOLD for hybrid mode')
+    parser.add_argument('--modes', nargs='+',
+        default=['query', 'fanout', 'hybrid'])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'mode':<8} {'post p50':>10} {'post p99':>10} "
+          f"{'home p50':>10} {'home p99':>10}   (ms)")
+    for mode in args.modes:
+        post_latencies, home_latencies = run_mode(mode, args)
+        results[f'{mode}.create_post'] = summarize(post_latencies)
+        results[f'{mode}.index'] = summarize(home_latencies)
+        print(f'{mode:<8} '
+              f'{percentile(post_latencies, 50) * 1000:>10.2f} '
+              f'{percentile(post_latencies, 99) * 1000:>10.2f} '
+              f'{percentile(home_latencies, 50) * 1000:>10.2f} '
+              f'{percentile(home_latencies, 99) * 1000:>10.2f}')
+
+    if args.output:
+        params = {name: value for name, value in vars(args).items()
+            if name != 'output'}
+        write_results(args.output, 'fanout', params, results)
+
+
+if __name__ == '__main__':
+    main()
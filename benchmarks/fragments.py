@@ -0,0 +1,78 @@
+"""
+Post fragment cache benchmark: p50/p99 time to render the posts of a page
+with the per-post include loop the templates used before, with
+render_posts() and no cache, and with render_posts() and a warm cache.
+
+    python -m benchmarks.fragments --users 200 --per-page 25
+"""
+# python packages
+import argparse
+import random
+import time
+# flask extensions
+from flask import render_template_string
+# local modules
+from app import db
+from app.models import Post
+from benchmarks.generator import generate
+from benchmarks.harness import bench_app, percentile
+
+
+INCLUDE_LOOP = "{% for post in posts %}{% include '_post.html' %}{% endfor %}"
+RENDER_POSTS = "{{ render_posts(posts) }}"
+
+
+def time_renders(source, pages, samples, rng):
+    latencies = []
+    for _ in range(samples):
+        posts = rng.choice(pages)
+        start = time.perf_counter()
+        render_template_string(source, posts=posts)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=10,
+        help='posts per user')
+    parser.add_argument('--per-page', type=int, default=25)
+    parser.add_argument('--pages', type=int, default=20,
+        help='distinct pages rendered')
+    parser.add_argument('--samples', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with bench_app() as app, app.test_request_context('/explore'):
+        generate(args.users, args.users * args.posts, follows=5,
+            seed=args.seed)
+        posts = Post.query.options(db.joinedload(Post.author)). \
+            order_by(Post.timestamp.desc()). \
+                limit(args.pages * args.per_page).all()
+        pages = [posts[i:i + args.per_page]
+            for i in range(0, len(posts), args.per_page)]
+        fragments = app.extensions['post_fragments']
+        size = fragments.size
+        fragments.size = 0 # disabled
+        results = [('include', time_renders(INCLUDE_LOOP, pages,
+            args.samples, rng)),
+            ('no cache', time_renders(RENDER_POSTS, pages,
+                args.samples, rng))]
+        fragments.size = size
+        for page in pages: # warm up
+            render_template_string(RENDER_POSTS, posts=page)
+        results.append(('cached', time_renders(RENDER_POSTS, pages,
+            args.samples, rng)))
+
+    print(f"{args.per_page} posts per page")
+    print(f"{'render':<10} {'p50':>9} {'p99':>9}   (ms)")
+    for name, latencies in results:
+        print(f'{name:<10} {percentile(latencies, 50) * 1000:>9.2f} '
+              f'{percentile(latencies, 99) * 1000:>9.2f}')
+
+
+if __name__ == '__main__':
+    main()
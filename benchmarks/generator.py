@@ -0,0 +1,176 @@
+"""
+Seeded synthetic social graph, bulk-loaded into the app's database.
+
+    - follower counts follow a power law: follow targets are drawn with weights rank ** -follow_exponent, so the first few accounts collect most of the followers (user 1 is the most followed)
+    - the number of accounts each user follows is heavy-tailed too (Pareto), with the requested mean
+    - post authorship is skewed (Pareto activity weights, independent of popularity)
+    - post timestamps are bursty: posts come in bursts (a geometric number of posts, seconds to minutes apart) whose starts are spread over the time window
+
+The same parameters and seed always produce the same rows. Rows are
+inserted with executemany() in large chunks and one transaction, with
+SQLite's sync turned off and a large page cache for the load (100k users
+and 1M posts load in well under a minute); the denormalized counters (and,
+in 'fanout'/'hybrid' TIMELINE_MODE, the timelines) are then rebuilt in
+bulk. Session events (search indexing, timeline pushes, ...) don't run.
+"""
+# python packages
+import random
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+# local modules
+from app import db, timeline
+from app.dataio import insert_rows
+from app.models import User, Post, followers
+
+
+# rows per executemany()
+CHUNK_SIZE = 50000
+# default newest post timestamp (fixed, so that runs load identical rows)
+END = datetime(2020, 1, 1)
+# SQLite page cache while loading: large enough to hold the indexes the
+# rows are inserted into (which arrive in random order)
+LOAD_CACHE_KIB = 512 * 1024
+
+
+class Graph():
+    """
+    Summary of a generated graph.
+    """
+    __slots__ = ('users', 'follows', 'posts', 'ids', 'start', 'end',
+        'load_seconds')
+
+    def __init__(self, users, follows, posts, ids, start, end, load_seconds):
+        self.users = users
+        self.follows = follows
+        self.posts = posts
+        self.ids = ids # user ids, most-followed first
+        self.start = start # oldest post timestamp
+        self.end = end # newest post timestamp
+        self.load_seconds = load_seconds
+
+    def as_dict(self):
+        return {'users': self.users, 'follows': self.follows,
+            'posts': self.posts, 'load_seconds': round(self.load_seconds, 3)}
+
+
+def follow_rows(ids, mean_follows, exponent, rng):
+    """
+    Yields unique (follower_id, followed_id) pairs with power-law in-degrees and heavy-tailed out-degrees.
+    """
+    cum_weights = list(accumulate(rank ** -exponent
+        for rank in range(1, len(ids) + 1)))
+    # Pareto(alpha) has mean alpha / (alpha - 1); scale it to mean_follows
+    alpha = 2.0
+    scale = mean_follows * (alpha - 1) / alpha
+    cap = len(ids) - 1
+    for follower_id in ids:
+        count = min(cap, int(scale * rng.paretovariate(alpha)))
+        followed = set()
+        # draws repeat on popular accounts; bound the attempts
+        for _ in range(4):
+            for followed_id in rng.choices(ids, cum_weights=cum_weights,
+                    k=count - len(followed)):
+                if followed_id != follower_id:
+                    followed.add(followed_id)
+            if len(followed) >= count:
+                break
+        for followed_id in sorted(followed):
+            yield follower_id, followed_id
+
+
+def post_rows(ids, posts, start, end, rng, burst_mean=4, burst_gap=90):
+    """
+    Yields (body, timestamp, user_id) for `posts` posts in bursts: each burst is one author posting a geometric number of posts (mean `burst_mean`), exponentially distributed `burst_gap` seconds apart on average, from a uniformly drawn start.
+    """
+    activity = list(accumulate(rng.paretovariate(1.5) for _ in ids))
+    window = (end - start).total_seconds()
+    remaining = posts
+    n = 0
+    while remaining > 0:
+        user_id = rng.choices(ids, cum_weights=activity)[0]
+        size = 1
+        while size < remaining and rng.random() > 1 / burst_mean:
+            size += 1
+        offset = rng.uniform(0, window)
+        for _ in range(size):
+            n += 1
+            yield (f'post {n} from user{user_id}',
+                start + timedelta(seconds=min(offset, window)), user_id)
+            offset += rng.expovariate(1 / burst_gap)
+        remaining -= size
+
+
+def chunks(rows, size=CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def generate(users, posts, follows=20, seed=1, days=30, follow_exponent=1.1,
+        end=None):
+    """
+    Bulk-load a synthetic graph into the app's (empty) database.
+
+        Params
+            users (int)
+                number of users
+            posts (int)
+                total number of posts
+            follows (int)
+                mean number of accounts followed per user
+            seed (int)
+                random seed; the same parameters and seed give the same rows
+            days (int)
+                the posts span the `days` days before `end`
+            follow_exponent (float)
+                power-law exponent of the follow target weights
+            end (datetime)
+                newest possible post timestamp (default: END)
+
+        Returns
+            graph (obj) -- Graph summary (counts, user ids most-followed first, time span)
+    """
+    rng = random.Random(seed)
+    end = end or END
+    start = end - timedelta(days=days)
+    ids = list(range(1, users + 1))
+    started = time.perf_counter()
+    with db.engine.connect() as connection:
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite: # must be set outside of a transaction
+            # (restored afterwards: pooled connections keep their pragmas)
+            pragmas = {name: connection.execute(f'PRAGMA {name}').scalar()
+                for name in ('synchronous', 'cache_size')}
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute(f'PRAGMA cache_size = -{LOAD_CACHE_KIB}')
+        with connection.begin():
+            for chunk in chunks(ids):
+                insert_rows(connection, User.__table__, ('id', 'username',
+                    'email', 'avatar_digest', 'last_seen', 'is_celebrity',
+                    'profile_version'), [(i, f'user{i}', f'user{i}@example.com',
+                    User.make_avatar_digest(f'user{i}@example.com'), end,
+                    False, 0) for i in chunk])
+            follow_count = 0
+            for chunk in chunks(follow_rows(ids, follows, follow_exponent,
+                    rng)):
+                insert_rows(connection, followers,
+                    ('follower_id', 'followed_id'), chunk)
+                follow_count += len(chunk)
+            for chunk in chunks(post_rows(ids, posts, start, end, rng)):
+                insert_rows(connection, Post.__table__,
+                    ('body', 'timestamp', 'user_id'), chunk)
+        if sqlite:
+            for name, value in pragmas.items():
+                connection.execute(f'PRAGMA {name} = {value}')
+    User.repair_counters()
+    if timeline.fanout_enabled():
+        timeline.rebuild(db.session)
+    db.session.commit()
+    return Graph(users, follow_count, posts, ids, start, end,
+        time.perf_counter() - started)
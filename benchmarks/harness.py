@@ -0,0 +1,119 @@
+"""
+Shared benchmark plumbing: the app config, throwaway SQLite apps, timing
+and percentiles, and JSON result files.
+"""
+# python packages
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+# local modules
+from app import app_factory, db, last_seen_buffer
+from config import Config
+
+
+class BenchConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SEARCH_BACKEND = 'none'
+    METRICS_ENABLED = False
+    EXPLORE_BUFFER_MARK_FILE = None
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies):
+    """
+    Returns the summary statistics of a list of latencies (seconds), in milliseconds.
+    """
+    return {'samples': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p90_ms': round(percentile(latencies, 90) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3)}
+
+
+def time_calls(func, samples, warmup=0):
+    """
+    Call func() warmup + samples times; returns the latencies (seconds) of the last `samples` calls.
+    """
+    latencies = []
+    for n in range(warmup + samples):
+        start = time.perf_counter()
+        func()
+        if n >= warmup:
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+@contextmanager
+def bench_app(**config):
+    """
+    Yields an app (inside its app context) backed by an empty throwaway SQLite database; `config` overrides BenchConfig.
+    """
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(db_fd)
+    config = type('BenchAppConfig', (BenchConfig,),
+        dict(config, SQLALCHEMY_DATABASE_URI='sqlite:///' + db_path))
+    app = app_factory(config)
+    try:
+        with app.app_context():
+            db.create_all()
+            yield app
+            last_seen_buffer.flush() # while the database still exists
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        os.remove(db_path)
+
+
+def git_revision():
+    """
+    Returns the commit the tree is at (suffixed with '-dirty' if it has uncommitted changes), or None outside of a git checkout.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root,
+            capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain',
+            '--untracked-files=no'], cwd=root, capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def write_results(path, benchmark, params, results):
+    """
+    Write a run's results as JSON, along with what's needed to compare it with other runs (commit, parameters, environment).
+
+        Params
+            path (str)
+                output file
+            benchmark (str)
+                benchmark name
+            params (dict)
+                the run's parameters (sizes, seed, ...); runs are only comparable if they match
+            results (dict)
+                {name: summarize() output (or any JSON-serializable value)}
+    """
+    document = {
+        'benchmark': benchmark,
+        'commit': git_revision(),
+        'created': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'params': params,
+        'environment': {'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version, 'platform': platform.platform()},
+        'results': results}
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+        f.write('\n')
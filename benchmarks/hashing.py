@@ -0,0 +1,122 @@
+"""
+Password hashing benchmark: read latency while a login burst saturates the
+server, with hashing on the request threads (PASSWORD_HASH_WORKERS = 0) and
+in the hashing pool with admission control (see app/hashing.py).
+
+The server is modeled as a fixed number of request threads (--server-threads,
+like gunicorn's sync workers) taking requests from one queue. --logins
+clients post logins back to back while one client loads /explore every
+--read-interval seconds; each read's latency includes its wait in the queue.
+
+    python -m benchmarks.hashing --server-threads 8 --logins 16 --pool 2 --queue 2
+"""
+# python packages
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+# local modules
+from app import db
+from app.models import User
+from benchmarks.generator import generate
+from benchmarks.harness import bench_app, percentile, summarize, \
+    write_results
+
+
+def run_setup(workers, args):
+    """
+    Run the login burst and the reads against a fresh app with PASSWORD_HASH_WORKERS = workers.
+
+        Returns
+            read_latencies (list) -- seconds per /explore (queueing included)
+            logins (dict) -- login responses by status code
+    """
+    with bench_app(PASSWORD_HASH_WORKERS=workers,
+            PASSWORD_HASH_QUEUE=args.queue) as app:
+        generate(args.users, args.users * args.posts, seed=args.seed)
+        for user in User.query.filter(User.id <= args.logins):
+            user.set_password('benchmark')
+        db.session.commit()
+        db.session.remove()
+        server = ThreadPoolExecutor(args.server_threads)
+
+        def request(method, url, data=None):
+            with app.test_client() as client:
+                return client.open(url, method=method, data=data).status_code
+
+        # warm up: hashing pool processes, templates
+        server.submit(request, 'POST', '/auth/login', {'username': 'user1',
+            'password': 'benchmark'}).result()
+        server.submit(request, 'GET', '/explore').result()
+
+        logins, lock = {}, threading.Lock()
+        stop = threading.Event()
+
+        def login_client(number):
+            data = {'username': f'user{number + 1}', 'password': 'benchmark'}
+            while not stop.is_set():
+                status = server.submit(request, 'POST', '/auth/login',
+                    data).result()
+                with lock:
+                    logins[status] = logins.get(status, 0) + 1
+                if status == 503: # honor Retry-After, scaled down
+                    time.sleep(args.read_interval)
+
+        clients = [threading.Thread(target=login_client, args=(n,))
+            for n in range(args.logins)]
+        for client in clients:
+            client.start()
+        time.sleep(args.read_interval) # let the burst fill the server
+        read_latencies = []
+        for n in range(args.samples):
+            start = time.perf_counter()
+            server.submit(request, 'GET', '/explore').result()
+            read_latencies.append(time.perf_counter() - start)
+            time.sleep(args.read_interval)
+        stop.set()
+        for client in clients:
+            client.join()
+        server.shutdown()
+    return read_latencies, logins
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--posts', type=int, default=5,
+        help='initial posts per user')
+    parser.add_argument('--server-threads', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=16,
+        help='clients posting logins back to back')
+    parser.add_argument('--pool', type=int, default=2,
+        help='PASSWORD_HASH_WORKERS of the pooled run')
+    parser.add_argument('--queue', type=int, default=2,
+        help='PASSWORD_HASH_QUEUE of the pooled run')
+    parser.add_argument('--samples', type=int, default=50,
+        help='reads timed during the burst')
+    parser.add_argument('--read-interval', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'hashing':<9} {'read p50':>9} {'read p99':>9} {'logins':>7} "
+          f"{'503s':>6}   (ms)")
+    for name, workers in (('inline', 0), ('pool', args.pool)):
+        read_latencies, logins = run_setup(workers, args)
+        results[f'{name}.explore'] = summarize(read_latencies)
+        results[f'{name}.logins'] = {str(status): count
+            for status, count in sorted(logins.items())}
+        print(f'{name:<9} {percentile(read_latencies, 50) * 1000:>9.2f} '
+              f'{percentile(read_latencies, 99) * 1000:>9.2f} '
+              f'{logins.get(302, 0):>7} {logins.get(503, 0):>6}')
+
+    if args.output:
+        params = {name: value for name, value in vars(args).items()
+            if name != 'output'}
+        write_results(args.output, 'hashing', params, results)
+
+
+if __name__ == '__main__':
+    main()
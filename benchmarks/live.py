@@ -0,0 +1,170 @@
+"""
+Live updates benchmark: db load and delivery latency of many idle home
+timelines waiting for new posts, fed by the hub (live.poll(), as
+/posts/new does; see app/live.py) and, as the baseline, by each client
+querying the db every --interval seconds.
+
+--waiters followers of the most-followed account wait (one thread each, as
+the server's threaded workers serve them) for --idle seconds, then that account
+posts --publish times, --gap seconds apart. Reports the db queries per
+second while idle, and the latency from each post's commit to each waiter
+getting it.
+
+    python -m benchmarks.live --users 2000 --posts 20000 --waiters 500 --interval 5
+"""
+# python packages
+import argparse
+import sys
+import threading
+import time
+# local modules
+from app import db, live
+from app.models import Post, User, followers
+from benchmarks.generator import generate
+from benchmarks.harness import bench_app, summarize, write_results
+
+
+MODES = ('hub', 'db')
+
+
+def waiter_ids(poster, count):
+    """
+    Returns `count` ids of followers of the poster (repeated if it has fewer).
+    """
+    ids = [row[0] for row in db.session.execute(
+        db.select([followers.c.follower_id]).
+        where(followers.c.followed_id == poster).
+        order_by(followers.c.follower_id))]
+    if not ids:
+        raise RuntimeError(f'user {poster} has no followers')
+    return [ids[n % len(ids)] for n in range(count)]
+
+
+def run_mode(mode, args):
+    """
+    Run the waiters and posts against a fresh app, the waiters polling in the mode ('hub' or 'db').
+
+        Returns
+            latencies (list) -- seconds from a post's commit to a waiter getting it
+            idle_qps (float) -- db queries per second while nobody posts
+            missed (int) -- posts some waiter never got
+    """
+    with bench_app(LIVE_POLL_TIMEOUT=args.timeout, POSTS_PER_PAGE=25) as app:
+        graph = generate(args.users, args.posts, follows=args.follows,
+            seed=args.seed)
+        poster = User.query.get(graph.ids[0])
+        readers = waiter_ids(poster.id, args.waiters)
+        db.session.remove()
+
+        queries, latencies, published = [0], [], {}
+        received = {}
+        lock = threading.Lock()
+        stop = threading.Event()
+        ready = threading.Barrier(len(readers) + 1)
+
+        def count(*_):
+            with lock:
+                queries[0] += 1
+
+        def waiter(reader):
+            with app.app_context():
+                authors = live.feed_authors(User.query.get(reader))
+                since = db.session.query(db.func.max(Post.id)).scalar()
+                db.session.remove()
+                ready.wait()
+                while not stop.is_set():
+                    if mode == 'hub':
+                        posts, since = live.poll(since, authors, args.timeout,
+                            app.config['POSTS_PER_PAGE'])
+                    else:
+                        posts = live.missed_posts(since, authors,
+                            app.config['POSTS_PER_PAGE'])
+                        db.session.remove()
+                        if posts:
+                            since = posts[0].id
+                        else:
+                            stop.wait(args.interval)
+                    now = time.perf_counter()
+                    with lock:
+                        for post in posts:
+                            if post.id in published:
+                                latencies.append(now - published[post.id])
+                                received[post.id] = received.get(post.id, 0) + 1
+
+        threads = [threading.Thread(target=waiter, args=(reader,), daemon=True)
+            for reader in readers]
+        for thread in threads:
+            thread.start()
+        ready.wait()
+        # let the waiters settle into waiting (the hub starts, the baseline
+        # clients spread over an interval) before counting
+        time.sleep(min(args.idle, max(args.interval, 1)) / 2)
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        time.sleep(args.idle)
+        idle_qps = queries[0] / args.idle
+        db.event.remove(db.engine, 'before_cursor_execute', count)
+
+        for n in range(args.publish):
+            post = Post(body=f'live {n}', author=User.query.get(poster.id))
+            db.session.add(post)
+            db.session.flush()
+            with lock:
+                published[post.id] = time.perf_counter()
+            db.session.commit()
+            db.session.remove()
+            time.sleep(args.gap)
+        time.sleep(max(args.interval, 1))
+        stop.set()
+        for thread in threads:
+            thread.join()
+        missed = sum(1 for id in published
+            if received.get(id, 0) < len(readers))
+    return latencies, idle_qps, missed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--posts', type=int, default=20000,
+        help='total posts')
+    parser.add_argument('--follows', type=int, default=20,
+        help='mean accounts followed per user')
+    parser.add_argument('--waiters', type=int, default=500)
+    parser.add_argument('--interval', type=float, default=5.0,
+        help="seconds between the baseline clients' queries")
+    parser.add_argument('--timeout', type=float, default=5.0,
+        help='LIVE_POLL_TIMEOUT of the hub waiters')
+    parser.add_argument('--idle', type=float, default=10.0,
+        help='seconds to wait before posting')
+    parser.add_argument('--publish', type=int, default=5,
+        help='posts published')
+    parser.add_argument('--gap', type=float, default=1.0,
+        help='seconds between posts')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'mode':<6} {'idle q/s':>9} {'p50':>9} {'p99':>9} {'max':>9} "
+          f"{'missed':>7}   (ms)")
+    for mode in MODES:
+        latencies, idle_qps, missed = run_mode(mode, args)
+        if not latencies:
+            print(f'{mode}: no posts delivered', file=sys.stderr)
+            continue
+        summary = dict(summarize(latencies), idle_qps=round(idle_qps, 2),
+            missed=missed, max_ms=round(max(latencies) * 1000, 3))
+        results[mode] = summary
+        print(f"{mode:<6} {idle_qps:>9.1f} {summary['p50_ms']:>9.2f} "
+              f"{summary['p99_ms']:>9.2f} {summary['max_ms']:>9.2f} "
+              f"{missed:>7}")
+
+    if args.output:
+        params = {name: value for name, value in vars(args).items()
+            if name != 'output'}
+        write_results(args.output, 'live', params, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Post records benchmark: CPU time and memory per page of the post lists, read
+as Post objects (POST_RECORDS = False: ORM instances, with Post.author
+eager-loaded) and as PostRecords (POST_RECORDS = True: joined Core rows; see
+app/records.py).
+
+Two measures per page (home timeline, a deep explore page past the
+in-memory buffer, profiles):
+    load -- loading the page's posts alone (what the view's query costs); memory is what the page's posts hold on to (retained) and the peak while loading them
+    page -- the whole request through the test client, with the fragment cache disabled so that every post is rendered; memory is the peak while serving it
+CPU is process time; memory is of Python allocations (tracemalloc, measured
+in separate, untimed runs).
+
+    python -m benchmarks.records --users 2000 --posts 50000 --per-page 25
+"""
+# python packages
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+# local modules
+from app import db
+from app.models import Post, User
+from benchmarks.generator import generate
+from benchmarks.harness import bench_app, summarize, write_results
+
+
+def post_lists(app, readers, profiles):
+    """
+    Returns {page: [func(records) loading the posts of one page]}, like the views do.
+    """
+    per_page = app.config['POSTS_PER_PAGE']
+
+    def load(posts, records, eager=True):
+        if records:
+            posts = posts.records()
+        elif eager:
+            posts = posts.options(db.joinedload(Post.author))
+        return posts.keyset_paginate(per_page).items
+
+    users = {id: User.query.get(id) for id in set(readers) | set(profiles)}
+    return {'index': [lambda records, user=users[reader]:
+            load(user.feed_posts(), records) for reader in readers],
+        'explore.deep': [lambda records: load(Post.query.order_by(
+            Post.timestamp.desc(), Post.id.desc()), records)] * len(readers),
+        'user': [lambda records, user=users[profile]: load(user.posts.order_by(
+            Post.timestamp.desc(), Post.id.desc()), records, eager=False)
+            for profile in profiles]}
+
+
+def measure_load(loads, records, warmup, memory_samples):
+    """
+    Returns (wall latencies, cpu seconds, retained bytes, peak bytes) per list load.
+    """
+    for load in loads[:warmup]:
+        load(records)
+    latencies, cpu = [], []
+    for load in loads:
+        start, start_cpu = time.perf_counter(), time.process_time()
+        load(records)
+        latencies.append(time.perf_counter() - start)
+        cpu.append(time.process_time() - start_cpu)
+    retained, peaks = [], []
+    for load in loads[:memory_samples]:
+        # count the page's posts only (the authors stay in the identity map)
+        for obj in list(db.session):
+            if isinstance(obj, Post):
+                db.session.expunge(obj)
+        tracemalloc.start()
+        items = load(records)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        retained.append(current)
+        peaks.append(peak)
+        del items
+    return latencies, cpu, retained, peaks
+
+
+def pages(app, readers, profiles, deep):
+    """
+    Returns {page: [(reader id, url) of each request]}.
+    """
+    return {'index': [(reader, '/index') for reader in readers],
+        'explore.deep': [(reader, f'/explore?page={deep}')
+            for reader in readers],
+        'user': [(reader, f'/user/user{profile}')
+            for reader, profile in zip(readers, profiles)]}
+
+
+def measure_page(app, requests, warmup, memory_samples):
+    """
+    Returns (wall latencies, cpu seconds per request, peak bytes per request) of the requests.
+    """
+    client = app.test_client()
+
+    def get(reader, url):
+        with client.session_transaction() as session:
+            session['user_id'] = str(reader)
+            session['_fresh'] = True
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f'GET {url}: {response.status_code}')
+        db.session.remove() # like the end of a real request
+
+    for reader, url in requests[:warmup]:
+        get(reader, url)
+    latencies, cpu = [], []
+    for reader, url in requests:
+        start, start_cpu = time.perf_counter(), time.process_time()
+        get(reader, url)
+        latencies.append(time.perf_counter() - start)
+        cpu.append(time.process_time() - start_cpu)
+    peaks = []
+    for reader, url in requests[:memory_samples]:
+        tracemalloc.start()
+        get(reader, url)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return latencies, cpu, peaks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--posts', type=int, default=50000,
+        help='total posts')
+    parser.add_argument('--follows', type=int, default=20,
+        help='mean accounts followed per user')
+    parser.add_argument('--per-page', type=int, default=25)
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--memory-samples', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {}
+    with bench_app(POSTS_PER_PAGE=args.per_page, FRAGMENT_CACHE_SIZE=0,
+            CONDITIONAL_GET=False) as app:
+        graph = generate(args.users, args.posts, follows=args.follows,
+            seed=args.seed)
+        print(f'loaded {graph.users} users, {graph.follows} follows and '
+              f'{graph.posts} posts in {graph.load_seconds:.1f} s',
+              file=sys.stderr)
+        rng = random.Random(args.seed)
+        readers = [rng.choice(graph.ids) for _ in range(args.samples)]
+        profiles = [rng.choice(graph.ids[:len(graph.ids) // 10])
+            for _ in range(args.samples)]
+        deep = app.config['EXPLORE_BUFFER_SIZE'] // args.per_page + 1
+        print(f"{'load':<22} {'p50':>8} {'cpu':>8} {'retained KB':>12} "
+              f"{'peak KB':>9}   (ms)")
+        with app.test_request_context():
+            for name, loads in post_lists(app, readers, profiles).items():
+                for reader, records in (('orm', False), ('records', True)):
+                    latencies, cpu, retained, peaks = measure_load(loads,
+                        records, args.warmup, args.memory_samples)
+                    summary = summarize(latencies)
+                    summary['cpu_ms'] = round(sum(cpu) / len(cpu) * 1000, 3)
+                    summary['retained_kb'] = round(
+                        sum(retained) / len(retained) / 1024, 1)
+                    summary['peak_kb'] = round(sum(peaks) / len(peaks) / 1024, 1)
+                    results[f'load.{name}.{reader}'] = summary
+                    print(f"{name + '.' + reader:<22} "
+                          f"{summary['p50_ms']:>8.2f} {summary['cpu_ms']:>8.2f} "
+                          f"{summary['retained_kb']:>12.1f} "
+                          f"{summary['peak_kb']:>9.1f}")
+            db.session.remove()
+        print(f"\n{'page':<22} {'p50':>8} {'cpu':>8} {'peak KB':>12}   (ms)")
+        for name, requests in pages(app, readers, profiles, deep).items():
+            for reader, records in (('orm', False), ('records', True)):
+                app.config['POST_RECORDS'] = records
+                latencies, cpu, peaks = measure_page(app, requests,
+                    args.warmup, args.memory_samples)
+                summary = summarize(latencies)
+                summary['cpu_ms'] = round(sum(cpu) / len(cpu) * 1000, 3)
+                summary['peak_kb'] = round(sum(peaks) / len(peaks) / 1024, 1)
+                results[f'page.{name}.{reader}'] = summary
+                print(f"{name + '.' + reader:<22} {summary['p50_ms']:>8.2f} "
+                      f"{summary['cpu_ms']:>8.2f} {summary['peak_kb']:>12.1f}")
+
+    if args.output:
+        params = {name: value for name, value in vars(args).items()
+            if name != 'output'}
+        write_results(args.output, 'records', params, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Embedded search engine benchmark: indexing throughput, index size, and
+p50/p99 query latency for rare, common and multi-term queries on synthetic
+140-character posts (word frequencies drawn from a Zipf-like distribution).
+
+    python -m benchmarks.search --docs 1000000
+"""
+# python packages
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from itertools import accumulate
+# local modules
+from app.searchengine import EmbeddedEngine
+from benchmarks.harness import percentile
+
+
+def make_vocabulary(size, rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+
+def make_body(vocabulary, cum_weights, rng):
+    words = rng.choices(vocabulary, cum_weights=cum_weights,
+        k=rng.randint(5, 22))
+    return ' '.join(words)[:140]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=1000000)
+    parser.add_argument('--batch', type=int, default=50000,
+        help='documents per bulk write (one segment each)')
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    cum_weights = list(accumulate(rank ** -1.0
+        for rank in range(1, len(vocabulary) + 1)))
+    path = tempfile.mkdtemp()
+    try:
+        engine = EmbeddedEngine(path)
+        elapsed = 0.0
+        for first in range(1, args.docs + 1, args.batch):
+            operations = [('index', 'post', id, None,
+                {'body': make_body(vocabulary, cum_weights, rng)})
+                for id in range(first, min(first + args.batch, args.docs + 1))]
+            start = time.perf_counter()
+            engine.bulk(operations)
+            elapsed += time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(path, 'post', name))
+            for name in os.listdir(os.path.join(path, 'post')))
+        print(f'indexed {args.docs} docs in {elapsed:.1f}s '
+              f'({args.docs / elapsed:.0f} docs/s); '
+              f'index size {size / 2 ** 20:.1f} MiB')
+
+        engine = EmbeddedEngine(path) # cold reader
+        query_sets = {
+            'rare': [rng.choice(vocabulary[len(vocabulary) // 2:])
+                for _ in range(args.queries)],
+            'common': [rng.choice(vocabulary[10:100])
+                for _ in range(args.queries)],
+            'multi': [' '.join(rng.choices(vocabulary[100:5000], k=3))
+                for _ in range(args.queries)]}
+        print(f"{'query':<8} {'p50':>9} {'p99':>9}   (ms)   avg hits")
+        for name, queries in query_sets.items():
+            latencies, hits = [], 0
+            for query in queries:
+                start = time.perf_counter()
+                _, total, _, _ = engine.search('post', query, 1, 25)
+                latencies.append(time.perf_counter() - start)
+                hits += total
+            print(f'{name:<8} {percentile(latencies, 50) * 1000:>9.2f} '
+                  f'{percentile(latencies, 99) * 1000:>9.2f}   '
+                  f'{hits / len(queries):>12.0f}')
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+Benchmark suite: bulk-loads a synthetic social graph (see
+benchmarks/generator.py) into a throwaway SQLite database, then times the
+User/Post model methods and the post list routes (through the Flask test
+client), and writes the p50/p90/p99/mean latencies as JSON.
+
+    python -m benchmarks.suite --users 100000 --posts 1000000 --output run.json
+    python -m benchmarks.compare base.json run.json
+
+Readers are drawn the same way for every run with the same seed: half
+uniformly, half among the 1% most-followed accounts (whose pages hold the
+most posts), so runs against different commits time the same requests.
+"""
+# python packages
+import argparse
+import random
+import sys
+import time
+# local modules
+from app import db
+from app.models import User, Post
+from benchmarks.generator import generate
+from benchmarks.harness import bench_app, summarize, time_calls, \
+    write_results
+
+
+def pick_users(ids, count, rng):
+    """
+    Returns `count` user ids: every other one among the 1% most-followed.
+    """
+    top = ids[:max(1, len(ids) // 100)]
+    return [rng.choice(top) if n % 2 else rng.choice(ids)
+        for n in range(count)]
+
+
+def cycle(values):
+    """
+    Returns a function returning the values in turn.
+    """
+    state = {'n': -1}
+
+    def next_value():
+        state['n'] = (state['n'] + 1) % len(values)
+        return values[state['n']]
+    return next_value
+
+
+def model_benchmarks(app, graph, args, rng):
+    per_page = app.config['POSTS_PER_PAGE']
+    # note: users are looked up by id in each call (from the identity map
+    # after the first one), since the session is removed between benchmarks
+    reader_ids = cycle(pick_users(graph.ids, args.samples, rng))
+    pair_ids = cycle([(rng.choice(graph.ids), id)
+        for id in pick_users(graph.ids, args.samples, rng)])
+
+    def readers():
+        return User.query.get(reader_ids())
+
+    def pairs():
+        follower_id, followed_id = pair_ids()
+        return User.query.get(follower_id), User.query.get(followed_id)
+
+    def feed_posts():
+        readers().feed_posts().options(db.joinedload(Post.author)). \
+            keyset_paginate(per_page)
+
+    def feed_posts_count():
+        readers().feed_posts().count()
+
+    def user_posts():
+        readers().posts.order_by(Post.timestamp.desc(), Post.id.desc()). \
+            options(db.joinedload(Post.author)).keyset_paginate(per_page)
+
+    def is_following():
+        follower, followed = pairs()
+        follower.is_following(followed)
+
+    def follow_unfollow():
+        follower, followed = pairs()
+        if follower.id == followed.id:
+            return None
+        following = follower.is_following(followed)
+        follower.follow(followed)
+        db.session.commit()
+        if not following:
+            follower.unfollow(followed)
+            db.session.commit()
+
+    def create_post():
+        db.session.add(Post(body='benchmark post', author=readers()))
+        db.session.commit()
+
+    benchmarks = [('feed_posts', feed_posts),
+        ('feed_posts.count', feed_posts_count),
+        ('user.posts', user_posts),
+        ('is_following', is_following),
+        ('follow+unfollow', follow_unfollow),
+        ('create_post', create_post)]
+    return {f'model.{name}': func for name, func in benchmarks}
+
+
+def route_benchmarks(app, graph, args, rng):
+    client = app.test_client()
+    readers = cycle(pick_users(graph.ids, args.samples, rng))
+    usernames = cycle([f'user{id}'
+        for id in pick_users(graph.ids, args.samples, rng)])
+
+    def login(user_id):
+        with client.session_transaction() as session:
+            session['user_id'] = str(user_id)
+            session['_fresh'] = True
+
+    def get(url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f'GET {url}: {response.status_code}')
+        return response
+
+    def index():
+        login(readers())
+        get('/index')
+
+    def explore():
+        login(readers())
+        get('/explore')
+
+    # a cursor some pages deep into /explore (past the in-memory buffer of
+    # recent posts for the default sizes)
+    login(graph.ids[0])
+    deep = app.config['EXPLORE_BUFFER_SIZE'] // app.config['POSTS_PER_PAGE'] + 2
+    deep_url = '/explore'
+    for _ in range(deep):
+        html = get(deep_url).get_data(as_text=True)
+        marker = html.find('/explore?after=')
+        if marker < 0:
+            break
+        deep_url = html[marker:html.index('"', marker)].replace('&amp;', '&')
+
+    def explore_deep():
+        login(readers())
+        get(deep_url)
+
+    def user():
+        login(readers())
+        get(f'/user/{usernames()}')
+
+    benchmarks = [('index', index), ('explore', explore),
+        ('explore.deep', explore_deep), ('user', user)]
+    return {f'route.{name}': func for name, func in benchmarks}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--posts', type=int, default=50000,
+        help='total posts')
+    parser.add_argument('--follows', type=int, default=20,
+        help='mean accounts followed per user')
+    parser.add_argument('--days', type=int, default=30,
+        help='time span of the posts')
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--timeline-mode', default='query',
+        choices=['query', 'fanout', 'hybrid'])
+    parser.add_argument('--only', nargs='+', metavar='NAME',
+        help='only run the benchmarks whose names start with one of these '
+             '(e.g. model.feed_posts route)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = {}
+    with bench_app(TIMELINE_MODE=args.timeline_mode) as app:
+        graph = generate(args.users, args.posts, follows=args.follows,
+            seed=args.seed, days=args.days)
+        print(f'loaded {graph.users} users, {graph.follows} follows and '
+              f'{graph.posts} posts in {graph.load_seconds:.1f} s',
+              file=sys.stderr)
+        results['generate'] = graph.as_dict()
+        benchmarks = model_benchmarks(app, graph, args, rng)
+        benchmarks.update(route_benchmarks(app, graph, args, rng))
+        print(f"{'benchmark':<22} {'p50':>9} {'p90':>9} {'p99':>9}   (ms)")
+        for name, func in benchmarks.items():
+            if args.only and not name.startswith(tuple(args.only)):
+                continue
+            with app.test_request_context():
+                started = time.perf_counter()
+                summary = summarize(time_calls(func, args.samples,
+                    warmup=args.warmup))
+                db.session.remove()
+            summary['seconds'] = round(time.perf_counter() - started, 3)
+            results[name] = summary
+            print(f"{name:<22} {summary['p50_ms']:>9.2f} "
+                  f"{summary['p90_ms']:>9.2f} {summary['p99_ms']:>9.2f}")
+
+    if args.output:
+        params = {name: value for name, value in vars(args).items()
+            if name not in ('output', 'only')}
+        write_results(args.output, 'suite', params, results)
+
+
+if __name__ == '__main__':
+    main()
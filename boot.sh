@@ -12,4 +12,11 @@ while true; do
     done
 
 
-exec gunicorn -b :5000 --access-logfile - --error-logfile - minitwitter:app
\ No newline at end of file
+# note: with --threads > 1, gunicorn runs its sync workers threaded
+# (gthread), so the idle connections of live updates (see app/live.py) each
+# hold a thread rather than a whole worker. (gevent workers would
+# monkey-patch the threads and the process pool that the app runs itself;
+# see app/hashing.py and app/sqlitedb.py.)
+exec gunicorn -b :5000 -k ${GUNICORN_WORKER_CLASS:-sync} \
+    --threads ${GUNICORN_THREADS:-100} \
+    --access-logfile - --error-logfile - minitwitter:app
\ No newline at end of file
@@ -1,4 +1,6 @@
+import hashlib
 import os
+import tempfile
 from dotenv import load_dotenv
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -11,6 +13,21 @@ class Config():
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # read replicas (see app/replicas.py): comma-separated database URLs;
+    # the reads of GET requests go to one of them, except for a user's
+    # requests in the REPLICA_PIN_SECONDS after they wrote
+    SQLALCHEMY_REPLICA_URIS = [url for url in
+        (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if url]
+    REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS') or 10)
+    # SQLite tuning (see app/sqlitedb.py)
+    # 'production': WAL mode and the PRODUCTION_PRAGMAS (overridden by
+    # SQLITE_PRAGMAS) on every connection, and a pool of SQLITE_POOL_SIZE
+    # connections; 'default': the drivers' defaults
+    SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE') or 'default'
+    SQLITE_PRAGMAS = {}
+    SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE') or 5)
+    # send this process's writes through one connection, group-committed
+    SQLITE_WRITE_QUEUE = os.environ.get('SQLITE_WRITE_QUEUE') is not None
 
     # Emails
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
@@ -20,8 +37,150 @@ class Config():
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['12104721+vishrutarya@users.noreply.github.com']
 
+    # Home timelines
+    # 'query': build each timeline on read (join + union over followers/posts)
+    # 'fanout': materialize timelines on write (see app/timeline.py)
+    # 'hybrid': as 'fanout', except that posts by accounts with more than
+    # TIMELINE_CELEBRITY_THRESHOLD followers are merged in at read time
+    TIMELINE_MODE = os.environ.get('TIMELINE_MODE') or 'query'
+    TIMELINE_CELEBRITY_THRESHOLD = int(
+        os.environ.get('TIMELINE_CELEBRITY_THRESHOLD') or 10000)
+    # celebrities are demoted at this many followers or fewer (unset: 4/5 of
+    # TIMELINE_CELEBRITY_THRESHOLD), so that a follower count hovering around
+    # one threshold doesn't move all of an account's posts back and forth
+    TIMELINE_CELEBRITY_DEMOTE_THRESHOLD = int(
+        os.environ['TIMELINE_CELEBRITY_DEMOTE_THRESHOLD']) \
+        if os.environ.get('TIMELINE_CELEBRITY_DEMOTE_THRESHOLD') else None
+    # seconds between the background retags of users whose follower count
+    # crossed a threshold (0: none; retag with `flask timeline retag`)
+    TIMELINE_RETAG_INTERVAL = int(
+        os.environ.get('TIMELINE_RETAG_INTERVAL') or 60)
+
+    # last_seen write-behind (see app/presence.py)
+    # record at most one last_seen update per user per GRANULARITY seconds
+    # and write them to the db in one batch every FLUSH_INTERVAL seconds
+    # (0: write through on the request, as before)
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(
+        os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 10)
+
+    # cache of the users loaded for their session cookie (see
+    # app/usercache.py): up to USER_CACHE_SIZE users for USER_CACHE_TTL
+    # seconds, in this process, or in redis with USER_CACHE_URL
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 60)
+    USER_CACHE_URL = os.environ.get('USER_CACHE_URL')
+
+    # password hashing (see app/hashing.py): method and cost of new hashes
+    # (stored hashes made otherwise are rehashed on login), worker processes
+    # (0: hash on the request thread), hashes that may wait for a worker
+    # before logins/signups get a 503, and the Retry-After sent with it
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or \
+        'pbkdf2:sha256:150000'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 8)
+    PASSWORD_HASH_RETRY_AFTER = int(
+        os.environ.get('PASSWORD_HASH_RETRY_AFTER') or 2)
+
+    # answer unchanged timeline pages with 304 (see app/conditional.py)
+    CONDITIONAL_GET = os.environ.get('CONDITIONAL_GET', '1') != '0'
+
+    # new posts pushed to open home timelines (see app/live.py): seconds a
+    # long poll waits, seconds an SSE stream lasts before the client
+    # reconnects, seconds between SSE heartbeats, recent posts each process
+    # keeps for its waiting requests, and seconds between checks for the
+    # posts of other processes (0: none)
+    LIVE_UPDATES = os.environ.get('LIVE_UPDATES', '1') != '0'
+    LIVE_POLL_TIMEOUT = int(os.environ.get('LIVE_POLL_TIMEOUT') or 25)
+    LIVE_STREAM_SECONDS = int(os.environ.get('LIVE_STREAM_SECONDS') or 300)
+    LIVE_HEARTBEAT = int(os.environ.get('LIVE_HEARTBEAT') or 15)
+    LIVE_BACKLOG = int(os.environ.get('LIVE_BACKLOG') or 1000)
+    LIVE_SYNC_INTERVAL = float(os.environ.get('LIVE_SYNC_INTERVAL') or 1)
+
+    # response compression (see app/compression.py): gzip level (0: no
+    # compression), smallest response body compressed (bytes), brotli (if
+    # the `brotli` package is installed) and its quality, and the mimetypes
+    # compressed
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL') or 6)
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE') or 500)
+    COMPRESS_BROTLI = os.environ.get('COMPRESS_BROTLI', '1') != '0'
+    COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY') or 5)
+    COMPRESS_MIMETYPES = ['text/html', 'text/css', 'text/plain', 'text/xml',
+        'text/javascript', 'application/javascript', 'application/json',
+        'image/svg+xml']
+    # serve Flask-Bootstrap's CSS/JS from this app (precompressed) rather
+    # than from its CDN
+    BOOTSTRAP_SERVE_LOCAL = os.environ.get('BOOTSTRAP_SERVE_LOCAL') is not None
+
     # Pagination
     POSTS_PER_PAGE = 25
+    # read post lists as lightweight records (joined Core rows) rather than
+    # Post objects (see app/records.py)
+    POST_RECORDS = os.environ.get('POST_RECORDS', '1') != '0'
+
+    # Search
+    # 'elasticsearch': the cluster at ELASTICSEARCH_URL
+    # 'embedded': the in-process engine (see app/searchengine.py), which
+    # stores its indexes under SEARCH_INDEX_DIR
+    # 'none': search is disabled
+    # unset: 'elasticsearch' if ELASTICSEARCH_URL is set, else 'embedded'
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    SEARCH_INDEX_DIR = os.environ.get('SEARCH_INDEX_DIR') or \
+        os.path.join(basedir, 'search-index')
 
     # Elasticsearch
-    ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
\ No newline at end of file
+    ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # 'outbox': record index updates in the search_outbox table, in the same
+    # transaction as the change, and send them in bulk from a background
+    # worker (see app/indexer.py)
+    # 'sync': send each update from after_commit, within the request
+    # note: either way, the index versions are outbox ids, which are only in
+    # commit order on SQLite; search needs a SQLite database (or
+    # SEARCH_BACKEND = 'none')
+    SEARCH_INDEXING = os.environ.get('SEARCH_INDEXING') or 'outbox'
+    SEARCH_OUTBOX_BATCH_SIZE = 500
+    # seconds between outbox drains when no commit wakes the worker sooner
+    # (0: no worker; drain with `flask search drain`)
+    SEARCH_OUTBOX_POLL_INTERVAL = int(
+        os.environ.get('SEARCH_OUTBOX_POLL_INTERVAL') or 5)
+    # reindexing (see app/reindex.py): documents per bulk request, and
+    # concurrent bulk requests
+    SEARCH_REINDEX_CHUNK_SIZE = int(
+        os.environ.get('SEARCH_REINDEX_CHUNK_SIZE') or 1000)
+    SEARCH_REINDEX_WORKERS = int(os.environ.get('SEARCH_REINDEX_WORKERS') or 4)
+    # search results: records of the posts whose hits lack stored fields,
+    # cached by id (see app/records.py)
+    SEARCH_RECORD_CACHE_SIZE = int(
+        os.environ.get('SEARCH_RECORD_CACHE_SIZE') or 10000)
+    SEARCH_RECORD_CACHE_TTL = int(
+        os.environ.get('SEARCH_RECORD_CACHE_TTL') or 60)
+    # search result cache (see app/searchcache.py): entries per process (0:
+    # no cache), seconds an entry lives, and a redis URL to share the cache
+    # between processes instead
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1000)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 30)
+    SEARCH_CACHE_URL = os.environ.get('SEARCH_CACHE_URL')
+    # rendered post fragments (see app/fragments.py): fragments per process
+    # (0: no cache), and seconds a fragment lives
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL') or 3600)
+    # in-memory buffer of the most recent posts, for /explore (see
+    # app/explore.py): posts per process (0: no buffer), seconds between
+    # full reloads, and the file through which processes signal commits (by
+    # default in the temp dir, one per database; not in the source tree,
+    # which may be read-only)
+    EXPLORE_BUFFER_SIZE = int(os.environ.get('EXPLORE_BUFFER_SIZE') or 500)
+    EXPLORE_BUFFER_TTL = int(os.environ.get('EXPLORE_BUFFER_TTL') or 300)
+    EXPLORE_BUFFER_MARK_FILE = os.environ.get('EXPLORE_BUFFER_MARK_FILE') or \
+        os.path.join(tempfile.gettempdir(), 'minitwitter-explore-' +
+            hashlib.md5(SQLALCHEMY_DATABASE_URI.encode('utf-8')).hexdigest()[:12]
+            + '.mark')
+    # request metrics (see app/metrics.py): opt-in, as /metrics is public;
+    # requests slower than METRICS_SLOW_REQUEST_MS are logged with their
+    # SQL breakdown (0: no slow request log)
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED') is not None
+    METRICS_PATH = os.environ.get('METRICS_PATH') or '/metrics'
+    METRICS_SLOW_REQUEST_MS = int(
+        os.environ.get('METRICS_SLOW_REQUEST_MS') or 500)
+    # bulk import/export (see app/dataio.py): rows per executemany()/fetch
+    DATA_BATCH_SIZE = int(os.environ.get('DATA_BATCH_SIZE') or 10000)
\ No newline at end of file
@@ -1,20 +1,55 @@
 # python packages
 from datetime import datetime, timedelta
+import gzip
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
 import unittest
 # local modules
-from app import app_factory, db
+from app import app_factory, db, last_seen_buffer
 from app.models import User, Post
+from app import dataio, indexer, reindex, searchengine, timeline
+from app.compression import compress_static
+from app.records import PostRecord
+from app.search import ElasticsearchBackend, EmbeddedBackend
+from app.searchcache import RedisBackend, search_cache
+from benchmarks.generator import generate
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    WTF_CSRF_ENABLED = False
+    LAST_SEEN_FLUSH_INTERVAL = 0
+    SEARCH_BACKEND = 'none'
+    SEARCH_OUTBOX_POLL_INTERVAL = 0
+    TIMELINE_RETAG_INTERVAL = 0
+    SEARCH_CACHE_SIZE = 0
+    EXPLORE_BUFFER_MARK_FILE = None
+    PASSWORD_HASH_WORKERS = 0
+
+
+class FanoutTestConfig(TestConfig):
+    TIMELINE_MODE = 'fanout'
+
+
+class HybridTestConfig(TestConfig):
+    TIMELINE_MODE = 'hybrid'
+    TIMELINE_CELEBRITY_THRESHOLD = 1
 
 
 class UserModelCase(unittest.TestCase):
+    config_class = TestConfig
+
     def setUp(self):
-        self.app = app_factory(TestConfig)
+        self.app = app_factory(self.config_class)
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -38,6 +73,7 @@ class UserModelCase(unittest.TestCase):
         Test the get_avatar_image method
         """
         u = User(username='john', email='john@example.com')
+        self.assertEqual(u.avatar_digest, 'd4c74594d841139328695756648b6bd6')
         self.assertEqual(u.get_avatar_image(size=128),
         ('https://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6?d=identicon&s=128'))
 
@@ -71,6 +107,38 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_counters(self):
+        """
+        Test the denormalized follower/following/post counters.
+        """
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='sally', email='sally@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        # test: follow/unfollow and posting keep the counters in step
+        u1.follow(u2)
+        db.session.add_all([Post(body='one', author=u2),
+            Post(body='two', author=u2)])
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u1.followers_count), (1, 0))
+        self.assertEqual((u2.followed_count, u2.followers_count), (0, 1))
+        self.assertEqual(u2.posts_count, 2)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_count, 0)
+        self.assertEqual(u2.followers_count, 0)
+
+        # test: repair_counters() fixes drifted counters
+        db.session.execute(User.__table__.update().values(
+            posts_count=7, followers_count=None))
+        db.session.commit()
+        self.assertEqual(User.repair_counters(), 2)
+        db.session.commit()
+        self.assertEqual(u2.posts_count, 2)
+        self.assertEqual(u1.followers_count, 0)
+        self.assertEqual(User.repair_counters(), 0)
+
     # test: feed posts
     def test_feed_posts(self):
         # make four users
@@ -111,9 +179,1811 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f2, [p2, p3]) 
         self.assertEqual(f3, [p3, p4]) 
         self.assertEqual(f4, [p4])
-            
+
+    def test_data_import_export(self):
+        """
+        Test the NDJSON export/import round trip.
+        """
+        u1 = User(username='john', email='john@example.com', about_me='hi')
+        u2 = User(username='sally', email='sally@example.com')
+        u1.set_password('cat')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.add_all([Post(body='one', author=u2),
+            Post(body='two', author=u1)])
+        db.session.commit()
+        feed = [(post.id, post.body, post.timestamp)
+            for post in u1.feed_posts().all()]
+        output = io.StringIO()
+        counts = dataio.export_data(output, batch_size=1)
+        self.assertEqual(counts, {'user': 2, 'follow': 1, 'post': 2})
+        lines = output.getvalue().splitlines()
+        self.assertEqual([json.loads(line)['type'] for line in lines],
+            ['user', 'user', 'follow', 'post', 'post'])
+
+        # test: importing into an empty db restores the rows and rebuilds
+        # the counters (and timelines)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        counts = dataio.import_data(io.StringIO(output.getvalue()),
+            batch_size=2)
+        self.assertEqual(counts, {'user': 2, 'follow': 1, 'post': 2})
+        u1 = User.query.filter_by(username='john').one()
+        self.assertTrue(u1.check_password('cat'))
+        self.assertEqual(u1.about_me, 'hi')
+        self.assertEqual(u1.avatar_digest,
+            User.make_avatar_digest('john@example.com'))
+        self.assertEqual((u1.followed_count, u1.posts_count), (1, 1))
+        self.assertEqual([(post.id, post.body, post.timestamp)
+            for post in u1.feed_posts().all()], feed)
+        # test: new rows get fresh ids
+        post = Post(body='three', author=u1)
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual(post.id, 3)
+
+        # test: bad lines and id conflicts are rejected as a whole
+        with self.assertRaises(dataio.DataError):
+            dataio.import_data(io.StringIO(
+                '{"type": "user", "id": 9, "username": "x"}\n{"type": "x"}\n'))
+        with self.assertRaises(dataio.DataError):
+            dataio.import_data(io.StringIO(lines[1]))
+        self.assertEqual((User.query.count(), Post.query.count()), (2, 3))
+
+    def test_benchmark_generator(self):
+        """
+        Test the benchmark data generator: seeded, consistent with the counters and (in 'fanout'/'hybrid' modes) the timelines.
+        """
+        def rows():
+            return [db.session.execute(select).fetchall() for select in (
+                'SELECT id, username, followers_count, posts_count FROM user',
+                'SELECT * FROM followers ORDER BY 1, 2',
+                'SELECT id, body, timestamp, user_id FROM post')]
+
+        graph = generate(50, 400, follows=5, seed=3)
+        self.assertEqual((User.query.count(), Post.query.count()), (50, 400))
+        first = rows()
+        self.assertEqual(len(first[1]), graph.follows)
+        # test: the first accounts are the most followed
+        counts = [user.followers_count for user in
+            User.query.order_by(User.id).all()]
+        self.assertEqual(counts[0], max(counts))
+        self.assertGreater(sum(counts[:5]), sum(counts[-5:]))
+        self.assertEqual(User.repair_counters(), 0)
+        self.assertTrue(all(graph.start <= post.timestamp <= graph.end
+            for post in Post.query.all()))
+        if timeline.fanout_enabled():
+            count = db.session.execute(
+                db.select([db.func.count()]).select_from(timeline.entries)). \
+                    scalar()
+            self.assertGreater(count, 0)
+            feed = User.query.get(1).feed_posts().all()
+            timeline.rebuild(db.session)
+            self.assertEqual(User.query.get(1).feed_posts().all(), feed)
+
+        # test: the same seed gives the same rows
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        generate(50, 400, follows=5, seed=3)
+        self.assertEqual(rows(), first)
+
+
+class FanoutUserModelCase(UserModelCase):
+    """
+    Re-runs every UserModelCase test with materialized timelines.
+    """
+    config_class = FanoutTestConfig
+
+    def test_fanout_follow_unfollow(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='sally', email='sally@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        now = datetime.utcnow()
+        p1 = Post(body='old post from sally', author=u2,
+            timestamp=now + timedelta(seconds=1))
+        db.session.add(p1)
+        db.session.commit()
+
+        # test: follow backfills existing posts; new posts are pushed
+        u1.follow(u2)
+        db.session.commit()
+        p2 = Post(body='new post from sally', author=u2,
+            timestamp=now + timedelta(seconds=2))
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(u1.feed_posts().all(), [p2, p1])
+
+        # test: unfollow evicts sally's posts from john's timeline only
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.feed_posts().all(), [])
+        self.assertEqual(u2.feed_posts().all(), [p2, p1])
+
+    def test_fanout_rebuild(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='sally', email='sally@example.com')
+        p1 = Post(body='post from sally', author=u2)
+        db.session.add_all([u1, u2, p1])
+        u1.follow(u2)
+        db.session.commit()
+
+        # test: rebuilding from scratch gives the same timelines
+        db.session.execute(timeline.entries.delete())
+        timeline.rebuild(db.session)
+        db.session.commit()
+        self.assertEqual(u1.feed_posts().all(), [p1])
+        self.assertEqual(u2.feed_posts().all(), [p1])
+
+
+
+class HybridUserModelCase(UserModelCase):
+    """
+    Re-runs every UserModelCase test with hybrid timelines; retag() promotes anyone with more than one follower, and demotes those with none.
+    """
+    config_class = HybridTestConfig
+
+    def test_hybrid_celebrity_transitions(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='sally', email='sally@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        now = datetime.utcnow()
+        p1 = Post(body='post from mary', author=u3,
+            timestamp=now + timedelta(seconds=1))
+        db.session.add(p1)
+        db.session.commit()
+
+        # test: a second follower makes mary a celebrity once retagged (not
+        # in the follow); her posts are pulled from then on
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+        self.assertFalse(u3.is_celebrity)
+        self.assertEqual(timeline.retag(db.session), ([u3.id], []))
+        db.session.commit()
+        self.assertTrue(u3.is_celebrity)
+        self.assertEqual(db.session.query(timeline.entries).filter_by(
+            post_id=p1.id).count(), 1)
+        p2 = Post(body='another post from mary', author=u3,
+            timestamp=now + timedelta(seconds=2))
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(db.session.query(timeline.entries).filter_by(
+            post_id=p2.id).count(), 1)
+        self.assertEqual(u1.feed_posts().all(), [p2, p1])
+        self.assertEqual(u1.feed_posts().paginate(1, 1, False).items, [p2])
+        self.assertEqual(u1.feed_posts().paginate(2, 1, False).items, [p1])
+        self.assertEqual(u1.feed_posts().count(), 2)
+
+        # test: posts both pushed and pulled are counted once
+        db.session.execute(timeline.entries.insert().values(user_id=u1.id,
+            post_id=p2.id, timestamp=p2.timestamp))
+        self.assertEqual(u1.feed_posts().all(), [p2, p1])
+        self.assertEqual(u1.feed_posts().paginate(1, 1, False).total, 2)
+        self.assertEqual(u1.feed_posts().records().count(), 2)
+        db.session.rollback()
+
+        # test: dropping back to the promote threshold isn't enough to be
+        # demoted
+        u2.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(timeline.retag(db.session), ([], []))
+        self.assertTrue(u3.is_celebrity)
+        self.assertEqual(u1.feed_posts().all(), [p2, p1])
+        self.assertEqual(u2.feed_posts().all(), [])
+
+        # test: dropping to the demote threshold pushes her posts again
+        u1.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(timeline.retag(db.session), ([], [u3.id]))
+        db.session.commit()
+        self.assertFalse(u3.is_celebrity)
+        u2.follow(u3)
+        db.session.commit()
+        self.assertEqual(u2.feed_posts().all(), [p2, p1])
+        self.assertEqual(db.session.query(timeline.entries).filter_by(
+            post_id=p2.id).count(), 2)
+
+        # test: a rebuild keeps tags between the thresholds
+        u1.follow(u3)
+        db.session.commit()
+        timeline.retag(db.session)
+        u1.unfollow(u3)
+        db.session.commit()
+        timeline.rebuild(db.session)
+        db.session.commit()
+        self.assertTrue(u3.is_celebrity)
+        self.assertEqual(u2.feed_posts().all(), [p2, p1])
+
+
+
+class LastSeenTestConfig(TestConfig):
+    LAST_SEEN_FLUSH_INTERVAL = 3600
+
+
+class LastSeenCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app_factory(LastSeenTestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_last_seen_buffer(self):
+        then = datetime(2020, 1, 1)
+        u1 = User(username='john', email='john@example.com', last_seen=then)
+        u2 = User(username='sally', email='sally@example.com', last_seen=then)
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        now = datetime.utcnow()
+
+        # test: updates are buffered, and coalesced within the granularity
+        last_seen_buffer.touch(u1.id, previous=u1.last_seen, when=now)
+        last_seen_buffer.touch(u1.id, previous=u1.last_seen,
+            when=now + timedelta(seconds=30))
+        last_seen_buffer.touch(u2.id, previous=u2.last_seen, when=now)
+        self.assertEqual(last_seen_buffer.get(u1.id), now)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, then)
+
+        # test: one flush writes every pending update
+        self.assertEqual(last_seen_buffer.flush(), 2)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, now)
+        self.assertEqual(u2.last_seen, now)
+        self.assertIsNone(last_seen_buffer.get(u1.id))
+        self.assertEqual(last_seen_buffer.flush(), 0)
+
+
+class FakeElasticsearch():
+    """
+    In-memory stand-in for the elasticsearch client calls the app makes (bulk with internal or external versions, search, and index/alias management).
+    """
+    def __init__(self):
+        self.documents = {} # (physical index, id) -> (version, source)
+        self.aliases = {} # alias -> physical index
+        self.physical = set()
+        self.indices = FakeIndices(self)
+        self.bulk_requests = 0
+        self.searches = 0
+        self.available = True
+        self.fail_after = None # bulk requests to allow before failing
+
+    def resolve(self, index):
+        return self.aliases.get(index, index)
+
+    def bulk(self, body):
+        if not self.available or self.fail_after == 0:
+            raise ConnectionError('elasticsearch is unavailable')
+        if self.fail_after is not None:
+            self.fail_after -= 1
+        self.bulk_requests += 1
+        items, statuses = [], []
+        actions = iter(body)
+        for action in actions:
+            (op, meta), = action.items()
+            index = self.resolve(meta['_index'])
+            self.physical.add(index)
+            key = (index, str(meta['_id']))
+            source = next(actions) if op != 'delete' else None
+            current = self.documents.get(key)
+            version = meta.get('version')
+            if current is not None and (op == 'create' or
+                    (version is not None and (version < current[0]
+                        if meta.get('version_type') == 'external_gte'
+                        else version <= current[0]))):
+                status = 409
+            elif op != 'delete':
+                if version is None:
+                    version = current[0] + 1 if current else 1
+                self.documents[key] = (version, source)
+                status = 201
+            elif current is None:
+                status = 404
+            else:
+                del self.documents[key]
+                status = 200
+            statuses.append(status)
+            items.append({op: {'_id': key[1], 'status': status}})
+        return {'errors': any(status >= 300 for status in statuses),
+            'items': items}
+
+    def search(self, index, body):
+        self.searches += 1
+        index = self.resolve(index)
+        match = body['query']['multi_match']
+        words = match['query'].lower().split()
+        fields = match['fields']
+        hits = [{'_id': id, 'sort': [1.0, id],
+                 '_source': {field: source[field]
+                    for field in body.get('_source', source) if field in source}}
+            for (hit_index, id), (_, source) in self.documents.items()
+            if hit_index == index and any(word in str(value).lower().split()
+                for field, value in source.items()
+                if fields == ['*'] or field in fields for word in words)]
+        hits.sort(key=lambda hit: int(hit['_id']), reverse=True)
+        start = body.get('from', 0)
+        return {'hits': {'total': {'value': len(hits)},
+            'hits': hits[start:start + body['size']]}}
+
+
+class FakeIndices():
+    def __init__(self, es):
+        self.es = es
+
+    def create(self, index):
+        self.es.physical.add(index)
+
+    def delete(self, index, ignore=()):
+        self.es.physical.discard(index)
+        self.es.documents = {key: value for key, value
+            in self.es.documents.items() if key[0] != index}
+
+    def exists(self, index):
+        return index in self.es.physical
+
+    def exists_alias(self, name):
+        return name in self.es.aliases
+
+    def get_alias(self, name):
+        return {self.es.aliases[name]: {'aliases': {name: {}}}}
+
+    def update_aliases(self, body):
+        for action in body['actions']:
+            (op, params), = action.items()
+            if op == 'add':
+                self.es.aliases[params['alias']] = params['index']
+            elif op == 'remove_index':
+                self.delete(params['index'])
+
+
+class SearchIndexingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app_factory(TestConfig)
+        self.es = FakeElasticsearch()
+        self.app.search_backend = ElasticsearchBackend(self.es)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def indexed(self, index='post'):
+        index = self.es.resolve(index)
+        return {int(id): source['body'] for (doc_index, id), (_, source)
+            in self.es.documents.items() if doc_index == index}
+
+    def test_outbox_drain(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='hello world', author=u)
+        p2 = Post(body='goodbye world', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+
+        # test: commits only record updates; a drain sends them in bulk
+        self.assertEqual(indexer.backlog()[:2], (2, 0))
+        self.assertEqual(self.indexed(), {})
+        self.assertEqual(indexer.drain(), 2)
+        self.assertEqual(self.es.bulk_requests, 1)
+        self.assertEqual(indexer.backlog()[:2], (0, 0))
+        self.assertEqual(self.indexed(),
+            {p1.id: 'hello world', p2.id: 'goodbye world'})
+        posts, total, _ = Post.search('hello', 1, 10)
+        self.assertEqual((posts.all(), total), ([p1], 1))
+
+        # test: only changes to indexed fields are recorded, and several
+        # updates to a document collapse into one operation
+        u.about_me = 'not indexed'
+        db.session.commit()
+        self.assertEqual(indexer.backlog()[0], 0)
+        p1.body = 'hello again'
+        db.session.commit()
+        p1.body = 'hello there'
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(indexer.backlog()[0], 3)
+        self.assertEqual(indexer.drain(), 3)
+        self.assertEqual(self.es.bulk_requests, 2)
+        self.assertEqual(self.indexed(), {p1.id: 'hello there'})
+
+        # test: rolled-back changes are not recorded
+        p1.body = 'never committed'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(indexer.backlog()[0], 0)
+
+    def test_outbox_retry_and_ordering(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='first', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+
+        # test: failed updates stay in the outbox and back off
+        self.es.available = False
+        self.assertEqual(indexer.drain(), 0)
+        pending, failing, retry_at = indexer.backlog()
+        self.assertEqual((pending, failing), (1, 1))
+        self.assertGreater(retry_at, datetime.utcnow())
+        self.es.available = True
+        self.assertEqual(indexer.drain(), 0) # not due yet
+        db.session.execute(indexer.outbox.update().values(
+            next_attempt=datetime.utcnow()))
+        db.session.commit()
+        self.assertEqual(indexer.drain(), 1)
+        self.assertEqual(self.indexed(), {p.id: 'first'})
+
+        # test: replaying a drained (older) update doesn't overwrite a
+        # newer one, and outbox ids keep increasing once drained
+        version = self.es.documents[('post', str(p.id))][0]
+        p.body = 'second'
+        db.session.commit()
+        self.assertEqual(indexer.drain(), 1)
+        db.session.execute(indexer.outbox.insert().values(id=version,
+            index_name='post', doc_id=p.id, op='index',
+            next_attempt=datetime.utcnow()))
+        db.session.commit()
+        self.assertEqual(indexer.drain(), 1)
+        self.assertEqual(self.es.documents[
+            ('post', str(p.id))][0], version + 1)
+
+    def test_outbox_worker_starts(self):
+        # test: the worker starts with the first request, not only with a
+        # commit of this process (it also drains other processes' rows)
+        class WorkerTestConfig(TestConfig):
+            SEARCH_OUTBOX_POLL_INTERVAL = 3600
+        app = app_factory(WorkerTestConfig)
+        worker = app.extensions['search_indexer']
+        self.assertIsNone(worker.thread)
+        app.test_client().get('/auth/login')
+        self.assertTrue(worker.thread.is_alive())
+        self.assertIsNone(self.app.extensions['search_indexer'].thread)
+
+    def test_versions_need_sqlite(self):
+        # test: outbox ids are only in commit order on SQLite
+        class PostgresTestConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'postgresql://localhost/microblog'
+            SEARCH_BACKEND = 'embedded'
+        with self.assertRaisesRegex(ValueError, 'commit order'):
+            app_factory(PostgresTestConfig)
+        PostgresTestConfig.SEARCH_BACKEND = 'none'
+        app_factory(PostgresTestConfig)
+
+
+    def test_search_records(self):
+        u = User(username='john', email='john@example.com')
+        v = User(username='susan', email='susan@example.com')
+        p1 = Post(body='hello world', author=u)
+        p2 = Post(body='hello there', author=v)
+        db.session.add_all([u, v, p1, p2])
+        db.session.commit()
+        indexer.drain()
+
+        # test: results are rendered from the hits' stored fields alone
+        with QueryRecorder() as recorder:
+            records, total, _ = Post.search_records('hello', 1, 10)
+        self.assertEqual(recorder.statements, [])
+        self.assertEqual(total, 2)
+        self.assertEqual([(r.id, r.body, r.timestamp, r.author.username)
+            for r in records], [(p2.id, 'hello there', p2.timestamp, 'susan'),
+                (p1.id, 'hello world', p1.timestamp, 'john')])
+        self.assertEqual(records[1].author.get_avatar_image(size=70),
+            u.get_avatar_image(size=70))
+
+        # test: stored fields aren't searched
+        self.assertEqual(Post.search_records('john', 1, 10)[1], 0)
+
+        # test: renaming an author re-indexes all their posts
+        u.username = 'johnny'
+        db.session.commit()
+        self.assertEqual(indexer.backlog()[0], 1)
+        indexer.drain()
+        records, _, _ = Post.search_records('world', 1, 10)
+        self.assertEqual(records[0].author.username, 'johnny')
+
+        # test: hits without stored fields are loaded from the db once, then
+        # from the record cache until the post changes
+        for key, (version, source) in list(self.es.documents.items()):
+            self.es.documents[key] = (version, {'body': source['body']})
+        with QueryRecorder() as recorder:
+            records, _, _ = Post.search_records('hello', 1, 10)
+        self.assertEqual(len(recorder.statements), 1)
+        self.assertEqual([r.author.username for r in records],
+            ['susan', 'johnny'])
+        with QueryRecorder() as recorder:
+            Post.search_records('hello', 1, 10)
+        self.assertEqual(recorder.statements, [])
+        p1.body = 'hello again'
+        db.session.commit()
+        records, _, _ = Post.search_records('hello', 1, 10)
+        self.assertEqual(records[1].body, 'hello again')
+
+    def test_sync_indexing(self):
+        self.app.config['SEARCH_INDEXING'] = 'sync'
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='hello world', author=u)
+        p2 = Post(body='goodbye world', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+
+        # test: commits send their updates straight away, in one request
+        self.assertEqual(self.es.bulk_requests, 1)
+        self.assertEqual(self.indexed(),
+            {p1.id: 'hello world', p2.id: 'goodbye world'})
+        u.username = 'johnny'
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(self.indexed(), {p1.id: 'hello world'})
+        records, _, _ = Post.search_records('hello', 1, 10)
+        self.assertEqual(records[0].author.username, 'johnny')
+
+        # test: sync writes and the outbox's share a version sequence, so
+        # outbox updates made after a sync write aren't dropped as conflicts
+        self.app.config['SEARCH_INDEXING'] = 'outbox'
+        p1.body = 'hello outbox'
+        db.session.commit()
+        self.assertEqual(indexer.backlog()[0], 1)
+        self.assertEqual(indexer.drain(), 1)
+        self.assertEqual(self.indexed(), {p1.id: 'hello outbox'})
+
+    def test_reindex_resume(self):
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body=f'post {i}', author=u) for i in range(23)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        self.addCleanup(setattr, reindex, 'BULK_ATTEMPTS',
+            reindex.BULK_ATTEMPTS)
+        reindex.BULK_ATTEMPTS = 1
+
+        # test: an interrupted reindex keeps a checkpoint after the last
+        # chunk that made it into the index
+        self.es.fail_after = 2
+        with self.assertRaises(ConnectionError):
+            Post.reindex(chunk_size=5, workers=1)
+        checkpoint = reindex.get_checkpoint('post')
+        self.assertEqual((checkpoint.last_id, checkpoint.indexed),
+            (posts[9].id, 10))
+
+        # test: the next run resumes from the checkpoint
+        self.es.fail_after = None
+        progress = []
+        result = Post.reindex(chunk_size=5, workers=3,
+            progress=lambda indexed, elapsed: progress.append(indexed))
+        self.assertEqual((result.resumed_from, result.indexed),
+            (posts[9].id, 13))
+        self.assertEqual(progress[-1], 13)
+        self.assertEqual(self.indexed(),
+            {post.id: post.body for post in posts})
+        self.assertIsNone(reindex.get_checkpoint('post'))
+
+        # test: an in-place reindex doesn't take documents off the outbox's
+        # version sequence: updates made after it still apply
+        indexer.drain()
+        Post.reindex(chunk_size=5)
+        posts[-1].body = 'edited'
+        db.session.commit()
+        self.assertEqual(indexer.drain(), 1)
+        self.assertEqual(self.indexed()[posts[-1].id], 'edited')
+
+    def test_reindex_new_index(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='first', author=u)
+        p2 = Post(body='second', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        indexer.drain()
+        db.session.delete(p2)
+        db.session.commit() # not drained: the old index is now stale
+        self.addCleanup(setattr, reindex, 'BULK_ATTEMPTS',
+            reindex.BULK_ATTEMPTS)
+        reindex.BULK_ATTEMPTS = 1
+
+        # test: updates made during a build also go to the new index
+        self.es.fail_after = 0
+        with self.assertRaises(ConnectionError):
+            Post.reindex(new_index=True)
+        target = reindex.get_checkpoint('post').target
+        self.es.fail_after = None
+        p3 = Post(body='third', author=u)
+        db.session.add(p3)
+        db.session.commit()
+        self.assertEqual(indexer.drain(), 2)
+        self.assertEqual(self.indexed(), {p1.id: 'first', p3.id: 'third'})
+        self.assertEqual(self.indexed(target), {p3.id: 'third'})
+
+        # test: once complete, the name is swapped over to the new index
+        result = Post.reindex(new_index=True)
+        self.assertEqual(result.target, target)
+        self.assertEqual(self.es.aliases, {'post': target})
+        self.assertEqual(self.indexed(), {p1.id: 'first', p3.id: 'third'})
+        self.assertEqual(self.es.physical, {target})
+        posts, total, _ = Post.search('third', 1, 10)
+        self.assertEqual((posts.all(), total), ([p3], 1))
+
+
+class SearchCacheTestConfig(TestConfig):
+    SEARCH_CACHE_SIZE = 2
+
+
+class FakeRedis():
+    """
+    In-memory stand-in for the redis client calls the search cache makes.
+    """
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value.encode() if isinstance(value, str) else value
+
+    def incr(self, key):
+        self.values[key] = int(self.values.get(key) or 0) + 1
+        return self.values[key]
+
+
+class SearchCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app_factory(SearchCacheTestConfig)
+        self.es = FakeElasticsearch()
+        self.app.search_backend = ElasticsearchBackend(self.es)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def check_cache(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='hello world', author=u)
+        db.session.add_all([u, p1])
+        db.session.commit()
+        indexer.drain()
+
+        # test: repeated queries (up to case and spacing) hit the cache
+        records, total, _ = Post.search_records('hello', 1, 10)
+        self.assertEqual(([r.id for r in records], total), ([p1.id], 1))
+        self.assertEqual(Post.search_records(' HELLO ', 1, 10)[1], 1)
+        self.assertEqual(self.es.searches, 1)
+        Post.search_records('hello', 2, 10)
+        self.assertEqual(self.es.searches, 2)
+
+        # test: writing documents of the index invalidates its results
+        p2 = Post(body='hello again', author=u)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(Post.search_records('hello', 1, 10)[1], 1)
+        indexer.drain()
+        records, total, _ = Post.search_records('hello', 1, 10)
+        self.assertEqual(([r.id for r in records], total), ([p2.id, p1.id], 2))
+        self.assertEqual(self.es.searches, 3)
+        stats = search_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 3))
+        self.assertGreaterEqual(stats['invalidations'], 2)
+        return stats
+
+    def test_local_cache(self):
+        stats = self.check_cache()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['evictions'], 1) # LRU, size 2
+
+    def test_shared_cache(self):
+        redis = FakeRedis()
+        self.app.extensions['search_cache'].backend = RedisBackend(redis)
+        self.check_cache()
+        self.assertEqual(int(redis.get('search-cache:version:post')), 2)
+
+        # test: a backend failure is a miss, not an error
+        self.app.extensions['search_cache'].backend = RedisBackend(None)
+        self.assertEqual(Post.search_records('hello', 1, 10)[1], 2)
+        self.assertEqual(search_cache.stats()['errors'], 1)
+
+
+class EmbeddedSearchTestConfig(TestConfig):
+    SEARCH_BACKEND = 'embedded'
+
+
+class EmbeddedSearchCase(unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir)
+        EmbeddedSearchTestConfig.SEARCH_INDEX_DIR = self.index_dir
+        self.app = app_factory(EmbeddedSearchTestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_data_import(self):
+        """
+        Test that a bulk import indexes its posts with one reindex, not through the search outbox.
+        """
+        dataio.import_data(io.StringIO(
+            '{"type": "user", "id": 1, "username": "john"}\n'
+            '{"type": "post", "id": 1, "body": "hello world", "user_id": 1, '
+            '"timestamp": "2020-01-01T00:00:00"}\n'))
+        self.assertEqual(indexer.backlog()[0], 0)
+        records, total, _ = Post.search_records('hello', 1, 10)
+        self.assertEqual(([r.id for r in records], total), ([1], 1))
+        self.assertEqual(records[0].author.username, 'john')
+
+    def test_engine(self):
+        engine = searchengine.EmbeddedEngine(self.index_dir)
+        statuses = engine.bulk([
+            ('index', 'post', 1, None, {'body': 'the quick brown fox'}),
+            ('index', 'post', 2, None, {'body': 'the lazy dog'}),
+            ('index', 'post', 3, None, {'body': 'fox fox fox'}),
+            ('index', 'post', 4, None, {'body': 'a dog and a fox and a cat'})])
+        self.assertEqual(statuses, [201] * 4)
+
+        # test: OR-ed terms, ranked by BM25 (term frequency, length)
+        ids, total, last_sort, _ = engine.search('post', 'FOX', 1, 10)
+        self.assertEqual((ids, total), ([3, 1, 4], 3))
+        ids, total, _, _ = engine.search('post', 'dog cat', 1, 10)
+        self.assertEqual((ids, total), ([4, 2], 2))
+        self.assertEqual(engine.search('post', 'zebra', 1, 10)[:2], ([], 0))
+
+        # test: page 2 and search_after agree
+        _, _, first_page_sort, _ = engine.search('post', 'fox', 1, 2)
+        self.assertEqual(engine.search('post', 'fox', 2, 2)[0], [4])
+        self.assertEqual(engine.search('post', 'fox', 1, 2,
+            first_page_sort)[0], [4])
+
+        # test: updates, deletes and external versions
+        statuses = engine.bulk([
+            ('index', 'post', 1, None, {'body': 'the quick brown cat'}),
+            ('delete', 'post', 3, None, None),
+            ('delete', 'post', 99, None, None),
+            ('create', 'post', 2, None, {'body': 'ignored'}),
+            ('index', 'post', 5, 10, {'body': 'versioned fox'}),
+            ('index', 'post', 5, 9, {'body': 'stale fox'})])
+        self.assertEqual(statuses, [201, 200, 404, 409, 201, 409])
+        self.assertEqual(engine.search('post', 'fox', 1, 10)[0], [5, 4])
+        self.assertEqual(engine.search('post', 'cat', 1, 10)[0], [1, 4])
+        self.assertEqual(engine.bulk([('delete', 'post', 5, 11, None),
+            ('index', 'post', 5, 11, {'body': 'replayed'})]), [200, 409])
+        self.assertEqual(engine.bulk([('index', 'post', 5, 10, {'body': 'x'}),
+            ('index', 'post', 6, 12, {'body': 'y'})],
+            version_type='external_gte'), [409, 201])
+        self.assertEqual(engine.bulk([('index', 'post', 6, 12,
+            {'body': 'reindexed'})], version_type='external_gte'), [201])
+
+        # test: incremental writes are merged, and survive a restart
+        for id in range(100, 100 + 2 * searchengine.MERGE_FACTOR):
+            engine.bulk([('index', 'post', id * 1000, None,
+                {'body': f'fox number {id}'})])
+        engine = searchengine.EmbeddedEngine(self.index_dir)
+        ids, total, _, _ = engine.search('post', 'fox', 1, 100)
+        manifest, segments = engine.index('post').snapshot
+        self.assertLessEqual(len(segments), searchengine.MERGE_FACTOR)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.index_dir,
+            'post'))), sorted([entry['name'] for entry in manifest['segments']]
+                + ['manifest.json', 'write.lock']))
+        self.assertEqual(total, 1 + 2 * searchengine.MERGE_FACTOR)
+        self.assertEqual(ids[0], (99 + 2 * searchengine.MERGE_FACTOR) * 1000)
+        self.assertEqual(ids[-1], 4)
+        self.assertEqual(engine.search('post', 'number 105', 1, 1)[0],
+            [105000])
+
+    def test_engine_merges(self):
+        engine = searchengine.EmbeddedEngine(self.index_dir)
+        written = []
+        write_segment = searchengine.write_segment
+
+        def counting(path, docs, postings):
+            docs = list(docs)
+            written.append(len(docs))
+            return write_segment(path, docs, postings)
+        self.addCleanup(setattr, searchengine, 'write_segment', write_segment)
+        searchengine.write_segment = counting
+
+        # test: merges go by size tier, so each document is rewritten about
+        # once per tier rather than on every merge
+        count = 1000
+        for id in range(count):
+            engine.bulk([('index', 'post', id, None, {'body': f'fox {id}'})])
+        tiers = math.ceil(math.log(count, searchengine.MERGE_FACTOR))
+        self.assertLessEqual(sum(written), count * (tiers + 1))
+        manifest, segments = engine.index('post').snapshot
+        self.assertLessEqual(len(segments),
+            (searchengine.MERGE_FACTOR - 1) * (tiers + 1))
+        self.assertEqual(engine.search('post', 'fox', 1, 1)[1], count)
+
+    def test_engine_tombstones(self):
+        # test: the versions of deleted documents conflict with stale writes
+        # for TOMBSTONE_SECONDS ...
+        engine = searchengine.EmbeddedEngine(self.index_dir)
+        engine.bulk([('index', 'post', id, 1, {'body': 'fox'})
+            for id in range(10)])
+        engine.bulk([('delete', 'post', id, 2, None) for id in range(5)])
+        self.assertEqual(engine.bulk([('index', 'post', 0, 1,
+            {'body': 'stale'})]), [409])
+        manifest, _ = engine.index('post').snapshot
+        self.assertEqual(sorted(map(int, manifest['deleted_versions'])),
+            list(range(5)))
+
+        # ... then are dropped once the segments holding the documents are
+        # merged away
+        self.addCleanup(setattr, searchengine, 'TOMBSTONE_SECONDS',
+            searchengine.TOMBSTONE_SECONDS)
+        searchengine.TOMBSTONE_SECONDS = -1
+        engine.bulk([('delete', 'post', 5, 2, None)])
+        manifest, segments = engine.index('post').snapshot
+        self.assertEqual(manifest['deleted_versions'], {})
+        self.assertEqual(engine.search('post', 'fox', 1, 10)[:2],
+            ([9, 8, 7, 6], 4))
+        self.assertEqual(engine.bulk([('index', 'post', 0, 1,
+            {'body': 'fox'})]), [201])
+
+    def test_engine_top_hits(self):
+        # test: pruned searches (past TRACK_TOTAL_HITS) rank like exact ones
+        engine = searchengine.EmbeddedEngine(self.index_dir)
+        rng = random.Random(1)
+        words = [f'w{i}' for i in range(50)]
+        weights = [1 / (i + 1) for i in range(50)]
+        engine.bulk([('index', 'post', id, None, {'body': ' '.join(
+            rng.choices(words, weights, k=rng.randint(2, 12)))})
+            for id in range(3000)])
+        queries = ['w0 w1', 'w0 w7 w30', 'w2 w3 w4 w5']
+        exact = [engine.search('post', query, page, 10)
+            for query in queries for page in (1, 3)]
+        self.addCleanup(setattr, searchengine, 'TRACK_TOTAL_HITS',
+            searchengine.TRACK_TOTAL_HITS)
+        self.addCleanup(setattr, searchengine, 'SCORE_BLOCK',
+            searchengine.SCORE_BLOCK)
+        searchengine.TRACK_TOTAL_HITS = 50
+        searchengine.SCORE_BLOCK = 64
+        pruned = [engine.search('post', query, page, 10)
+            for query in queries for page in (1, 3)]
+        self.assertEqual([result[0] for result in pruned],
+            [result[0] for result in exact])
+        for (_, total, _, _), (_, exact_total, _, _) in zip(pruned, exact):
+            self.assertLessEqual(total, exact_total)
+            self.assertGreaterEqual(total, min(50, exact_total))
+        # ... and so do search_after pages
+        _, _, last_sort, _ = engine.search('post', 'w0 w1', 2, 10)
+        self.assertEqual(engine.search('post', 'w0 w1', 1, 10, last_sort)[0],
+            exact[1][0])
+
+    def test_embedded_backend(self):
+        self.assertIsInstance(self.app.search_backend, EmbeddedBackend)
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='hello world', author=u)
+        p2 = Post(body='goodbye world', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+
+        # test: the outbox drains into the embedded index
+        self.assertEqual(indexer.drain(), 2)
+        posts, total, _ = Post.search('world', 1, 10)
+        self.assertEqual((posts.all(), total), ([p2, p1], 2))
+        records, _, _ = Post.search_records('world', 1, 10)
+        self.assertEqual([(r.id, r.body, r.author.username) for r in records],
+            [(p2.id, 'goodbye world', 'john'), (p1.id, 'hello world', 'john')])
+
+        # test: rebuilding into a new index swaps the name over to it
+        db.session.delete(p2)
+        db.session.commit()
+        result = Post.reindex(new_index=True)
+        self.assertEqual(result.indexed, 1)
+        self.assertEqual(self.app.search_backend.alias_targets('post'),
+            [result.target])
+        self.assertFalse(os.path.exists(os.path.join(self.index_dir, 'post')))
+        posts, total, _ = Post.search('world', 1, 10)
+        self.assertEqual((posts.all(), total), ([p1], 1))
+
+
+class QueryRecorder():
+    """
+    Context manager that records every SQL statement (and its parameters) sent to the database.
+    """
+    def __enter__(self):
+        self.statements = []
+        db.event.listen(db.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        db.event.remove(db.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context,
+            executemany):
+        if executemany:
+            parameters = parameters[0]
+        self.statements.append((statement, parameters))
+
+
+class RoutesCase(unittest.TestCase):
+    config_class = TestConfig
+
+    def setUp(self):
+        self.app = app_factory(self.config_class)
+        self.app.config['POSTS_PER_PAGE'] = 2
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, user):
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+            session['_fresh'] = True
+
+    def make_posts(self, author, count):
+        """
+        Make `count` posts by author; several share a timestamp so the id tiebreaker is exercised. Returns them newest first.
+        """
+        now = datetime.utcnow()
+        posts = [Post(body=f'post {i}', author=author,
+            timestamp=now + timedelta(seconds=i // 2)) for i in range(count)]
+        db.session.add_all(posts)
+        db.session.commit()
+        return sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+
+    def walk(self, url):
+        """
+        Follow the 'Older posts' links from url; returns the post bodies seen on each page and the last page's 'Newer posts' link.
+        """
+        pages = []
+        while True:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            html = response.get_data(as_text=True)
+            pages.append(re.findall(r'<br>\s*(post \d+)', html))
+            older = re.search(r'<li class="next">\s*<a href="([^"#]+)"', html)
+            newer = re.search(r'<li class="previous">\s*<a href="([^"#]+)"', html)
+            if older is None:
+                return pages, newer and newer.group(1).replace('&amp;', '&')
+            url = older.group(1).replace('&amp;', '&')
+
+    def test_keyset_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='sally', email='sally@example.com')
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        db.session.commit()
+        expected = [p.body for p in self.make_posts(u2, 7)]
+        self.login(u1)
+        for url in ('/explore', '/index', '/user/sally'):
+            # test: cursor links visit every post once, in order
+            pages, newer_url = self.walk(url)
+            self.assertEqual(sum(pages, []), expected)
+            self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+            # test: the 'Newer posts' link returns the previous page
+            newer_pages, _ = self.walk(newer_url)
+            self.assertEqual(newer_pages[0], pages[-2])
+            # test: legacy ?page= links still work
+            legacy_pages, _ = self.walk(url + '?page=2')
+            self.assertEqual(sum(legacy_pages, []), expected[2:])
+        self.assertEqual(self.client.get('/explore?after=junk').status_code,
+            400)
+
+    def test_post_records(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='sally', email='sally@example.com')
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        db.session.commit()
+        self.make_posts(u1, 2)
+        self.make_posts(u2, 3)
+        self.login(u1)
+        self.app.config['FRAGMENT_CACHE_TTL'] = 0
+        loaded = []
+        count_post = lambda target, context: loaded.append(target)
+        db.event.listen(Post, 'load', count_post)
+        self.addCleanup(db.event.remove, Post, 'load', count_post)
+
+        # test: pages render the same from records as from Post objects,
+        # and build no Post objects
+        for url in ('/index', '/index?page=2', '/explore?page=2',
+                '/user/sally'):
+            pages = []
+            for records in (False, True):
+                self.app.config['POST_RECORDS'] = records
+                db.session.remove() # start from an empty identity map
+                loaded.clear()
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                pages.append(response.get_data(as_text=True))
+                self.assertEqual(bool(loaded), not records, url)
+            self.assertEqual(pages[0], pages[1], url)
+
+    def test_post_fragments(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.make_posts(u, 2)
+        self.login(u)
+        fragments = self.app.extensions['post_fragments']
+
+        # test: each post is rendered once, then served from the cache
+        said = lambda url, username: len(re.findall(
+            rf'href="/user/{username}">\s*{username}\s*</a>\s*said',
+            self.client.get(url).get_data(as_text=True)))
+        self.assertEqual(said('/explore', 'john'), 2)
+        self.assertEqual(len(fragments), 2)
+        self.assertEqual(said('/index', 'john'), 2)
+        self.assertEqual(len(fragments), 2)
+
+        # test: editing the username supersedes the user's fragments
+        self.client.post('/edit_profile', data={'username': 'johnny',
+            'about_me': ''})
+        self.assertEqual(said('/explore', 'john'), 0)
+        self.assertEqual(said('/explore', 'johnny'), 2)
+        self.assertEqual(len(fragments), 4)
+
+    def test_explore_buffer(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        expected = [p.body for p in self.make_posts(u, 5)]
+        self.login(u)
+        buffer = self.app.extensions['explore_buffer']
+        buffer.size = 3
+        post_statements = lambda recorder: [statement for statement, _
+            in recorder.statements if re.search(r'\bFROM post\b', statement)]
+
+        # test: the first page is served from the buffer, without SQL; the
+        # pages past the buffer fall back to the db
+        pages, _ = self.walk('/explore')
+        self.assertEqual(sum(pages, []), expected)
+        with QueryRecorder() as recorder:
+            self.client.get('/explore')
+        self.assertEqual(post_statements(recorder), [])
+        self.assertEqual(len(buffer.records), 3)
+
+        # test: posts committed by this process are added as they commit
+        self.client.post('/index', data={'post': 'post 100'})
+        pages, _ = self.walk('/explore')
+        self.assertEqual(sorted(sum(pages, [])), sorted(expected + ['post 100']))
+
+        # test: posts committed by another process are fetched once the
+        # shared mark says so
+        db.session.execute(Post.__table__.insert().values(body='post 101',
+            user_id=u.id, timestamp=datetime.utcnow() + timedelta(minutes=1)))
+        db.session.commit()
+        self.assertNotEqual(self.walk('/explore')[0][0][0], 'post 101')
+        buffer.mark.bump(generation=1)
+        with QueryRecorder() as recorder:
+            self.assertEqual(self.walk('/explore')[0][0][0], 'post 101')
+        # the new post's fetch, then pages 2-4 (past the buffer)
+        self.assertEqual(len(post_statements(recorder)), 4)
+
+        # test: syncs query without holding the buffer's lock, and one that
+        # another sync overtook meanwhile drops its (older) rows
+        def overtaken():
+            self.assertFalse(buffer.lock.locked())
+            del buffer.fetch_all
+            buffer.sync() # another request's
+            return []
+        buffer.fetch_all = overtaken
+        buffer.mark.bump(epoch=1)
+        buffer.sync()
+        self.assertEqual(buffer.seen, buffer.mark.read())
+        self.assertEqual(len(buffer.records), 3)
+
+    def test_explore_buffer_mark_file(self):
+        # test: the default mark file isn't in the source tree
+        self.assertFalse(Config.EXPLORE_BUFFER_MARK_FILE.startswith(
+            os.path.dirname(os.path.abspath(__file__)) + os.sep))
+
+        # test: a mark file that can't be opened falls back to a local mark
+        class MarkTestConfig(TestConfig):
+            EXPLORE_BUFFER_MARK_FILE = os.path.join(tempfile.gettempdir(),
+                'no-such-dir', 'explore.mark')
+        with self.assertLogs(level='WARNING') as logs:
+            app = app_factory(MarkTestConfig)
+        self.assertIn('cannot open the mark file', logs.output[0])
+        mark = app.extensions['explore_buffer'].mark
+        self.assertIsNone(mark.path)
+        self.assertEqual(mark.bump(generation=1), ((0, 0), (1, 0)))
+
+    def test_user_cache(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        self.login(u)
+        cached = self.app.extensions['user_cache'].backend.get
+        user_statements = lambda recorder: [statement for statement, _
+            in recorder.statements if re.search(r'\bFROM user\b', statement)]
+
+        # test: once cached, requests get current_user without SQL
+        self.client.get('/edit_profile')
+        self.assertEqual(cached(user_id)['username'], 'john')
+        self.assertNotIn('password_hash', cached(user_id))
+        db.session.remove()
+        with QueryRecorder() as recorder:
+            html = self.client.get('/edit_profile').get_data(as_text=True)
+        self.assertEqual(user_statements(recorder), [])
+        self.assertIn('value="john"', html)
+
+        # test: profile edits evict the user; the next request reloads them
+        self.client.post('/edit_profile', data={'username': 'johnny',
+            'about_me': 'hi'})
+        self.assertIsNone(cached(user_id))
+        self.client.get('/edit_profile')
+        self.assertEqual(cached(user_id)['about_me'], 'hi')
+
+        # test: so do password changes and last_seen flushes
+        u = User.query.get(user_id)
+        u.set_password('dog')
+        db.session.commit()
+        self.assertIsNone(cached(user_id))
+        self.client.get('/edit_profile')
+        last_seen_buffer.touch(user_id, when=datetime.utcnow() +
+            timedelta(hours=1))
+        self.assertIsNone(cached(user_id))
+
+        # test: the password hash is loaded on access
+        self.client.get('/edit_profile')
+        db.session.remove()
+        self.assertTrue(self.app.extensions['user_cache'].load(user_id).
+            check_password('dog'))
+
+        # test: a stale entry (the user renamed by another process) isn't
+        # written back: writing requests reload the user, and the profile
+        # version is bumped from the db's
+        self.client.get('/edit_profile')
+        stale = cached(user_id)
+        db.session.execute(User.__table__.update().
+            where(User.id == user_id).values(username='john2',
+                profile_version=User.profile_version + 1))
+        db.session.commit()
+        self.app.extensions['user_cache'].backend.set(user_id, stale, 60)
+        db.session.remove()
+        self.client.post('/edit_profile', data={'username': 'john3',
+            'about_me': 'hi'})
+        db.session.remove()
+        u = User.query.get(user_id)
+        self.assertEqual((u.username, u.profile_version),
+            ('john3', stale['profile_version'] + 2))
+        db.session.remove()
+        u = self.app.extensions['user_cache'].attach(stale)
+        u.username = 'john4'
+        db.session.commit()
+        self.assertEqual(u.profile_version, stale['profile_version'] + 3)
+
+    def test_conditional_get(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        self.make_posts(u2, 3)
+        self.login(u1)
+        ids = {u.username: u.id for u in (u1, u2, u3)}
+
+        def get(url):
+            # a request revalidating the page as of its previous response
+            etag = etags.get(url)
+            headers = {'If-None-Match': etag} if etag else {}
+            response = self.client.get(url, headers=headers)
+            if response.headers.get('ETag'):
+                etags[url] = response.headers['ETag']
+            return response.status_code
+
+        def change(func):
+            func()
+            db.session.commit()
+            db.session.remove()
+
+        etags = {}
+        urls = ['/index', '/explore', '/user/susan']
+        # test: unchanged pages are answered with 304, without rendering
+        self.assertEqual([get(url) for url in urls], [200, 200, 200])
+        self.assertEqual([get(url) for url in urls], [304, 304, 304])
+        response = self.client.get('/index',
+            headers={'If-None-Match': etags['/index']})
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+
+        # test: a post by a followed user changes every page that shows it
+        change(lambda: db.session.add(Post(body='new',
+            author=User.query.get(ids['susan']))))
+        self.assertEqual([get(url) for url in urls], [200, 200, 200])
+        # ... and a post by anyone else only explore
+        change(lambda: db.session.add(Post(body='other',
+            author=User.query.get(ids['mary']))))
+        self.assertEqual([get(url) for url in urls], [304, 200, 304])
+
+        # test: so does a post replacing a deleted one (same posts_count)
+        def replace():
+            susan = User.query.get(ids['susan'])
+            db.session.delete(susan.posts.order_by(Post.id).first())
+            db.session.add(Post(body='replacement', author=susan))
+        change(replace)
+        self.assertEqual([get(url) for url in urls], [200, 200, 200])
+
+        # test: renaming a followed author changes the pages showing them
+        def rename():
+            User.query.get(ids['susan']).username = 'susan2'
+        change(rename)
+        urls[2] = '/user/susan2'
+        self.assertEqual([get(url) for url in urls], [200, 200, 200])
+
+        # test: the viewer's follows change their pages (timeline, links)
+        change(lambda: User.query.get(ids['john']).follow(
+            User.query.get(ids['mary'])))
+        self.assertEqual([get(url) for url in urls], [200, 200, 200])
+
+        # test: ETags are per viewer
+        self.login(User.query.get(ids['mary']))
+        self.assertEqual([get(url) for url in urls], [200, 200, 200])
+
+        # test: pages showing flash messages get no ETag
+        self.client.get('/follow/john')
+        response = self.client.get('/user/john')
+        self.assertIn('following john', response.get_data(as_text=True))
+        self.assertNotIn('ETag', response.headers)
+
+    def test_live_updates(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='sally', email='sally@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        db.session.commit()
+        expected = [p.id for p in self.make_posts(u2, 3)]
+        newest = self.make_posts(u3, 1)[0].id
+        self.login(u1)
+        self.app.config['POSTS_PER_PAGE'] = 10
+        self.app.config['LIVE_POLL_TIMEOUT'] = 1
+        hub = self.app.extensions['live_hub']
+        poll = lambda since, suffix='': json.loads(self.client.get(
+            f'/posts/new?since={since}{suffix}').get_data(as_text=True))
+        self.assertEqual(self.client.get('/posts/new').status_code, 400)
+
+        # test: the followed accounts' posts newer than `since` (from the db:
+        # they were committed before the hub started), and the newest id
+        # checked
+        batch = poll(0)
+        self.assertEqual(batch['ids'], expected)
+        self.assertEqual(batch['since'], newest)
+        self.assertEqual(batch['html'].count('said'), 3)
+        self.assertEqual(poll(expected[1])['ids'], expected[:1])
+        self.assertEqual(poll(0, '&html=0')['html'], '')
+
+        # test: a poll with nothing new waits, and gets the posts committed
+        # meanwhile from the hub
+        self.assertEqual(poll(newest), {'since': newest, 'ids': [],
+            'html': ''})
+        self.assertEqual(hub.stats()['waiting'], 0)
+        post = Post(body='new', author=u2)
+        unfollowed = Post(body='unfollowed', author=u3)
+        db.session.add_all([post, unfollowed])
+        db.session.commit()
+        record = PostRecord.from_model(post)
+        since, newest = newest, unfollowed.id
+        with QueryRecorder() as recorder:
+            batch = poll(since)
+        self.assertEqual(batch['ids'], [record.id])
+        self.assertEqual(batch['since'], newest)
+        self.assertFalse([statement for statement, _ in recorder.statements
+            if 'FROM post' in statement])
+        # (as if committed by another thread)
+        later = PostRecord(newest + 10, 'later', record.timestamp,
+            record.author)
+        publisher = threading.Timer(0.1, hub.publish, args=([later],))
+        publisher.start()
+        self.assertEqual(poll(newest)['ids'], [later.id])
+        publisher.join()
+        self.assertEqual(hub.stats()['wakeups'], 1)
+
+        # test: SSE streams send an event per batch, resuming from the
+        # Last-Event-ID of a reconnecting client
+        self.app.config['LIVE_STREAM_SECONDS'] = 1
+        self.app.config['LIVE_HEARTBEAT'] = 1
+        sse = {'Accept': 'text/event-stream'}
+        response = self.client.get('/posts/new?since=0', headers=sse)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = response.get_data(as_text=True).split('\n\n')
+        self.assertEqual(events[0], 'retry: 1000')
+        # the posts in the db, then the one only in the hub
+        self.assertTrue(events[1].startswith(
+            f'id: {record.id}\nevent: posts\ndata: '))
+        self.assertEqual(json.loads(events[1].split('data: ')[1])['ids'],
+            [record.id] + expected)
+        self.assertEqual(json.loads(events[2].split('data: ')[1])['ids'],
+            [later.id])
+        events = self.client.get('/posts/new?since=0', headers=dict(sse,
+            **{'Last-Event-ID': later.id})).get_data(as_text=True)
+        self.assertNotIn('event: posts', events)
+        self.assertIn(f': heartbeat\nid: {later.id}', events)
+
+    def test_compression(self):
+        chunks = ['line {}\n'.format(n) * 50 for n in range(3)]
+        self.app.add_url_rule('/stream', 'stream', lambda: self.app.
+            response_class((chunk for chunk in chunks), mimetype='text/plain'))
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.make_posts(u, 10)
+        self.login(u)
+        self.app.config['POSTS_PER_PAGE'] = 10
+        gzipped = {'Accept-Encoding': 'gzip'}
+
+        # test: pages are compressed when the client accepts it
+        plain = self.client.get('/explore')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+        response = self.client.get('/explore', headers=gzipped)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertLess(len(response.get_data()), len(plain.get_data()) / 2)
+        self.assertEqual(gzip.decompress(response.get_data()),
+            plain.get_data())
+        # ... if they're large enough
+        self.app.extensions['compression'].min_size = 10 ** 6
+        response = self.client.get('/explore', headers=gzipped)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.app.extensions['compression'].min_size = 0
+
+        # test: pages with a CSRF token aren't compressed if they may reflect
+        # the request's input (BREACH)
+        self.app.config['WTF_CSRF_ENABLED'] = True
+        response = self.client.get('/index', headers=gzipped)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn(b'csrf_token', gzip.decompress(response.get_data()))
+        for response in (self.client.get('/index?page=1', headers=gzipped),
+                self.client.post('/index', data={'post': ''},
+                    headers=gzipped)):
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'csrf_token', response.get_data())
+            self.assertNotIn('Content-Encoding', response.headers)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app.extensions['compression'].min_size = 10 ** 6
+
+        # test: streamed responses are compressed as they're sent
+        response = self.client.get('/stream', headers=gzipped)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.get_data()),
+            ''.join(chunks).encode('utf-8'))
+
+        # test: static files are sent precompressed, if they've been
+        static_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_dir)
+        self.app.static_folder = static_dir
+        self.app.blueprints['bootstrap'].static_folder = None
+        css = b'body { margin: 0; }\n' * 100
+        with open(os.path.join(static_dir, 'site.css'), 'wb') as f:
+            f.write(css)
+        response = self.client.get('/static/site.css', headers=gzipped)
+        self.assertNotIn('Content-Encoding', response.headers)
+        response.close()
+        files = compress_static(self.app)
+        self.assertEqual([(os.path.basename(path), size)
+            for path, size, _ in files], [('site.css', len(css))])
+        response = self.client.get('/static/site.css', headers=gzipped)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertEqual(gzip.decompress(response.get_data()), css)
+        response.close()
+        response = self.client.get('/static/site.css')
+        self.assertEqual(response.get_data(), css)
+        response.close()
+
+    def test_statements_per_page(self):
+        """
+        The number of SQL statements per page doesn't grow with the page size (i.e., post authors aren't loaded one by one).
+        """
+        viewer = User(username='viewer', email='viewer@example.com')
+        authors = [User(username=f'user{i}', email=f'user{i}@example.com')
+            for i in range(30)]
+        db.session.add_all([viewer] + authors)
+        for author in authors:
+            viewer.follow(author)
+        db.session.add_all([Post(body=f'post {i}', author=author)
+            for i, author in enumerate(authors)])
+        db.session.commit()
+        self.login(viewer)
+        for url in ('/index', '/explore', '/user/user0'):
+            self.client.get(url)
+            counts = []
+            for per_page in (5, 25):
+                self.app.config['POSTS_PER_PAGE'] = per_page
+                db.session.remove() # start from an empty identity map
+                with QueryRecorder() as recorder:
+                    self.client.get(url)
+                counts.append(len(recorder.statements))
+            self.assertEqual(counts[0], counts[1], url)
+
+
+class MetricsTestConfig(TestConfig):
+    METRICS_ENABLED = True
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app_factory(MetricsTestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_metrics(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Post(body='hello', author=u)])
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(u.id)
+            session['_fresh'] = True
+        self.client.get('/user/john')
+        self.client.get('/user/john')
+        self.client.get('/user/nobody')
+
+        # test: per-endpoint requests, latency histogram and SQL totals
+        totals = self.app.extensions['metrics'].snapshot()['main.user']
+        self.assertEqual(totals['requests'], {200: 2, 404: 1})
+        self.assertGreater(totals['sql_count'], 3)
+        self.assertGreater(totals['template_time'], 0)
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('minitwitter_requests_total{endpoint="main.user",'
+            'status="404"} 1', text)
+        self.assertIn('minitwitter_request_duration_seconds_bucket{endpoint='
+            '"main.user",le="+Inf"} 3', text)
+        self.assertIn(f'minitwitter_sql_statements_total{{endpoint='
+            f'"main.user",bind="primary"}} {totals["sql_count"]}', text)
+
+        # test: slow requests are logged with their statements
+        self.app.config['METRICS_SLOW_REQUEST_MS'] = 0.001
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get('/user/john')
+        self.assertIn('slow request: GET /user/john? (main.user) 200',
+            logs.output[0])
+        self.assertIn('FROM post WHERE', logs.output[0])
+
+
+class ReplicaTestConfig(TestConfig):
+    EXPLORE_BUFFER_SIZE = 0
+
+
+class ReplicaCase(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.db_dir)
+        primary = os.path.join(self.db_dir, 'primary.db')
+        self.replica = os.path.join(self.db_dir, 'replica.db')
+        ReplicaTestConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + primary
+        ReplicaTestConfig.SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + self.replica]
+        self.app = app_factory(ReplicaTestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+
+    def client_for(self, user_id):
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = str(user_id)
+            session['_fresh'] = True
+        return client
+
+    def test_read_replica(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='sally', email='sally@example.com')
+        db.session.add_all([u1, u2, Post(body='old post', author=u2)])
+        db.session.commit()
+        john_id, sally_id = u1.id, u2.id
+        # the replica is a copy of the primary that never catches up
+        db.session.remove()
+        db.get_engine(self.app).dispose()
+        shutil.copyfile(self.app.config['SQLALCHEMY_DATABASE_URI'][10:],
+            self.replica)
+        db.session.add(Post(body='new post', author=User.query.get(sally_id)))
+        db.session.commit()
+        john, sally = self.client_for(john_id), self.client_for(sally_id)
+
+        # test: GET requests read from the replica
+        html = john.get('/user/sally').get_data(as_text=True)
+        self.assertIn('old post', html)
+        self.assertNotIn('new post', html)
+
+        # test: after writing, the user reads from the primary
+        response = sally.post('/index', data={'post': 'my post'})
+        self.assertEqual(response.status_code, 302)
+        html = sally.get('/user/sally').get_data(as_text=True)
+        self.assertIn('my post', html)
+        self.assertIn('new post', html)
+        self.assertNotIn('my post', john.get('/user/sally').
+            get_data(as_text=True))
+
+        # test: views that write on GET read from the primary (sally is
+        # only followable on the primary: she doesn't exist on the replica)
+        db.session.execute(User.__table__.update().where(
+            User.id == sally_id).values(username='sally2'))
+        db.session.commit()
+        john.get('/follow/sally2')
+        self.assertEqual(User.query.get(john_id).followed.count(), 1)
+        # ... and pin the user to the primary
+        self.assertIn('my post', john.get('/user/sally2').
+            get_data(as_text=True))
+
+    def test_replica_metrics(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        john_id = u.id
+        db.session.remove()
+        db.get_engine(self.app).dispose()
+        shutil.copyfile(self.app.config['SQLALCHEMY_DATABASE_URI'][10:],
+            self.replica)
+        class MetricsReplicaTestConfig(ReplicaTestConfig):
+            METRICS_ENABLED = True
+        self.app = app_factory(MetricsReplicaTestConfig)
+        john = self.client_for(john_id)
+
+        # test: statements are counted on the replicas too, by bind
+        john.get('/user/john')
+        john.post('/edit_profile', data={'username': 'john',
+            'about_me': 'hi'})
+        metrics = self.app.extensions['metrics'].snapshot()
+        binds = metrics['main.user']['sql_binds']
+        self.assertIn('replica0', binds)
+        self.assertEqual(sum(count for count, _ in binds.values()),
+            metrics['main.user']['sql_count'])
+        self.assertNotIn('replica0', metrics['main.edit_profile']['sql_binds'])
+        count, _ = binds['replica0']
+        text = john.get('/metrics').get_data(as_text=True)
+        self.assertIn(f'minitwitter_sql_statements_total{{endpoint='
+            f'"main.user",bind="replica0"}} {count}', text)
+
+
+class PasswordHashingTestConfig(TestConfig):
+    PASSWORD_HASH_WORKERS = 1
+    PASSWORD_HASH_QUEUE = 0
+
+
+class PasswordHashingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app_factory(PasswordHashingTestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self):
+        return self.client.post('/auth/login', data={'username': 'john',
+            'password': 'cat'})
+
+    def test_hashing_pool(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        hasher = self.app.extensions['password_hasher']
+
+        # test: hashes are computed and checked in the pool
+        self.assertTrue(u.check_password('cat'))
+        self.assertFalse(u.check_password('dog'))
+        self.assertEqual(hasher.stats()['hashes'], 3)
+
+        # test: past the pool's capacity, logins get a 503 straight away
+        hasher.counts['pending'] = hasher.slots
+        response = self.login()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '2')
+        self.assertEqual(hasher.stats()['rejected'], 1)
+        hasher.counts['pending'] = 0
+        self.assertEqual(self.login().status_code, 302)
+
+        # test: a login rehashes the password once the method changes
+        self.client.get('/auth/logout')
+        hasher.method = 'pbkdf2:sha256:1000'
+        self.assertEqual(self.login().status_code, 302)
+        u = User.query.filter_by(username='john').first()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(u.check_password('cat'))
+
+
+class SQLiteProductionTestConfig(TestConfig):
+    SQLITE_PROFILE = 'production'
+    SQLITE_WRITE_QUEUE = True
+
+
+class SQLiteProductionCase(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.db_dir)
+        SQLiteProductionTestConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + \
+            os.path.join(self.db_dir, 'app.db')
+        self.app = app_factory(SQLiteProductionTestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+
+    def test_pragmas(self):
+        engine = db.get_engine(self.app)
+        self.assertEqual(engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(engine.execute('PRAGMA synchronous').scalar(), 1)
+        self.assertEqual(engine.pool.size(), self.app.config['SQLITE_POOL_SIZE'])
+
+    def test_write_queue(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        writer = self.app.extensions['sqlite_writer']
+
+        # test: a rollback (or a session closed without committing) only
+        # undoes its own writes, and hands the writer over
+        db.session.add(Post(body='rolled back', author=u))
+        db.session.flush()
+        db.session.rollback()
+        db.session.add(Post(body='closed', author=User.query.get(user_id)))
+        db.session.flush()
+        db.session.remove()
+        db.session.add(Post(body='kept', author=User.query.get(user_id)))
+        db.session.commit()
+        self.assertEqual([p.body for p in Post.query.all()], ['kept'])
+
+        # test: concurrent writers are serialized and group-committed
+        def write(number):
+            with self.app.app_context():
+                for n in range(10):
+                    db.session.add(Post(body=f'post {number}.{n}',
+                        author=User.query.get(user_id)))
+                    db.session.commit()
+                db.session.remove()
+        groups = writer.committed
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(Post.query.count(), 41)
+        self.assertEqual(User.query.get(user_id).posts_count, 41)
+        self.assertLessEqual(writer.committed - groups, 40)
+        # ... and visible to the other connections
+        self.assertEqual(db.get_engine(self.app).execute(
+            'SELECT count(*) FROM post').scalar(), 41)
+
+
+class QueryPlanCase(RoutesCase):
+    """
+    Runs EXPLAIN QUERY PLAN on every statement the routes issue against a seeded dataset, and fails if any of them scans a whole table or index.
+    """
+    # e.g. 'SCAN post', 'SCAN TABLE post' or 'SCAN post USING COVERING INDEX
+    # ...': only SEARCHes (index lookups and range scans) are accepted, and
+    # index-order walks that a LIMIT stops (see bounded_walk())
+    table_scan = re.compile(r'^SCAN (?:TABLE )?(\w+)\b')
+    index_walk = re.compile(r'^SCAN (?:TABLE )?\w+ USING (?:COVERING )?INDEX ')
+
+    def seed(self):
+        now = datetime.utcnow()
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+            for i in range(20)]
+        db.session.add_all(users)
+        db.session.add_all([Post(body=f'post {i}', author=users[i % 20],
+            timestamp=now + timedelta(seconds=i)) for i in range(400)])
+        for i, user in enumerate(users):
+            for j in (1, 2, 3):
+                user.follow(users[(i + j) % 20])
+        db.session.commit()
+        indexer.drain()
+        return users
+
+    def explain(self, statement, parameters):
+        """
+        Returns the (id, parent, detail) rows of the statement's query plan.
+        """
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            return [tuple(row[:2]) + (row[-1],) for row in cursor.fetchall()]
+        finally:
+            connection.close()
+
+    def bounded_walk(self, plan, step, statement):
+        """
+        Returns True if the plan step walks an index in ORDER BY order as the statement's outermost loop, which its LIMIT stops after (offset +) limit rows (e.g., the first /explore page, of every post).
+        """
+        top_level = [row for row in plan if row[1] == 0]
+        return bool(self.index_walk.match(step[2])) and \
+            top_level and step is top_level[0] and \
+            re.search(r'\bORDER BY\b[^()]*\bLIMIT\b[^()]*$', statement)
+
+    def link(self, html, rel):
+        match = re.search(rf'<li class=["\']{rel}["\']>\s*<a href="([^"#]+)"',
+            html)
+        return match.group(1).replace('&amp;', '&')
+
+    def test_no_table_scans(self):
+        # restart the app so that every /explore page is read from the db
+        # (no buffer), and /search runs against the embedded engine
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        self.tearDown()
+        self.config_class = type('QueryPlanTestConfig', (self.config_class,),
+            {'EXPLORE_BUFFER_SIZE': 0, 'SEARCH_BACKEND': 'embedded',
+             'SEARCH_INDEX_DIR': index_dir})
+        self.setUp()
+        users = self.seed()
+        self.login(users[0])
+        table_names = set(db.metadata.tables)
+        with QueryRecorder() as recorder:
+            self.client.post('/index', data={'post': 'new post'})
+            for url in ('/index', '/explore', '/user/user5'):
+                html = self.client.get(url).get_data(as_text=True)
+                # older (after=), then newer again (before=) pages
+                html = self.client.get(self.link(html, 'next')). \
+                    get_data(as_text=True)
+                self.client.get(self.link(html, 'previous'))
+                # old ?page= links
+                self.client.get(url + '?page=3')
+            html = self.client.get('/search?q=post').get_data(as_text=True)
+            self.client.get(self.link(html, 'next'))
+            self.client.get('/follow/user10')
+            self.client.get('/unfollow/user1')
+            self.client.get('/edit_profile')
+        self.assertTrue(recorder.statements)
+        for statement, parameters in recorder.statements:
+            plan = self.explain(statement, parameters)
+            for step in plan:
+                match = self.table_scan.match(step[2])
+                if match and match.group(1) in table_names and \
+                        not self.bounded_walk(plan, step, statement):
+                    self.fail(f'{step[2]!r} in query plan of:\n{statement}')
+
+
+class FanoutQueryPlanCase(QueryPlanCase):
+    config_class = FanoutTestConfig
+
+
+class HybridQueryPlanCase(QueryPlanCase):
+    config_class = HybridTestConfig
+
+
+class FanoutRoutesCase(RoutesCase):
+    config_class = FanoutTestConfig
+
+
+class HybridRoutesCase(RoutesCase):
+    config_class = HybridTestConfig
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
-
-        
-    
\ No newline at end of file